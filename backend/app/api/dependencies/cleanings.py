@@ -0,0 +1,52 @@
+from typing import Optional, Tuple
+
+from fastapi import HTTPException, Query, status
+
+from app.models.cleaning import CLEANING_FIELDS, CleaningFilter
+from app.models.enum_type import CleaningType
+
+
+def get_cleaning_filter(
+        cleaning_type: Optional[CleaningType] = Query(None),
+        min_price: Optional[float] = Query(None, ge=0),
+        max_price: Optional[float] = Query(None, ge=0),
+        name_prefix: Optional[str] = Query(None, min_length=1, max_length=100),
+        search: Optional[str] = Query(None, min_length=1, max_length=200,
+                                      description="Full-text search on the description."),
+) -> CleaningFilter:
+    if min_price is not None and max_price is not None and min_price > max_price:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="min_price cannot be greater than max_price.")
+
+    return CleaningFilter(
+        cleaning_type=cleaning_type,
+        min_price=min_price,
+        max_price=max_price,
+        name_prefix=name_prefix,
+        search=search,
+    )
+
+
+def get_cleaning_fields(
+        fields: Optional[str] = Query(
+            None, description="Comma separated fields to send, all of them by default. The id is always sent."
+        ),
+) -> Optional[Tuple[str, ...]]:
+    """
+    The fields asked for, in a canonical order so that equal sets make equal queries and cache keys. None when all
+    of them are.
+    """
+    if fields is None:
+        return None
+
+    asked = {name.strip() for name in fields.split(",") if name.strip()}
+    unknown = asked.difference(CLEANING_FIELDS)
+    if unknown:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Unknown fields: {', '.join(sorted(unknown))}. "
+                                   f"Pick among {', '.join(CLEANING_FIELDS)}.")
+
+    asked.add("id")
+    if len(asked) == len(CLEANING_FIELDS):
+        return None
+    return tuple(name for name in CLEANING_FIELDS if name in asked)
@@ -0,0 +1,88 @@
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Dict, List, Optional
+
+from fastapi import Header, HTTPException, Path, Request, Response, status
+
+from app.models.cleaning import CleaningInDB
+
+
+def cleaning_etag(cleaning: CleaningInDB) -> str:
+    return f'W/"{cleaning.id}-{cleaning.version}"'
+
+
+def collection_etag(name: str, table_version: int) -> str:
+    return f'W/"{name}-{table_version}"'
+
+
+def http_date(moment: datetime) -> str:
+    return format_datetime(moment.astimezone(timezone.utc), usegmt=True)
+
+
+def _opaque_tag(tag: str) -> str:
+    tag = tag.strip()
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def is_not_modified(request: Request, etag: str, last_modified: datetime = None) -> bool:
+    """
+    Evaluate If-None-Match (weak comparison) or, when absent, If-Modified-Since against the current representation
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        return _opaque_tag(etag) in {_opaque_tag(tag) for tag in if_none_match.split(",")}
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            return False
+        # HTTP dates only have second precision
+        return last_modified.replace(microsecond=0) <= since
+
+    return False
+
+
+def cache_headers(etag: str, cache_control: str, last_modified: datetime = None) -> Dict[str, str]:
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if last_modified is not None:
+        headers["Last-Modified"] = http_date(last_modified)
+
+    return headers
+
+
+def not_modified(headers: Dict[str, str]) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+
+def get_if_match_versions(
+        cleaning_id: int = Path(..., ge=1),
+        if_match: Optional[str] = Header(None),
+) -> Optional[List[int]]:
+    """
+    Turn an If-Match header into the row versions a write may apply to. None means the write is unconditional.
+    Tags are compared on their version only, so the weak tags we hand out are accepted.
+    """
+    if if_match is None or if_match.strip() == "*":
+        return None
+
+    versions = []
+    for tag in if_match.split(","):
+        opaque = tag.strip()
+        if opaque.startswith("W/"):
+            opaque = opaque[2:]
+
+        tag_id, _, tag_version = opaque.strip('"').partition("-")
+        if tag_id == str(cleaning_id) and tag_version.isdigit():
+            versions.append(int(tag_version))
+
+    if not versions:
+        raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED,
+                            detail="The cleaning has been modified since it was last fetched.")
+
+    return versions
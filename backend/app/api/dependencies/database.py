@@ -1,9 +1,14 @@
-from typing import Type, Callable
+from typing import Optional, Type, Callable
 
 from databases import Database
 from fastapi import Depends
 
-from fastapi.requests import Request
+from fastapi.requests import HTTPConnection, Request
+from app.core import config
+from app.db.cache import CacheBackend
+from app.db.changes import ChangeFeed
+from app.db.coalescing import ReadCoalescer
+from app.db.replicas import ReplicaSet
 from app.db.repositories.base import BaseRepository
 
 
@@ -11,8 +16,54 @@ def get_database(request: Request) -> Database:
     return request.app.state.db
 
 
+def get_cache(request: Request) -> Optional[CacheBackend]:
+    return getattr(request.app.state, "cache", None)
+
+
+def get_coalescer(request: Request) -> Optional[ReadCoalescer]:
+    return getattr(request.app.state, "coalescer", None)
+
+
+def get_change_feed(connection: HTTPConnection) -> Optional[ChangeFeed]:
+    return getattr(connection.app.state, "change_feed", None)
+
+
+def get_replicas(request: Request) -> Optional[ReplicaSet]:
+    return getattr(request.app.state, "replicas", None)
+
+
+def must_read_primary(request: Request) -> bool:
+    """
+    Writes, and reads by a client within the read-your-writes window of its last write, stay on the primary
+    """
+    context = getattr(request.state, "context", None)
+    return context is not None and context.read_primary
+
+
+def get_deadline(request: Request) -> Optional[float]:
+    context = getattr(request.state, "context", None)
+    return context.deadline if context is not None else None
+
+
 def get_repository(repo_type: Type[BaseRepository]) -> Callable:
-    def _get_repo(db: Database = Depends(get_database)) -> Type[BaseRepository]:
-        return repo_type(db)
+    def _get_repo(
+            db: Database = Depends(get_database),
+            cache: Optional[CacheBackend] = Depends(get_cache),
+            replicas: Optional[ReplicaSet] = Depends(get_replicas),
+            read_primary: bool = Depends(must_read_primary),
+            coalescer: Optional[ReadCoalescer] = Depends(get_coalescer),
+            deadline: Optional[float] = Depends(get_deadline),
+    ) -> Type[BaseRepository]:
+        return repo_type(
+            db,
+            cache,
+            trust_rows=config.FAST_SERIALIZATION,
+            slow_query_ms=config.DB_SLOW_QUERY_MS if config.DB_SLOW_QUERY_MS >= 0 else None,
+            explain_slow_queries=config.DB_EXPLAIN_SLOW_QUERIES,
+            replicas=replicas,
+            read_primary=read_primary,
+            coalescer=coalescer,
+            deadline=deadline,
+        )
 
     return _get_repo
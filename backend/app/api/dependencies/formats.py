@@ -0,0 +1,14 @@
+from typing import Optional
+
+from fastapi import Header, Response
+
+from app.api.responses import negotiate_format
+from app.models.enum_type import ResponseFormat
+
+
+def get_response_format(response: Response, accept: Optional[str] = Header(None)) -> ResponseFormat:
+    """
+    Format of the response body, negotiated from the Accept header
+    """
+    response.headers["Vary"] = "Accept"
+    return negotiate_format(accept)
@@ -0,0 +1,140 @@
+from datetime import datetime
+from decimal import Decimal
+from typing import Any, List, Optional, Tuple
+
+import msgpack
+import orjson
+from fastapi import Response, status
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+from app.core import config
+from app.models.enum_type import ResponseFormat
+
+# Headers FastAPI puts on the injected response that must not leak onto the one we build
+_SKIPPED_HEADERS = {"content-length", "content-type"}
+
+MEDIA_TYPES = {
+    ResponseFormat.json: "application/json",
+    ResponseFormat.msgpack: "application/msgpack",
+    ResponseFormat.json_columns: "application/vnd.phresh.columns+json",
+    ResponseFormat.msgpack_columns: "application/vnd.phresh.columns+msgpack",
+}
+# Also understood in Accept, from before application/msgpack was registered
+MEDIA_TYPE_ALIASES = {"application/x-msgpack": ResponseFormat.msgpack}
+
+_FORMATS_BY_MEDIA_TYPE = {**{media_type: response_format for response_format, media_type in MEDIA_TYPES.items()},
+                          **MEDIA_TYPE_ALIASES}
+_COLUMNAR = {ResponseFormat.json_columns: ResponseFormat.json, ResponseFormat.msgpack_columns: ResponseFormat.msgpack}
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, BaseModel):
+        # Our models are flat and built from trusted rows, their __dict__ is already the payload
+        return obj.__dict__
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def _msgpack_default(obj: Any) -> Any:
+    if isinstance(obj, datetime) and obj.tzinfo is None:
+        # Aware datetimes go out as the msgpack timestamp extension, naive ones cannot
+        return obj.isoformat()
+    return _default(obj)
+
+
+def dumps(content: Any) -> bytes:
+    return orjson.dumps(content, default=_default)
+
+
+def msgpack_dumps(content: Any) -> bytes:
+    return msgpack.packb(content, default=_msgpack_default, datetime=True)
+
+
+def as_columns(rows: List[BaseModel]) -> dict:
+    """
+    A list of flat models as one list per field, so field names are sent once and every column holds values of one
+    type. An empty list has no columns.
+    """
+    if not rows:
+        return {}
+    return {field: [row.__dict__[field] for row in rows] for field in rows[0].__dict__}
+
+
+def _parse_accept(accept: str) -> List[Tuple[str, float]]:
+    media_ranges = []
+    for part in accept.split(","):
+        media_type, *params = part.split(";")
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        media_ranges.append((media_type.strip().lower(), quality))
+    return media_ranges
+
+
+def negotiate_format(accept: Optional[str]) -> ResponseFormat:
+    """
+    Format preferred by an Accept header, by quality then order. JSON unless another format we serve is preferred
+    to it: wildcards and media types we do not serve count as JSON, clients sending them get what they always got.
+    """
+    best, best_quality = ResponseFormat.json, -1.0
+    for media_type, quality in _parse_accept(accept or ""):
+        if quality > best_quality and quality > 0:
+            best, best_quality = _FORMATS_BY_MEDIA_TYPE.get(media_type, ResponseFormat.json), quality
+    return best
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    Encode straight to bytes with orjson, pydantic models included
+    """
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+class MsgPackResponse(Response):
+    media_type = MEDIA_TYPES[ResponseFormat.msgpack]
+
+    def render(self, content: Any) -> bytes:
+        return msgpack_dumps(content)
+
+
+def respond(
+        content: Any,
+        response: Response,
+        *,
+        status_code: int = status.HTTP_200_OK,
+        response_format: ResponseFormat = ResponseFormat.json,
+        partial: bool = False,
+) -> Any:
+    """
+    With FAST_SERIALIZATION on, skip FastAPI's response_model validation and jsonable_encoder by returning an
+    already encoded response; headers set on the injected `response` are carried over. Otherwise return the
+    content untouched and let FastAPI serialize it as usual.
+
+    Other formats than JSON are always encoded here, and so are `partial` models (sparse fieldsets), which the
+    response_model would fill back with the fields left out. Columnar formats only apply to lists, anything else is
+    sent as rows in the same encoding.
+    """
+    media_type = None
+    if response_format in _COLUMNAR:
+        if isinstance(content, list):
+            content, media_type = as_columns(content), MEDIA_TYPES[response_format]
+        response_format = _COLUMNAR[response_format]
+
+    if response_format is ResponseFormat.json and not (config.FAST_SERIALIZATION or partial) and media_type is None:
+        return content
+
+    response_class = MsgPackResponse if response_format is ResponseFormat.msgpack else FastJSONResponse
+    encoded_response = response_class(content=content, status_code=status_code, media_type=media_type)
+    for key, value in response.headers.items():
+        if key not in _SKIPPED_HEADERS:
+            encoded_response.headers[key] = value
+
+    return encoded_response
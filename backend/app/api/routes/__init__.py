@@ -1,6 +1,8 @@
-from fastapi import APIRouter
 from app.api.routes.cleanings import router as cleaning_router
+from app.api.routes.jobs import router as jobs_router
 
-router = APIRouter()
-
-router.include_router(cleaning_router, prefix="/cleanings", tags=["cleanings"])
+# Routers of the API, with their prefix under /api and their tags
+routers = [
+    (cleaning_router, "/cleanings", ["cleanings"]),
+    (jobs_router, "/jobs", ["jobs"]),
+]
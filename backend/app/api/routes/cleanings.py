@@ -1,63 +1,421 @@
-from typing import List
+import asyncio
+from typing import Any, AsyncIterator, List, Optional, Tuple, Type, Union
 
-from fastapi import APIRouter, status, Body, Depends, HTTPException, Path
+from fastapi import (
+    APIRouter, status, Body, Depends, Header, HTTPException, Path, Query, Request, Response, WebSocket,
+)
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from starlette.background import BackgroundTask
 
-from app.api.dependencies.database import get_repository
-from app.db.repositories.cleanings import CleaningsRepository
-from app.models.cleaning import CleaningPublic, CleaningCreate, CleaningUpdate
+from app.api.dependencies.cleanings import get_cleaning_fields, get_cleaning_filter
+from app.api.dependencies.conditional import (
+    cache_headers, cleaning_etag, collection_etag, get_if_match_versions, is_not_modified, not_modified,
+)
+from app.api.dependencies.database import get_change_feed, get_repository
+from app.api.dependencies.formats import get_response_format
+from app.api.dependencies.pagination import decode_cursor, encode_cursor
+from app.api.responses import dumps, respond
+from app.core import config
+from app.core.metrics import CHANGE_FEED_EVENTS
+from app.db import bulk
+from app.db.changes import ChangeFeed, ChangeSubscription
+from app.db.repositories.cleanings import CleaningsRepository, decode_change_cursor, encode_change_cursor
+from app.models.cleaning import (
+    CleaningPublic, CleaningCreate, CleaningUpdate, CleaningInDB, CleaningFilter,
+    CleaningBatchUpdate, CleaningBatchItemResult, CleaningBatchResult, CleaningStats, CleaningImportResult,
+    sparse_cleaning,
+)
+from app.models.core import CoreModel
+from app.models.enum_type import BatchItemStatus, BulkFormat, CleaningSort, ResponseFormat
 
 router = APIRouter()
 
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+EVENT_STREAM_MEDIA_TYPE = "text/event-stream"
+
+
+async def _as_ndjson(cleanings: AsyncIterator[CleaningInDB]) -> AsyncIterator[Union[bytes, str]]:
+    async for cleaning in cleanings:
+        yield dumps(cleaning) + b"\n" if config.FAST_SERIALIZATION else cleaning.json() + "\n"
+
+
+def _check_batch_size(items: List[Any]) -> None:
+    if len(items) > config.CLEANINGS_MAX_BATCH_SIZE:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"Batches are limited to {config.CLEANINGS_MAX_BATCH_SIZE} items.")
+
+
+def _validate_batch(
+        items: List[Any], model: Type[CoreModel]
+) -> Tuple[List[Tuple[int, CoreModel]], List[CleaningBatchItemResult]]:
+    """
+    Validate every item on its own, so one bad item is reported instead of rejecting the whole batch
+    """
+    valid, invalid = [], []
+    for index, item in enumerate(items):
+        try:
+            valid.append((index, model.parse_obj(item)))
+        except ValidationError as e:
+            invalid.append(CleaningBatchItemResult(index=index, status=BatchItemStatus.invalid, errors=e.errors()))
+
+    return valid, invalid
+
 
 @router.get("/", response_model=List[CleaningPublic], name="cleanings:get-all-cleanings")
 async def get_all_cleanings(
+        request: Request,
+        response: Response,
+        limit: int = Query(config.CLEANINGS_PAGE_SIZE, ge=1, le=config.CLEANINGS_MAX_PAGE_SIZE),
+        after: Optional[str] = Query(None, description="Opaque cursor taken from the X-Next-Cursor header."),
+        sort: CleaningSort = Query(CleaningSort.id),
+        filters: CleaningFilter = Depends(get_cleaning_filter),
+        fields: Optional[Tuple[str, ...]] = Depends(get_cleaning_fields),
+        response_format: ResponseFormat = Depends(get_response_format),
         cleanings_repo: CleaningsRepository = Depends(get_repository(CleaningsRepository))
 ) -> List[CleaningPublic]:
-    return await cleanings_repo.get_all_cleanings()
+    """
+    With `fields`, only those columns are read and sent, along with the id and the column sorted by
+    """
+    after_key = decode_cursor(after) if after else None
+
+    # Clients asking for NDJSON get every remaining row streamed from a server-side cursor instead of a page
+    if NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+        return StreamingResponse(
+            _as_ndjson(cleanings_repo.iterate_cleanings(filters=filters, sort=sort, after=after_key, fields=fields)),
+            media_type=NDJSON_MEDIA_TYPE,
+        )
+
+    # Any write to the table moves its version, so an unchanged version means every page is still current
+    headers = {
+        **cache_headers(
+            collection_etag("cleanings", await cleanings_repo.get_table_version()),
+            config.CLEANINGS_LIST_CACHE_CONTROL,
+        ),
+        "Vary": "Accept",
+    }
+    if is_not_modified(request, headers["ETag"]):
+        return not_modified(headers)
+
+    # Fetch one extra row to find out whether there is a next page
+    cleanings = await cleanings_repo.get_all_cleanings(
+        limit=limit + 1, filters=filters, sort=sort, after=after_key, fields=fields
+    )
+
+    if len(cleanings) > limit:
+        cleanings = cleanings[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(cleanings_repo.get_page_key(cleanings[-1], sort=sort))
+
+    response.headers.update(headers)
+    return respond(cleanings, response, response_format=response_format, partial=fields is not None)
+
+
+@router.get("/stats", response_model=CleaningStats, name="cleanings:get-cleaning-stats")
+async def get_cleaning_stats(
+        response: Response,
+        response_format: ResponseFormat = Depends(get_response_format),
+        cleanings_repo: CleaningsRepository = Depends(get_repository(CleaningsRepository))
+) -> CleaningStats:
+    return respond(await cleanings_repo.get_stats(), response, response_format=response_format)
+
+
+@router.get("/export", name="cleanings:export-cleanings")
+async def export_cleanings(
+        export_format: BulkFormat = Query(BulkFormat.csv, alias="format"),
+        sort: CleaningSort = Query(CleaningSort.id),
+        filters: CleaningFilter = Depends(get_cleaning_filter),
+        cleanings_repo: CleaningsRepository = Depends(get_repository(CleaningsRepository))
+) -> StreamingResponse:
+    return StreamingResponse(
+        bulk.export_cleanings(cleanings_repo, export_format, filters=filters, sort=sort),
+        media_type=bulk.MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="cleanings.{export_format.value}"'},
+    )
+
+
+@router.post("/import", response_model=CleaningImportResult, name="cleanings:import-cleanings")
+async def import_cleanings(
+        request: Request,
+        response: Response,
+        response_format: ResponseFormat = Depends(get_response_format),
+        cleanings_repo: CleaningsRepository = Depends(get_repository(CleaningsRepository))
+) -> CleaningImportResult:
+    """
+    Import a CSV file (with a header) or NDJSON, as told by the Content-Type. The body is read as it is uploaded.
+    """
+    import_format = bulk.format_of_media_type(request.headers.get("content-type"))
+    if import_format is None:
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                            detail=f"Send one of {', '.join(bulk.MEDIA_TYPES.values())}.")
+
+    try:
+        result = await bulk.import_cleanings(
+            cleanings_repo, request.stream(), import_format,
+            chunk_size=config.CLEANINGS_IMPORT_CHUNK_SIZE, max_errors=config.CLEANINGS_IMPORT_MAX_ERRORS,
+        )
+    except bulk.BulkImportError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=e.detail())
+
+    return respond(result, response, response_format=response_format)
+
+
+def _opening_message(subscription: ChangeSubscription) -> Tuple[str, str]:
+    """
+    First message of a change stream: `ready`, or `resync` when the cursor asked for had expired and the client
+    must refetch what it shows. Either carries the cursor to resume from.
+    """
+    op = "resync" if subscription.expired else "ready"
+    return op, dumps({"op": op, "cursor": encode_change_cursor(subscription.position)}).decode()
+
+
+async def _as_event_stream(subscription: ChangeSubscription) -> AsyncIterator[str]:
+    try:
+        op, data = _opening_message(subscription)
+        yield f"id: {encode_change_cursor(subscription.position)}\nevent: {op}\ndata: {data}\n\n"
+
+        while not subscription.closed:
+            events = await subscription.next_events(config.CLEANINGS_CHANGES_HEARTBEAT_SECONDS)
+            if not events:
+                # Keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+                continue
+
+            yield "".join(f"id: {event.cursor}\nevent: {event.op}\ndata: {event.data}\n\n" for event in events)
+            CHANGE_FEED_EVENTS.inc(len(events))
+    finally:
+        subscription.close()
+
+
+@router.get("/changes", name="cleanings:get-cleaning-changes")
+async def get_cleaning_changes(
+        after: Optional[str] = Query(None, description="Cursor of the last change seen, the id of its event."),
+        last_event_id: Optional[str] = Header(None, description="Sent by EventSource when it reconnects."),
+        change_feed: ChangeFeed = Depends(get_change_feed),
+) -> StreamingResponse:
+    """
+    Server-sent events for every cleaning created, updated or deleted, so clients need not poll the list. Each
+    event is named after its op and identified by its cursor; without a cursor, changes start from now on. The
+    Last-Event-ID header wins over `after`.
+    """
+    cursor = last_event_id or after
+    subscription = await change_feed.subscribe(after=decode_change_cursor(cursor) if cursor else None)
+
+    # When the client leaves, the stream is cancelled between two events and never gets to close the subscription;
+    # the background task runs either way
+    return StreamingResponse(
+        _as_event_stream(subscription),
+        media_type=EVENT_STREAM_MEDIA_TYPE,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(subscription.close),
+    )
+
+
+async def _send_changes(websocket: WebSocket, subscription: ChangeSubscription) -> None:
+    await websocket.send_text(_opening_message(subscription)[1])
+
+    while not subscription.closed:
+        events = await subscription.next_events(config.CLEANINGS_CHANGES_HEARTBEAT_SECONDS)
+        for event in events:
+            await websocket.send_text(event.data)
+        CHANGE_FEED_EVENTS.inc(len(events))
+
+
+async def _wait_for_disconnect(websocket: WebSocket) -> None:
+    # Clients have nothing to say, reading only tells when they leave
+    while (await websocket.receive())["type"] != "websocket.disconnect":
+        pass
+
+
+@router.websocket("/changes/ws", name="cleanings:cleaning-changes-ws")
+async def cleaning_changes_ws(
+        websocket: WebSocket,
+        after: Optional[str] = Query(None),
+        change_feed: ChangeFeed = Depends(get_change_feed),
+) -> None:
+    """
+    The change feed over a WebSocket: one JSON message per change, after a `ready` or `resync` one
+    """
+    try:
+        position = decode_change_cursor(after) if after else None
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+    subscription = await change_feed.subscribe(after=position)
+    sending = asyncio.ensure_future(_send_changes(websocket, subscription))
+    receiving = asyncio.ensure_future(_wait_for_disconnect(websocket))
+    try:
+        await asyncio.wait({sending, receiving}, return_when=asyncio.FIRST_COMPLETED)
+        if not receiving.done():
+            # The feed stopped, or failed to read the log
+            failed = not sending.cancelled() and sending.exception() is not None
+            await websocket.close(code=status.WS_1011_INTERNAL_ERROR if failed else status.WS_1001_GOING_AWAY)
+    finally:
+        sending.cancel()
+        receiving.cancel()
+        await asyncio.gather(sending, receiving, return_exceptions=True)
+        subscription.close()
 
 
 @router.post("/", response_model=CleaningPublic, name="cleanings:create-cleaning", status_code=status.HTTP_201_CREATED)
 async def create_new_cleaning(
+        response: Response,
         new_cleaning: CleaningCreate = Body(..., embed=True),
+        response_format: ResponseFormat = Depends(get_response_format),
         cleanings_repo: CleaningsRepository = Depends(get_repository(CleaningsRepository))
 ) -> CleaningPublic:
-    return await cleanings_repo.create_cleaning(new_cleaning=new_cleaning)
+    created_cleaning = await cleanings_repo.create_cleaning(new_cleaning=new_cleaning)
+    return respond(created_cleaning, response, status_code=status.HTTP_201_CREATED, response_format=response_format)
+
+
+@router.post("/batch", response_model=CleaningBatchResult, name="cleanings:create-cleanings-batch")
+async def create_cleanings_batch(
+        response: Response,
+        new_cleanings: List[Any] = Body(..., embed=True),
+        response_format: ResponseFormat = Depends(get_response_format),
+        cleanings_repo: CleaningsRepository = Depends(get_repository(CleaningsRepository))
+) -> CleaningBatchResult:
+    _check_batch_size(new_cleanings)
+    valid, results = _validate_batch(new_cleanings, CleaningCreate)
+
+    created_cleanings = await cleanings_repo.create_cleanings(new_cleanings=[cleaning for _, cleaning in valid])
+
+    for (index, _), cleaning in zip(valid, created_cleanings):
+        results.append(
+            CleaningBatchItemResult(index=index, status=BatchItemStatus.created, id=cleaning.id, cleaning=cleaning)
+        )
+
+    return respond(
+        CleaningBatchResult(results=sorted(results, key=lambda result: result.index)), response,
+        response_format=response_format,
+    )
+
+
+@router.patch("/batch", response_model=CleaningBatchResult, name="cleanings:update-cleanings-batch")
+async def update_cleanings_batch(
+        response: Response,
+        cleaning_updates: List[Any] = Body(..., embed=True),
+        response_format: ResponseFormat = Depends(get_response_format),
+        cleanings_repo: CleaningsRepository = Depends(get_repository(CleaningsRepository))
+) -> CleaningBatchResult:
+    _check_batch_size(cleaning_updates)
+    valid, results = _validate_batch(cleaning_updates, CleaningBatchUpdate)
+
+    # An id may only appear once per statement, later duplicates are reported as invalid
+    unique, seen_ids = [], set()
+    for index, update in valid:
+        if update.id in seen_ids:
+            results.append(CleaningBatchItemResult(
+                index=index, status=BatchItemStatus.invalid, id=update.id,
+                errors=[{"loc": ["id"], "msg": "duplicate id in batch", "type": "value_error.duplicate"}],
+            ))
+        else:
+            seen_ids.add(update.id)
+            unique.append((index, update))
+
+    updated_cleanings = {
+        cleaning.id: cleaning
+        for cleaning in await cleanings_repo.update_cleanings(cleaning_updates=[update for _, update in unique])
+    }
+
+    for index, update in unique:
+        cleaning = updated_cleanings.get(update.id)
+        results.append(CleaningBatchItemResult(
+            index=index,
+            status=BatchItemStatus.updated if cleaning else BatchItemStatus.not_found,
+            id=update.id,
+            cleaning=cleaning,
+        ))
+
+    return respond(
+        CleaningBatchResult(results=sorted(results, key=lambda result: result.index)), response,
+        response_format=response_format,
+    )
+
+
+@router.delete("/batch", response_model=CleaningBatchResult, name="cleanings:delete-cleanings-batch")
+async def delete_cleanings_batch(
+        response: Response,
+        ids: List[int] = Body(..., embed=True),
+        response_format: ResponseFormat = Depends(get_response_format),
+        cleanings_repo: CleaningsRepository = Depends(get_repository(CleaningsRepository))
+) -> CleaningBatchResult:
+    _check_batch_size(ids)
+
+    deleted_ids = set(await cleanings_repo.delete_cleanings(delete_ids=list(set(ids))))
+
+    return respond(CleaningBatchResult(results=[
+        CleaningBatchItemResult(
+            index=index, status=BatchItemStatus.deleted if delete_id in deleted_ids else BatchItemStatus.not_found,
+            id=delete_id,
+        )
+        for index, delete_id in enumerate(ids)
+    ]), response, response_format=response_format)
 
 
 @router.get("/{cleaning_id}/", response_model=CleaningPublic, name="cleanings:get-cleaning-by-id")
 async def get_cleaning_by_id(
-        cleaning_id: int, cleanings_repo: CleaningsRepository = Depends(get_repository(CleaningsRepository))
+        cleaning_id: int,
+        request: Request,
+        response: Response,
+        fields: Optional[Tuple[str, ...]] = Depends(get_cleaning_fields),
+        response_format: ResponseFormat = Depends(get_response_format),
+        cleanings_repo: CleaningsRepository = Depends(get_repository(CleaningsRepository))
 ) -> CleaningPublic:
+    """
+    `fields` are picked from the whole cleaning: single cleanings are cached and batched whole, one entry serves
+    every projection
+    """
     cleaning = await cleanings_repo.get_cleaning_by_id(get_id=cleaning_id)
 
     if not cleaning:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No cleaning found that id")
 
-    return cleaning
+    headers = cache_headers(cleaning_etag(cleaning), config.CLEANING_CACHE_CONTROL, cleaning.updated_at)
+    if is_not_modified(request, headers["ETag"], cleaning.updated_at):
+        return not_modified(headers)
+
+    response.headers.update(headers)
+    if fields is not None:
+        return respond(sparse_cleaning(cleaning, fields), response, response_format=response_format, partial=True)
+    return respond(cleaning, response, response_format=response_format)
 
 
 @router.put("/{cleaning_id}/", response_model=CleaningPublic, name="cleanings:update-cleaning-by-id")
+@router.patch("/{cleaning_id}/", response_model=CleaningPublic, name="cleanings:patch-cleaning-by-id")
 async def update_cleaning_by_id(
+        response: Response,
         cleaning_id: int = Path(..., ge=1, title="The ID of the cleaning to update."),
         cleaning_update: CleaningUpdate = Body(..., embed=True),
+        expected_versions: Optional[List[int]] = Depends(get_if_match_versions),
+        response_format: ResponseFormat = Depends(get_response_format),
         cleanings_repo: CleaningsRepository = Depends(get_repository(CleaningsRepository))
 ) -> CleaningPublic:
-    updated_cleaning = await cleanings_repo.update_cleaning(update_id=cleaning_id, cleaning_update=cleaning_update)
+    updated_cleaning = await cleanings_repo.update_cleaning(
+        update_id=cleaning_id, cleaning_update=cleaning_update, expected_versions=expected_versions
+    )
 
     if not updated_cleaning:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No cleaning found with that id")
 
-    return updated_cleaning
+    response.headers.update(
+        cache_headers(cleaning_etag(updated_cleaning), config.CLEANING_CACHE_CONTROL, updated_cleaning.updated_at)
+    )
+    return respond(updated_cleaning, response, response_format=response_format)
 
 
 @router.delete("/{cleaning_id}/", response_model=int, name="cleanings:delete-cleaning-by-id")
 async def delete_cleaning_by_id(
+        response: Response,
         cleaning_id: int = Path(..., ge=1, title="The ID of the cleaning to delete."),
+        expected_versions: Optional[List[int]] = Depends(get_if_match_versions),
+        response_format: ResponseFormat = Depends(get_response_format),
         cleanings_repo: CleaningsRepository = Depends(get_repository(CleaningsRepository))
 ) -> int:
-    deleted_id = await cleanings_repo.delete_cleanings_by_id(delete_id=cleaning_id)
+    deleted_id = await cleanings_repo.delete_cleanings_by_id(delete_id=cleaning_id, expected_versions=expected_versions)
 
     if not deleted_id:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No cleaning found with that id.")
 
-    return deleted_id
+    return respond(deleted_id, response, response_format=response_format)
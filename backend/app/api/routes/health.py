@@ -0,0 +1,52 @@
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import JSONResponse
+from databases import Database
+from loguru import logger
+
+from app.api.dependencies.database import get_change_feed, get_coalescer, get_database, get_replicas
+from app.db.changes import ChangeFeed
+from app.db.coalescing import ReadCoalescer
+from app.db.pool import get_pool
+from app.db.replicas import ReplicaSet
+
+router = APIRouter()
+
+
+@router.get("/live", name="health:live")
+async def live() -> dict:
+    return {"status": "ok"}
+
+
+@router.get("/ready", name="health:ready")
+async def ready(
+        request: Request,
+        db: Database = Depends(get_database),
+        replicas: Optional[ReplicaSet] = Depends(get_replicas),
+        coalescer: Optional[ReadCoalescer] = Depends(get_coalescer),
+        change_feed: Optional[ChangeFeed] = Depends(get_change_feed),
+) -> JSONResponse:
+    """
+    Only the primary decides readiness: without replicas, reads fall back to it
+    """
+    try:
+        await db.fetch_val("SELECT 1")
+        status_code = 200
+    except Exception as e:
+        logger.warning(f"readiness check failed: {e!r}")
+        status_code = 503
+
+    pool = get_pool(db)
+    admission = getattr(request.app.state, "admission", None)
+    return JSONResponse(
+        {
+            "status": "ok" if status_code == 200 else "unavailable",
+            "pool": pool.stats() if pool else None,
+            "replicas": replicas.stats() if replicas is not None else [],
+            "coalescing": coalescer.stats() if coalescer is not None else None,
+            "change_feed": change_feed.stats() if change_feed is not None else None,
+            "admission": admission.stats() if admission is not None else None,
+        },
+        status_code=status_code,
+    )
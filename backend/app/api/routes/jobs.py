@@ -0,0 +1,46 @@
+from fastapi import APIRouter, status, Body, Depends, HTTPException, Path, Request, Response
+from pydantic import ValidationError
+
+from app.api.dependencies.database import get_repository
+from app.api.responses import respond
+from app.core import config
+from app.db.repositories.jobs import JobsRepository
+from app.jobs.handlers import JOB_HANDLERS
+from app.models.job import JobCreate, JobPublic
+
+router = APIRouter()
+
+
+@router.post("/", response_model=JobPublic, name="jobs:enqueue-job", status_code=status.HTTP_202_ACCEPTED)
+async def enqueue_job(
+        request: Request,
+        response: Response,
+        new_job: JobCreate = Body(..., embed=True),
+        jobs_repo: JobsRepository = Depends(get_repository(JobsRepository))
+) -> JobPublic:
+    # Reject a bad payload now rather than when a worker picks the job up
+    try:
+        payload = JOB_HANDLERS[new_job.kind].payload_model.parse_obj(new_job.payload)
+    except ValidationError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=e.errors())
+
+    job = await jobs_repo.enqueue_job(
+        new_job=new_job.copy(update={"payload": payload.dict()}), default_max_attempts=config.JOBS_MAX_ATTEMPTS
+    )
+
+    response.headers["Location"] = request.url_for("jobs:get-job-by-id", job_id=str(job.id))
+    return respond(job, response, status_code=status.HTTP_202_ACCEPTED)
+
+
+@router.get("/{job_id}/", response_model=JobPublic, name="jobs:get-job-by-id")
+async def get_job_by_id(
+        response: Response,
+        job_id: int = Path(..., ge=1),
+        jobs_repo: JobsRepository = Depends(get_repository(JobsRepository))
+) -> JobPublic:
+    job = await jobs_repo.get_job_by_id(job_id=job_id)
+
+    if not job:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No job found with that id.")
+
+    return respond(job, response)
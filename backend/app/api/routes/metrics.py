@@ -0,0 +1,10 @@
+from fastapi import APIRouter, Response
+
+from app.core.metrics import CONTENT_TYPE_LATEST, render_metrics
+
+router = APIRouter()
+
+
+@router.get("/metrics", name="metrics", include_in_schema=False)
+async def metrics() -> Response:
+    return Response(render_metrics(), media_type=CONTENT_TYPE_LATEST)
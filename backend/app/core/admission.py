@@ -0,0 +1,229 @@
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, Optional, Tuple
+
+import orjson
+from starlette.routing import Match
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.core.context import SAFE_METHODS
+from app.core.metrics import ADMISSION_QUEUE_WAIT, ADMISSION_QUEUED, ADMISSION_REQUESTS
+
+READ = "read"
+WRITE = "write"
+
+QUEUE_FULL = "queue_full"
+QUEUE_TIMEOUT = "queue_timeout"
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str) -> None:
+        super().__init__(reason)
+        self.reason = reason
+
+
+class Limiter:
+    """
+    At most `concurrency` holders at a time, and at most `queue_size` more waiting for a slot, first come first
+    served. A released slot goes straight to the next waiter.
+    """
+
+    def __init__(self, concurrency: int, queue_size: int) -> None:
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.active = 0
+        self.admitted_total = 0
+        self.queued_total = 0
+        self.shed_total = 0
+        self._waiters = deque()  # type: Deque[asyncio.Future]
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, timeout: float) -> bool:
+        """
+        Take a slot, waiting up to `timeout` seconds; True when the request had to wait. Raises AdmissionRejected
+        when the queue is full or the wait times out.
+        """
+        if self.active < self.concurrency and not self._waiters:
+            self.active += 1
+            self.admitted_total += 1
+            return False
+
+        if len(self._waiters) >= self.queue_size or timeout <= 0:
+            self.shed_total += 1
+            raise AdmissionRejected(QUEUE_FULL if timeout > 0 else QUEUE_TIMEOUT)
+
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        self.queued_total += 1
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # Handed a slot just as we gave up
+                self.release()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self.shed_total += 1
+                raise AdmissionRejected(QUEUE_TIMEOUT)
+            raise
+
+        self.admitted_total += 1
+        return True
+
+    def release(self) -> None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "concurrency": self.concurrency,
+            "queue_size": self.queue_size,
+            "active": self.active,
+            "queued": self.queued,
+            "admitted_total": self.admitted_total,
+            "queued_total": self.queued_total,
+            "shed_total": self.shed_total,
+        }
+
+
+class AdmissionController:
+    """
+    Bounds how many requests a worker serves at once so that a burst waits here, briefly and in bounded number,
+    instead of piling up in front of the connection pool where every request ends up slow. Reads and writes have
+    their own slots and queues: however many reads are waiting, writes never queue behind them. Routes may have a
+    lower limit of their own (long exports holding a connection for their whole stream); their queue is as long
+    as their limit. No request waits more than `queue_timeout` seconds in total.
+    """
+
+    def __init__(
+            self,
+            *,
+            read_concurrency: int,
+            read_queue_size: int,
+            write_concurrency: int,
+            write_queue_size: int,
+            queue_timeout: float,
+            route_limits: Dict[str, int] = None,
+    ) -> None:
+        self.queue_timeout = queue_timeout
+        self.classes = {
+            READ: Limiter(read_concurrency, read_queue_size),
+            WRITE: Limiter(write_concurrency, write_queue_size),
+        }
+        self.routes = {name: Limiter(limit, limit) for name, limit in (route_limits or {}).items()}
+
+    async def admit(self, priority: str, route: Optional[str]) -> Tuple[Limiter, ...]:
+        """
+        The limiters whose slots the request holds, to be released once it is served
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.queue_timeout
+        limiters = ([self.routes[route]] if route in self.routes else []) + [self.classes[priority]]
+
+        held = []
+        queued = False
+        started = time.perf_counter()
+        try:
+            for limiter in limiters:
+                queued = await limiter.acquire(deadline - loop.time()) or queued
+                held.append(limiter)
+        except BaseException as e:
+            self.release(held)
+            if isinstance(e, AdmissionRejected):
+                ADMISSION_REQUESTS.labels(priority, f"shed_{e.reason}").inc()
+            raise
+
+        ADMISSION_REQUESTS.labels(priority, "admitted").inc()
+        if queued:
+            ADMISSION_QUEUED.labels(priority).inc()
+            ADMISSION_QUEUE_WAIT.labels(priority).observe(time.perf_counter() - started)
+        return tuple(held)
+
+    @staticmethod
+    def release(limiters: Iterable[Limiter]) -> None:
+        for limiter in limiters:
+            limiter.release()
+
+    def stats(self) -> Dict[str, Dict[str, Dict[str, int]]]:
+        return {
+            "classes": {priority: limiter.stats() for priority, limiter in self.classes.items()},
+            "routes": {name: limiter.stats() for name, limiter in self.routes.items()},
+        }
+
+
+def parse_route_limits(entries: Iterable[str]) -> Dict[str, int]:
+    """
+    `route name=limit` entries, as in ADMISSION_ROUTE_LIMITS
+    """
+    limits = {}
+    for entry in entries:
+        name, separator, limit = entry.rpartition("=")
+        if not separator or not name.strip():
+            raise ValueError(f"Route limits are given as name=limit, not {entry!r}")
+        limits[name.strip()] = int(limit)
+    return limits
+
+
+class AdmissionMiddleware:
+    """
+    Admit HTTP requests through an AdmissionController, or turn them away with a 503 and a Retry-After. Slots are
+    held until the response is sent, streamed bodies included, so long-lived streams that hold no connection
+    (the change feed) must be listed in `exempt_routes`. Requests that match no route are not limited.
+    """
+
+    def __init__(self, app: ASGIApp, *, controller: AdmissionController, exempt_routes: Iterable[str] = ()) -> None:
+        self.app = app
+        self.controller = controller
+        self.exempt_routes = frozenset(exempt_routes)
+
+    @staticmethod
+    def _match_route(scope: Scope) -> Tuple[Optional[str], dict]:
+        # Routing is done again by the router; only the matched route's name is needed here
+        for route in getattr(scope.get("app"), "routes", ()):
+            match, child_scope = route.matches(scope)
+            if match is Match.FULL:
+                return getattr(route, "name", None), child_scope
+        return None, {}
+
+    async def _shed(self, send: Send) -> None:
+        retry_after = max(1, math.ceil(self.controller.queue_timeout))
+        await send({
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [(b"content-type", b"application/json"), (b"retry-after", str(retry_after).encode())],
+        })
+        await send({"type": "http.response.body", "body": orjson.dumps({"detail": "Server is busy, please retry."})})
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route, child_scope = self._match_route(scope)
+        if route is None or route in self.exempt_routes:
+            await self.app(scope, receive, send)
+            return
+
+        priority = READ if scope["method"] in SAFE_METHODS else WRITE
+        try:
+            held = await self.controller.admit(priority, route)
+        except AdmissionRejected:
+            # Lets the metrics label the rejected request with its route
+            scope.update(child_scope)
+            await self._shed(send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(held)
@@ -0,0 +1,109 @@
+import asyncio
+import time
+from typing import List, Optional
+
+import orjson
+from loguru import logger
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.core.metrics import HTTP_REQUESTS_CANCELLED
+
+DISCONNECTED = "disconnected"
+DEADLINE = "deadline"
+
+
+class CancellationMiddleware:
+    """
+    Cancel the handling of a request when nobody will read its response: the client disconnected, or the request's
+    deadline (see RequestContextMiddleware) passed, which is answered with a 504. Queries in flight are cancelled
+    with the handler (asyncpg asks the server to cancel them) and their connections go back to the pool.
+
+    Only until the response starts: a streamed response stops by itself when it hears the client left, and is let
+    finish whatever the deadline (its queries are bounded by the repositories). Cancelling it would leave behind
+    the tasks Starlette streams it with.
+
+    A client leaving is only heard once the request body has been read: from the start for requests without a body,
+    otherwise once the app has read it.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        context = scope.get("state", {}).get("context")
+        deadline = getattr(context, "deadline", None)  # type: Optional[float]
+        headers = Headers(scope=scope)
+
+        body_read, disconnected = asyncio.Event(), asyncio.Event()
+        prefetched = []  # type: List[Message]
+        response_started = False
+
+        if "transfer-encoding" not in headers and headers.get("content-length", "0") == "0":
+            # No body: read the one empty message now, so that listening for the client leaving can start
+            prefetched.append(await receive())
+            body_read.set()
+
+        async def receive_body() -> Message:
+            if prefetched:
+                return prefetched.pop()
+            if body_read.is_set():
+                # Listening for the client leaving is done by the middleware; the app hears of it the same
+                await disconnected.wait()
+                return {"type": "http.disconnect"}
+
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                disconnected.set()
+            if message["type"] == "http.disconnect" or not message.get("more_body", False):
+                body_read.set()
+            return message
+
+        async def send_tracked(message: Message) -> None:
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        async def listen_for_disconnect() -> None:
+            await body_read.wait()
+            while not disconnected.is_set():
+                if (await receive())["type"] == "http.disconnect":
+                    disconnected.set()
+
+        handling = asyncio.ensure_future(self.app(scope, receive_body, send_tracked))
+        listening = asyncio.ensure_future(listen_for_disconnect())
+        try:
+            while not handling.done():
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                await asyncio.wait({handling, listening}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if handling.done() or response_started:
+                    # From now on the app hears of the client leaving through `receive`, like streamed responses do
+                    break
+
+                reason = DISCONNECTED if listening.done() else DEADLINE
+                handling.cancel()
+                await asyncio.gather(handling, return_exceptions=True)
+                HTTP_REQUESTS_CANCELLED.labels(reason).inc()
+                logger.info(f"cancelled {scope['method']} {scope['path']}: {reason}")
+                # Unless the handler answered all the same, its queries having hit the same deadline
+                if reason == DEADLINE and not response_started:
+                    await send({
+                        "type": "http.response.start",
+                        "status": 504,
+                        "headers": [(b"content-type", b"application/json")],
+                    })
+                    await send({"type": "http.response.body", "body": orjson.dumps({"detail": "Request timed out."})})
+                return
+
+            await handling
+        finally:
+            listening.cancel()
+            if not handling.done():
+                # The server is cancelling us
+                handling.cancel()
+            await asyncio.gather(handling, listening, return_exceptions=True)
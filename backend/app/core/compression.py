@@ -0,0 +1,135 @@
+import zlib
+from typing import Optional
+
+import brotli
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Preferred first when a client accepts several equally
+ENCODINGS = ("br", "gzip")
+# Already compressed, compressing them again only costs CPU
+INCOMPRESSIBLE_MEDIA_TYPES = ("image/", "audio/", "video/", "application/zip", "application/gzip")
+# Streams whose every chunk must reach the client as soon as it is written; other streams are sent as the compressor
+# fills its blocks
+FLUSHED_MEDIA_TYPES = ("text/event-stream",)
+
+
+def accepted_encoding(accept_encoding: str) -> Optional[str]:
+    """
+    The encoding we serve that Accept-Encoding prefers, by quality then our own preference; None for identity
+    """
+    qualities = {}
+    for part in accept_encoding.split(","):
+        coding, *params = part.split(";")
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip().lower()] = quality
+
+    wildcard = qualities.get("*", 0.0)
+    candidates = [(qualities.get(encoding, wildcard), -rank, encoding) for rank, encoding in enumerate(ENCODINGS)]
+    quality, _, encoding = max(candidates)
+    return encoding if quality > 0 else None
+
+
+class Compressor:
+    """
+    One response body, compressed as it is produced
+    """
+
+    def __init__(self, encoding: str, *, gzip_level: int, brotli_quality: int) -> None:
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=brotli_quality)
+            self._zlib = None
+        else:
+            self._brotli = None
+            self._zlib = zlib.compressobj(gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes, *, flush: bool = False) -> bytes:
+        if self._brotli is not None:
+            compressed = self._brotli.process(data)
+            return compressed + self._brotli.flush() if flush else compressed
+        compressed = self._zlib.compress(data)
+        return compressed + self._zlib.flush(zlib.Z_SYNC_FLUSH) if flush else compressed
+
+    def finish(self, data: bytes = b"") -> bytes:
+        if self._brotli is not None:
+            return self._brotli.process(data) + self._brotli.finish()
+        return self._zlib.compress(data) + self._zlib.flush()
+
+
+class CompressionMiddleware:
+    """
+    Compress response bodies with brotli or gzip, as the client's Accept-Encoding prefers. Whole bodies smaller than
+    `minimum_size` go out as they are. Streamed bodies are compressed as they are produced, never held back: the
+    size of a stream is not known up front, so they are always compressed, and event streams are flushed after every
+    chunk.
+
+    Responses that already carry a Content-Encoding, and media types that are compressed already, are left alone.
+    """
+
+    def __init__(self, app: ASGIApp, *, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        encoding = None
+        if scope["type"] == "http":
+            encoding = accepted_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None  # type: Optional[Message]
+        compressor = None  # type: Optional[Compressor]
+        flush = False
+        # Bodies are only looked at until the response is known to be compressed or not
+        deciding = True
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start, compressor, flush, deciding
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body, more_body = message.get("body", b""), message.get("more_body", False)
+            if deciding:
+                deciding = False
+                headers = MutableHeaders(scope=start)
+                media_type = headers.get("content-type", "")
+                if "content-encoding" not in headers and not media_type.startswith(INCOMPRESSIBLE_MEDIA_TYPES):
+                    headers.add_vary_header("Accept-Encoding")
+                    if more_body or len(body) >= self.minimum_size:
+                        compressor = Compressor(
+                            encoding, gzip_level=self.gzip_level, brotli_quality=self.brotli_quality
+                        )
+                        flush = media_type.startswith(FLUSHED_MEDIA_TYPES)
+                        headers["Content-Encoding"] = encoding
+                        if "content-length" in headers:
+                            del headers["content-length"]
+                        if not more_body:
+                            body = compressor.finish(body)
+                            headers["Content-Length"] = str(len(body))
+                            compressor = None
+                await send(start)
+
+            if compressor is None:
+                await send({**message, "body": body})
+                return
+
+            body = compressor.compress(body, flush=flush) if more_body else compressor.finish(body)
+            # The compressor keeps small chunks until it has a block to send
+            if body or not more_body:
+                await send({**message, "body": body})
+
+        await self.app(scope, receive, send_compressed)
@@ -1,31 +1,199 @@
-from databases import DatabaseURL
-from starlette.config import Config
-from starlette.datastructures import Secret
+"""
+Settings, read from the environment or a .env file. Each one is read and cast to its annotation on first use, so
+importing the application costs nothing and needs none of them set; a missing required setting fails where it is
+needed. Code reads them as module attributes (`config.DB_MAX_POOL_SIZE`), which tests can monkeypatch.
+"""
+from typing import Any, Callable, Optional
 
-config = Config(".env")
+from databases import DatabaseURL
+from starlette.config import Config, undefined
+from starlette.datastructures import CommaSeparatedStrings, Secret
 
 PROJECT_NAME = "phresh"
 VERSION = "1.0.0"
 API_PREFIX = "/api"
 
-SECRET_KEY = config("SECRET_KEY", cast=Secret, default="CHANGEME")
-
-POSTGRES_USER = config("POSTGRES_USER", cast=str)
-POSTGRES_PASSWORD = config("POSTGRES_PASSWORD", cast=Secret)
-POSTGRES_DOCKER_SERVER = config("POSTGRES_DOCKER_SERVER", cast=str)
-POSTGRES_PORT = config("POSTGRES_PORT", cast=str, default="5432")
-POSTGRES_DB = config("POSTGRES_DB", cast=str)
-
-DATABASE_URL = config(
-    "DATABASE_URL",
-    cast=DatabaseURL,
-    default=f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@"
-            f"{POSTGRES_DOCKER_SERVER}:{POSTGRES_PORT}/{POSTGRES_DB}"
-)
-
-DATABASE_URL_STR = config(
-    "DATABASE_URL",
-    cast=str,
-    default=f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@"
-            f"{POSTGRES_DOCKER_SERVER}:{POSTGRES_PORT}/{POSTGRES_DB}"
-)
+
+class Setting:
+    """
+    Descriptor of one setting of `Settings`, named after its attribute. `default_factory` computes the default from
+    the other settings, only when the variable is not set.
+    """
+
+    def __init__(self, default: Any = undefined, *, default_factory: Callable[["Settings"], Any] = None) -> None:
+        self.default = default
+        self.default_factory = default_factory
+        self.name = None  # type: Optional[str]
+
+    def __set_name__(self, owner: type, name: str) -> None:
+        self.name = name
+
+    def __get__(self, settings: Optional["Settings"], owner: type) -> Any:
+        if settings is None:
+            return self
+
+        default = self.default
+        if self.default_factory is not None and settings.environment(self.name, default=None) is None:
+            default = self.default_factory(settings)
+
+        value = settings.environment(self.name, cast=owner.__annotations__[self.name], default=default)
+        # Cached on the instance, which takes precedence over this (non-data) descriptor from now on
+        settings.__dict__[self.name] = value
+        return value
+
+
+def _database_url(settings: "Settings") -> str:
+    return (
+        f"postgresql://{settings.POSTGRES_USER}:{settings.POSTGRES_PASSWORD}@"
+        f"{settings.POSTGRES_DOCKER_SERVER}:{settings.POSTGRES_PORT}/{settings.POSTGRES_DB}"
+    )
+
+
+class Settings:
+    def __init__(self, env_file: str = ".env") -> None:
+        self.env_file = env_file
+        self._environment = None  # type: Optional[Config]
+
+    @property
+    def environment(self) -> Config:
+        if self._environment is None:
+            self._environment = Config(self.env_file)
+        return self._environment
+
+    SECRET_KEY: Secret = Setting("CHANGEME")
+
+    # Only needed when DATABASE_URL is not set
+    POSTGRES_USER: str = Setting()
+    POSTGRES_PASSWORD: Secret = Setting()
+    POSTGRES_DOCKER_SERVER: str = Setting()
+    POSTGRES_PORT: str = Setting("5432")
+    POSTGRES_DB: str = Setting()
+
+    DATABASE_URL: DatabaseURL = Setting(default_factory=_database_url)
+
+    CLEANINGS_PAGE_SIZE: int = Setting(100)
+    CLEANINGS_MAX_PAGE_SIZE: int = Setting(1000)
+    CLEANINGS_MAX_BATCH_SIZE: int = Setting(1000)
+
+    # Rows validated and COPYed per statement by bulk imports, and invalid rows tolerated before an import is rolled
+    # back
+    CLEANINGS_IMPORT_CHUNK_SIZE: int = Setting(10000)
+    CLEANINGS_IMPORT_MAX_ERRORS: int = Setting(100)
+
+    CACHE_ENABLED: bool = Setting(True)
+    CACHE_MAX_ENTRIES: int = Setting(10000)
+    CACHE_TTL_SECONDS: float = Setting(60.0)
+
+    # Concurrent identical reads of a worker share one query. With DB_BATCH_LOOKUPS, lookups of single cleanings that
+    # arrive within DB_BATCH_WINDOW_MS of each other are loaded by one query (0 gathers one event loop iteration)
+    DB_COALESCE_READS: bool = Setting(True)
+    DB_BATCH_LOOKUPS: bool = Setting(False)
+    DB_BATCH_WINDOW_MS: float = Setting(1.0)
+    DB_MAX_BATCH_SIZE: int = Setting(100)
+
+    # Cache-Control sent with cleanings responses; revalidating with ETags is cheap, so default to always revalidate
+    CLEANING_CACHE_CONTROL: str = Setting("private, no-cache")
+    CLEANINGS_LIST_CACHE_CONTROL: str = Setting("private, no-cache")
+
+    # Seconds the price distribution of /api/cleanings/stats may lag behind writes; counts and averages are always exact
+    CLEANINGS_STATS_REFRESH_SECONDS: float = Setting(10.0)
+
+    # Change feed of cleanings, /api/cleanings/changes (server-sent events) and /api/cleanings/changes/ws
+    # Changes buffered per subscriber; one that falls further behind reads the log on its own until it catches up
+    CLEANINGS_CHANGES_BUFFER_SIZE: int = Setting(1000)
+    CLEANINGS_CHANGES_PAGE_SIZE: int = Setting(500)
+    # Writes wake the feed through a notification; polling picks up changes held back by a concurrent transaction
+    CLEANINGS_CHANGES_POLL_INTERVAL: float = Setting(1.0)
+    CLEANINGS_CHANGES_HEARTBEAT_SECONDS: float = Setting(15.0)
+    # Cursors older than this cannot be resumed, their clients are told to refetch
+    CLEANINGS_CHANGES_RETENTION_SECONDS: float = Setting(86400.0)
+    CLEANINGS_CHANGES_PRUNE_INTERVAL: float = Setting(300.0)
+
+    # Build models from trusted rows without validation and encode responses with orjson
+    FAST_SERIALIZATION: bool = Setting(False)
+
+    # Compress responses with brotli or gzip for clients that accept it. Smaller bodies are not worth it, streamed
+    # ones are always compressed. Compression runs on the event loop: levels past the defaults cost much more CPU
+    # for a few percent fewer bytes
+    COMPRESSION_ENABLED: bool = Setting(True)
+    COMPRESSION_MINIMUM_SIZE: int = Setting(1024)
+    COMPRESSION_GZIP_LEVEL: int = Setting(6)
+    COMPRESSION_BROTLI_QUALITY: int = Setting(4)
+
+    DB_MIN_POOL_SIZE: int = Setting(2)
+    DB_MAX_POOL_SIZE: int = Setting(10)
+    # Seconds a request may wait for a free pooled connection before giving up with a 503
+    DB_POOL_ACQUIRE_TIMEOUT: float = Setting(5.0)
+    DB_STATEMENT_TIMEOUT_MS: int = Setting(30000)
+    # Connections are replaced after this many seconds, and closed after sitting idle for the inactive lifetime
+    DB_MAX_CONNECTION_LIFETIME: float = Setting(1800.0)
+    DB_MAX_INACTIVE_CONNECTION_LIFETIME: float = Setting(300.0)
+    # Prepared statements asyncpg keeps per pooled connection; 0 turns caching off (needed behind a transaction-mode
+    # pgbouncer)
+    DB_STATEMENT_CACHE_SIZE: int = Setting(100)
+    DB_CONNECT_RETRIES: int = Setting(5)
+    DB_CONNECT_RETRY_DELAY: float = Setting(0.5)
+
+    # Seconds a request may take before it is cancelled and answered with a 504; clients can ask for less with an
+    # X-Request-Timeout header. Queries still running at the deadline are cancelled. Uploads to /api/cleanings/import
+    # must fit too, larger files go through a job. 0 for no deadline but the clients' own
+    REQUEST_TIMEOUT_SECONDS: float = Setting(30.0)
+
+    # Admission control: how many requests a worker serves at once, by priority class, and how many more may wait for
+    # a slot, for how long, before being turned away with a 503. Size these at a small multiple of DB_MAX_POOL_SIZE;
+    # writes have slots of their own so that a burst of reads cannot starve them
+    ADMISSION_ENABLED: bool = Setting(True)
+    ADMISSION_READ_CONCURRENCY: int = Setting(20)
+    ADMISSION_READ_QUEUE_SIZE: int = Setting(100)
+    ADMISSION_WRITE_CONCURRENCY: int = Setting(10)
+    ADMISSION_WRITE_QUEUE_SIZE: int = Setting(50)
+    ADMISSION_QUEUE_TIMEOUT: float = Setting(2.0)
+    # Lower limits of some routes as route-name=limit, comma separated; their queue is as long as their limit
+    ADMISSION_ROUTE_LIMITS: CommaSeparatedStrings = Setting("cleanings:export-cleanings=2,cleanings:import-cleanings=2")
+    # Never limited: health checks, metrics, and the change feed whose streams hold no connection
+    ADMISSION_EXEMPT_ROUTES: CommaSeparatedStrings = Setting(
+        "health:live,health:ready,metrics,cleanings:get-cleaning-changes"
+    )
+
+    # Export Prometheus metrics on /metrics. Under several worker processes also set PROMETHEUS_MULTIPROC_DIR
+    METRICS_ENABLED: bool = Setting(True)
+
+    # Log statements slower than this, with their parameter types. 0 logs every statement, a negative value none
+    DB_SLOW_QUERY_MS: float = Setting(500.0)
+    # Also log the EXPLAIN (ANALYZE, BUFFERS) plan of slow statements. Runs them a second time, inside a rolled back
+    # transaction, so only turn this on while investigating
+    DB_EXPLAIN_SLOW_QUERIES: bool = Setting(False)
+
+    # Read replicas for read-only repository methods, comma separated; unset to read from the primary only
+    DATABASE_REPLICA_URLS: CommaSeparatedStrings = Setting("")
+    # round_robin, or least_loaded (fewest connections in use or waited for)
+    DB_REPLICA_SELECTION: str = Setting("round_robin")
+    DB_REPLICA_MAX_LAG_SECONDS: float = Setting(30.0)
+    DB_REPLICA_CHECK_INTERVAL: float = Setting(5.0)
+    # After a write, the same client reads from the primary for this many seconds
+    DB_READ_YOUR_WRITES_SECONDS: float = Setting(5.0)
+
+    # Background jobs, run by python -m app.jobs.worker
+    JOBS_WORKER_CONCURRENCY: int = Setting(4)
+    # Idle workers are woken by a notification when a job is queued, polling only catches retries coming due
+    JOBS_POLL_INTERVAL: float = Setting(1.0)
+    # A job still running after its lease is cancelled; if its worker died it is put back for another one
+    JOBS_LEASE_SECONDS: float = Setting(900.0)
+    JOBS_MAX_ATTEMPTS: int = Setting(5)
+    # Attempt n is retried after about JOBS_RETRY_DELAY * 2 ** (n - 1) seconds, never more than JOBS_MAX_RETRY_DELAY
+    JOBS_RETRY_DELAY: float = Setting(5.0)
+    JOBS_MAX_RETRY_DELAY: float = Setting(600.0)
+    # On SIGTERM running jobs get this long to finish before they are cancelled and handed back to the queue
+    JOBS_SHUTDOWN_TIMEOUT: float = Setting(30.0)
+    # Serve the worker's metrics on this port, 0 to not serve them
+    JOBS_METRICS_PORT: int = Setting(0)
+
+
+settings = Settings()
+SETTING_NAMES = frozenset(name for name in vars(Settings) if isinstance(vars(Settings)[name], Setting))
+
+
+def __getattr__(name: str) -> Any:
+    if name in SETTING_NAMES:
+        return getattr(settings, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,123 @@
+import math
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.requests import Request
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Until when (unix time) a client that just wrote must read from the primary
+READ_PRIMARY_COOKIE = "read_primary_until"
+SAFE_METHODS = frozenset(("GET", "HEAD", "OPTIONS"))
+# Seconds the client is willing to wait for an answer; it can only shorten the server's own timeout
+REQUEST_TIMEOUT_HEADER = "x-request-timeout"
+
+
+class DeadlineExceeded(Exception):
+    """
+    The request's deadline passed before it could be answered
+    """
+
+
+class RequestContext:
+    """
+    Per-request bookkeeping shared between the middleware and the repositories serving the request
+    """
+    __slots__ = ("query_count", "db_seconds", "read_primary", "deadline")
+
+    def __init__(self, *, read_primary: bool = False, deadline: float = None) -> None:
+        self.query_count = 0
+        self.db_seconds = 0.0
+        # Set when replicas must not serve this request: it writes, or its client wrote moments ago
+        self.read_primary = read_primary
+        # time.monotonic() by which the request must be answered, None when it may take as long as it takes
+        self.deadline = deadline
+
+    def record_query(self, seconds: float) -> None:
+        self.query_count += 1
+        self.db_seconds += seconds
+
+    def server_timing(self) -> str:
+        return f'db;dur={self.db_seconds * 1000:.1f};desc="{self.query_count} queries"'
+
+
+_request_context = ContextVar("request_context", default=None)  # type: ContextVar[Optional[RequestContext]]
+
+
+def get_request_context() -> Optional[RequestContext]:
+    return _request_context.get()
+
+
+class RequestContextMiddleware:
+    """
+    Open a RequestContext for every HTTP request, expose it as `request.state.context`, and report the database
+    totals in a Server-Timing header. Headers go out before a streamed body, so streamed responses only report
+    the queries made up to that point.
+
+    With `read_your_writes_seconds`, a successful write sets a cookie sending the client's reads to the primary
+    for that long, so replica lag cannot hide its own writes from it.
+
+    Requests get a deadline `timeout` seconds away, sooner when the client sends a shorter X-Request-Timeout.
+    Without a `timeout` only the clients asking for one get a deadline.
+    """
+
+    def __init__(self, app: ASGIApp, *, read_your_writes_seconds: float = None, timeout: float = None) -> None:
+        self.app = app
+        self.read_your_writes_seconds = read_your_writes_seconds
+        self.timeout = timeout
+
+    def _deadline(self, scope: Scope) -> Optional[float]:
+        timeout = self.timeout
+        requested = Headers(scope=scope).get(REQUEST_TIMEOUT_HEADER)
+        if requested is not None:
+            try:
+                requested_timeout = float(requested)
+            except ValueError:
+                requested_timeout = None
+            # Not a number, or not a positive one, counts as not sent
+            if requested_timeout is not None and 0 < requested_timeout < (timeout or math.inf):
+                timeout = requested_timeout
+        return time.monotonic() + timeout if timeout else None
+
+    def _wrote_recently(self, scope: Scope) -> bool:
+        try:
+            until = float(Request(scope).cookies.get(READ_PRIMARY_COOKIE, 0))
+        except ValueError:
+            return False
+        # Values further out than one window were not set by us
+        now = time.time()
+        return now < until <= now + self.read_your_writes_seconds
+
+    def _read_primary_cookie(self) -> str:
+        until = time.time() + self.read_your_writes_seconds
+        return (
+            f"{READ_PRIMARY_COOKIE}={until:.3f}; Max-Age={int(self.read_your_writes_seconds) or 1}; Path=/; "
+            f"HttpOnly; SameSite=Lax"
+        )
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        writes = scope["method"] not in SAFE_METHODS
+        track_writes = self.read_your_writes_seconds is not None
+        context = RequestContext(
+            read_primary=writes or (track_writes and self._wrote_recently(scope)), deadline=self._deadline(scope),
+        )
+        scope.setdefault("state", {})["context"] = context
+        token = _request_context.set(context)
+
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", context.server_timing())
+                if writes and track_writes and message["status"] < 400:
+                    headers.append("Set-Cookie", self._read_primary_cookie())
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_context.reset(token)
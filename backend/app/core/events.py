@@ -1,18 +1,43 @@
 from typing import Callable
 from fastapi import FastAPI
 
-from app.db.events import connect_to_db, close_db_connection
+from app.core import config
+from app.db.cache import create_cache
+from app.db.coalescing import create_coalescer
+from app.db.events import (
+    connect_to_db, close_db_connection, connect_to_replicas, close_replica_connections, start_notification_listener,
+    stop_notification_listener, start_stats_refresher, stop_stats_refresher, start_change_feed, stop_change_feed,
+)
 
 
 def create_start_app_handler(app: FastAPI) -> Callable:
     async def start_app() -> None:
         await connect_to_db(app)
+        await connect_to_replicas(app)
+
+        app.state.cache = create_cache(
+            enabled=config.CACHE_ENABLED, max_entries=config.CACHE_MAX_ENTRIES, ttl=config.CACHE_TTL_SECONDS
+        )
+        app.state.coalescer = create_coalescer(
+            enabled=config.DB_COALESCE_READS,
+            batching=config.DB_BATCH_LOOKUPS,
+            batch_window=config.DB_BATCH_WINDOW_MS / 1000,
+            max_batch_size=config.DB_MAX_BATCH_SIZE,
+        )
+        # Started first so that the listener wakes it
+        await start_change_feed(app)
+        await start_notification_listener(app)
+        await start_stats_refresher(app)
 
     return start_app
 
 
 def create_stop_app_handler(app: FastAPI) -> Callable:
     async def stop_app() -> None:
+        await stop_stats_refresher(app)
+        await stop_notification_listener(app)
+        await stop_change_feed(app)
+        await close_replica_connections(app)
         await close_db_connection(app)
 
     return stop_app
@@ -0,0 +1,193 @@
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram
+from prometheus_client import generate_latest
+from prometheus_client.multiprocess import MultiProcessCollector
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Label used for requests that did not match any route (404s, and anything rejected before routing)
+UNMATCHED_ROUTE = "<unmatched>"
+
+DB_QUERY_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+JOB_DURATION_BUCKETS = (0.05, 0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0)
+
+HTTP_REQUESTS = Counter(
+    "http_requests_total", "HTTP requests by route name, method and status code", ["route", "method", "status"],
+)
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Time spent serving HTTP requests, streamed bodies included", ["route", "method"],
+)
+HTTP_REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress", "HTTP requests currently being served", ["method"], multiprocess_mode="livesum",
+)
+HTTP_REQUESTS_CANCELLED = Counter(
+    "http_requests_cancelled_total", "Requests whose handling was cancelled, because the client left or the deadline "
+    "passed", ["reason"],
+)
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds",
+    "Time spent in database queries by repository method",
+    ["repository", "method"],
+    buckets=DB_QUERY_LATENCY_BUCKETS,
+)
+DB_STATEMENT_CACHE_HITS = Counter(
+    "db_statement_cache_hits_total", "Queries run through an already prepared statement",
+)
+DB_STATEMENT_CACHE_MISSES = Counter(
+    "db_statement_cache_misses_total", "Queries that had to prepare their statement on the connection first",
+)
+# Reads over queries is the coalescing ratio: how many reads each query answered
+DB_COALESCING_READS = Counter(
+    "db_coalescing_reads_total", "Reads that could share a query with concurrent ones, by coalescing mode", ["mode"],
+)
+DB_COALESCING_QUERIES = Counter(
+    "db_coalescing_queries_total", "Queries run on behalf of coalesced reads, by coalescing mode", ["mode"],
+)
+CHANGE_FEED_SUBSCRIBERS = Gauge(
+    "change_feed_subscribers", "Clients subscribed to the change feed of cleanings", multiprocess_mode="livesum",
+)
+CHANGE_FEED_EVENTS = Counter(
+    "change_feed_events_total", "Changes of cleanings sent to change feed subscribers",
+)
+# Subscribers that filled their buffer; they read the log on their own until they catch up with the feed
+CHANGE_FEED_LAGGED = Counter(
+    "change_feed_lagged_subscribers_total", "Times a change feed subscriber fell too far behind to be pushed changes",
+)
+# Outcomes are admitted, shed_queue_full and shed_queue_timeout
+ADMISSION_REQUESTS = Counter(
+    "admission_requests_total", "Requests through admission control by priority class and outcome",
+    ["priority", "outcome"],
+)
+ADMISSION_QUEUED = Counter(
+    "admission_queued_total", "Requests that waited for a slot before being admitted, by priority class", ["priority"],
+)
+ADMISSION_QUEUE_WAIT = Histogram(
+    "admission_queue_wait_seconds", "Time admitted requests waited for a slot, by priority class", ["priority"],
+    buckets=DB_QUERY_LATENCY_BUCKETS,
+)
+JOB_DURATION = Histogram(
+    "job_duration_seconds", "Time spent running background jobs by kind and outcome", ["kind", "outcome"],
+    buckets=JOB_DURATION_BUCKETS,
+)
+JOB_QUEUE_WAIT = Histogram(
+    "job_queue_wait_seconds", "Time runnable background jobs waited for a worker", ["kind"],
+    buckets=JOB_DURATION_BUCKETS,
+)
+JOBS_IN_PROGRESS = Gauge(
+    "jobs_in_progress", "Background jobs currently running", ["kind"], multiprocess_mode="livesum",
+)
+
+# Metric children are cached per label set, `labels()` takes a lock and builds the key on every call
+_db_query_children = {}  # type: Dict[Tuple[str, str], Histogram]
+
+
+def multiprocess_dir() -> Optional[str]:
+    """
+    Directory shared by all worker processes, set when running under a multi-process server
+    """
+    return os.environ.get("PROMETHEUS_MULTIPROC_DIR") or os.environ.get("prometheus_multiproc_dir")
+
+
+def metrics_registry() -> CollectorRegistry:
+    """
+    Registry of the current process, or one aggregating every worker when running multi-process
+    """
+    if multiprocess_dir():
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+        return registry
+
+    return REGISTRY
+
+
+def render_metrics() -> bytes:
+    return generate_latest(metrics_registry())
+
+
+def observe_db_query(repository: str, method: str, seconds: float) -> None:
+    child = _db_query_children.get((repository, method))
+    if child is None:
+        child = _db_query_children[(repository, method)] = DB_QUERY_DURATION.labels(repository, method)
+    child.observe(seconds)
+
+
+class MetricsMiddleware:
+    """
+    Count and time every HTTP request, labelled by route name rather than raw path so that path parameters do
+    not blow up the number of series. Written as a plain ASGI middleware: BaseHTTPMiddleware would buffer
+    streamed responses through an extra task and queue.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+        self._route_names = None  # type: Optional[Dict[Tuple[object, str], str]]
+        self._children = {}  # type: Dict[Tuple[str, str, str], Tuple[Counter, Histogram]]
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        in_progress = HTTP_REQUESTS_IN_PROGRESS.labels(method)
+        in_progress.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            in_progress.dec()
+            self._observe(self._route_name(scope), method, status_code, time.perf_counter() - started)
+
+    def _observe(self, route: str, method: str, status_code: int, seconds: float) -> None:
+        key = (route, method, str(status_code))
+        children = self._children.get(key)
+        if children is None:
+            children = self._children[key] = (
+                HTTP_REQUESTS.labels(route, method, key[2]),
+                HTTP_REQUEST_DURATION.labels(route, method),
+            )
+        children[0].inc()
+        children[1].observe(seconds)
+
+    def _route_name(self, scope: Scope) -> str:
+        """
+        The router leaves the matched endpoint in the scope; map it back to the route's name. The method is part
+        of the key because one endpoint can serve several named routes (PUT and PATCH of a cleaning).
+        """
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return UNMATCHED_ROUTE
+
+        if self._route_names is None:
+            self._route_names = self._build_route_names(scope["app"])
+
+        return (
+            self._route_names.get((endpoint, scope["method"]))
+            or self._route_names.get((endpoint, ""))
+            or UNMATCHED_ROUTE
+        )
+
+    @staticmethod
+    def _build_route_names(app: ASGIApp) -> Dict[Tuple[object, str], str]:
+        names = {}  # type: Dict[Tuple[object, str], str]
+        for route in getattr(app, "routes", []):
+            endpoint = getattr(route, "endpoint", None)
+            if endpoint is None:
+                continue
+            for method in getattr(route, "methods", None) or ():
+                names[(endpoint, method)] = route.name
+            # Fallback for methods the route does not allow (405s)
+            names.setdefault((endpoint, ""), route.name)
+
+        return names
+
@@ -0,0 +1,339 @@
+"""
+Bulk import and export of cleanings as CSV or NDJSON through Postgres COPY. Uploads and downloads are streamed:
+rows are parsed as their lines arrive, validated and COPYed in chunks, and exports are encoded by Postgres. The
+API serves this at /api/cleanings/import and /api/cleanings/export; for files at hand there is a CLI:
+
+    python -m app.db.bulk import cleanings.csv
+    python -m app.db.bulk export cleanings.ndjson
+
+The format follows the file extension unless --format is given, and "-" reads stdin or writes stdout.
+"""
+import argparse
+import asyncio
+import codecs
+import csv
+import io
+import sys
+import time
+from typing import AsyncIterable, AsyncIterator, List, Optional, Tuple, Union
+
+import asyncpg
+import orjson
+from loguru import logger
+from pydantic import ValidationError
+
+from app.core import config
+from app.db.events import connect_database
+from app.db.repositories.cleanings import COPY_CLEANING_COLUMNS, CleaningsRepository
+from app.models.cleaning import CleaningCreate, CleaningFilter, CleaningImportError, CleaningImportResult
+from app.models.enum_type import BulkFormat, CleaningSort
+
+MEDIA_TYPES = {
+    BulkFormat.csv: "text/csv",
+    BulkFormat.ndjson: "application/x-ndjson",
+}
+
+# A line is held in memory until it is complete, so refuse to wait forever for the end of one
+MAX_LINE_LENGTH = 1024 * 1024
+
+FILE_CHUNK_SIZE = 1024 * 1024
+YIELD_EVERY_ROWS = 1000
+
+# Columns of an export that the database assigns, skipped on import so exports can be imported again
+IGNORED_COLUMNS = ("id", "version", "updated_at")
+
+# A row is either its fields by column name, or why it could not be read
+Row = Tuple[int, Union[dict, ValueError]]
+
+
+class BulkImportError(Exception):
+    """
+    The input as a whole cannot be imported, nothing was
+    """
+
+    def __init__(self, message: str, errors: List[CleaningImportError] = None) -> None:
+        super().__init__(message)
+        self.message = message
+        self.errors = errors or []
+
+    def detail(self) -> dict:
+        return {"message": self.message, "errors": [error.dict() for error in self.errors]}
+
+
+def format_of_media_type(content_type: Optional[str]) -> Optional[BulkFormat]:
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    for bulk_format, format_media_type in MEDIA_TYPES.items():
+        if media_type == format_media_type:
+            return bulk_format
+    return None
+
+
+async def _read_text(chunks: AsyncIterable[bytes]) -> AsyncIterator[str]:
+    """
+    Decode the input, cut after the last complete line of each chunk. A leading byte order mark is dropped.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    async for chunk in chunks:
+        text = pending + decoder.decode(chunk)
+        end = text.rfind("\n") + 1
+        text, pending = text[:end], text[end:]
+        if len(pending) > MAX_LINE_LENGTH:
+            raise BulkImportError(f"Lines are limited to {MAX_LINE_LENGTH} characters.")
+        if text:
+            yield text
+
+    text = pending + decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def _balanced_end(text: str) -> int:
+    """
+    Length of the longest run of whole lines of `text` that leaves no quoted field open. RFC 4180 doubles quotes
+    within fields, so a field is open exactly when an odd number of quotes came before.
+    """
+    if text.count('"') % 2 == 0:
+        return len(text)
+
+    end = position = quotes = 0
+    while True:
+        newline = text.find("\n", position)
+        if newline == -1:
+            return end
+        quotes += text.count('"', position, newline)
+        position = newline + 1
+        if quotes % 2 == 0:
+            end = position
+
+
+def _read_header(fields: List[str]) -> List[str]:
+    header = [field.strip() for field in fields]
+    unknown = [column for column in header if column not in COPY_CLEANING_COLUMNS + IGNORED_COLUMNS]
+    if unknown:
+        raise BulkImportError(
+            f"Unknown CSV columns {unknown}, expected a header naming some of {list(COPY_CLEANING_COLUMNS)}."
+        )
+    return header
+
+
+async def _read_csv(chunks: AsyncIterable[bytes]) -> AsyncIterator[Row]:
+    header, pending, number = None, "", 0
+    async for text in _read_text(chunks):
+        # A quoted field may span lines, so records are only parsed once their quotes are balanced
+        text = pending + text
+        end = _balanced_end(text)
+        text, pending = text[:end], text[end:]
+        if len(pending) > MAX_LINE_LENGTH:
+            raise BulkImportError(f"Rows are limited to {MAX_LINE_LENGTH} characters.")
+
+        try:
+            records = list(csv.reader(io.StringIO(text)))
+        except csv.Error as e:
+            raise BulkImportError(f"Invalid CSV after row {number}: {e}")
+
+        for fields in records:
+            if not fields:
+                continue
+            if header is None:
+                header = _read_header(fields)
+                continue
+
+            number += 1
+            if len(fields) != len(header):
+                yield number, ValueError(f"expected {len(header)} fields, got {len(fields)}")
+                continue
+            # CSV has no null, an empty field is a missing value
+            yield number, {
+                column: value for column, value in zip(header, fields)
+                if value != "" and column not in IGNORED_COLUMNS
+            }
+
+    if pending:
+        raise BulkImportError(f"Unterminated quoted field after row {number}.")
+
+
+async def _read_ndjson(chunks: AsyncIterable[bytes]) -> AsyncIterator[Row]:
+    number = 0
+    async for text in _read_text(chunks):
+        # Not splitlines(): JSON strings may hold other line separators
+        for line in text.split("\n"):
+            if not line.strip():
+                continue
+
+            number += 1
+            try:
+                yield number, orjson.loads(line)
+            except orjson.JSONDecodeError as e:
+                yield number, e
+
+
+def read_rows(chunks: AsyncIterable[bytes], bulk_format: BulkFormat) -> AsyncIterator[Row]:
+    """
+    Numbered rows of a CSV (with a header) or NDJSON input, read as its chunks arrive
+    """
+    return _read_csv(chunks) if bulk_format == BulkFormat.csv else _read_ndjson(chunks)
+
+
+def _validate_row(values: Union[dict, ValueError]) -> Tuple[Optional[CleaningCreate], Optional[list]]:
+    if isinstance(values, ValueError):
+        return None, [{"loc": ["__root__"], "msg": str(values), "type": "value_error.unreadable"}]
+    try:
+        return CleaningCreate.parse_obj(values), None
+    except ValidationError as e:
+        return None, e.errors()
+
+
+async def import_cleanings(
+        cleanings_repo: CleaningsRepository,
+        chunks: AsyncIterable[bytes],
+        bulk_format: BulkFormat,
+        *,
+        chunk_size: int,
+        max_errors: int,
+) -> CleaningImportResult:
+    """
+    Import every valid row and report the invalid ones. More than `max_errors` invalid rows, or an input that
+    cannot be read at all, rolls the whole import back and raises BulkImportError.
+    """
+    started = time.perf_counter()
+    rows, errors = 0, []  # type: int, List[CleaningImportError]
+
+    async def validated_chunks() -> AsyncIterator[List[CleaningCreate]]:
+        nonlocal rows
+        chunk = []
+        async for number, values in read_rows(chunks, bulk_format):
+            rows += 1
+            if rows % YIELD_EVERY_ROWS == 0:
+                # Let the COPY of the previous chunk send its rows meanwhile, reading a file never yields
+                await asyncio.sleep(0)
+            cleaning, row_errors = _validate_row(values)
+            if cleaning is not None:
+                chunk.append(cleaning)
+            else:
+                errors.append(CleaningImportError(row=number, errors=row_errors))
+                if len(errors) > max_errors:
+                    raise BulkImportError(
+                        f"More than {max_errors} invalid rows, nothing was imported.", errors[:max_errors]
+                    )
+
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+
+        if chunk:
+            yield chunk
+
+    try:
+        imported = await cleanings_repo.copy_cleanings_in(chunks=validated_chunks())
+    except asyncpg.DataError as e:
+        raise BulkImportError(f"Rows rejected by the database, nothing was imported: {e}")
+
+    seconds = time.perf_counter() - started
+    result = CleaningImportResult(
+        rows=rows,
+        imported=imported,
+        invalid=len(errors),
+        errors=errors,
+        seconds=round(seconds, 3),
+        rows_per_second=round(rows / seconds if seconds else 0.0, 1),
+    )
+    logger.info(f"imported {imported} of {rows} cleanings in {seconds:.2f}s ({result.rows_per_second:.0f} rows/s)")
+    return result
+
+
+def export_cleanings(
+        cleanings_repo: CleaningsRepository,
+        bulk_format: BulkFormat,
+        *,
+        filters: CleaningFilter = None,
+        sort: CleaningSort = CleaningSort.id,
+) -> AsyncIterator[bytes]:
+    """
+    The matching cleanings as chunks of CSV or NDJSON. Invalid arguments raise here rather than once a streamed
+    response has already started.
+    """
+    copy = cleanings_repo.copy_cleanings_out(format=bulk_format, filters=filters, sort=sort)
+
+    async def _export() -> AsyncIterator[bytes]:
+        started = time.perf_counter()
+        async for chunk in copy:
+            yield chunk
+
+        seconds = time.perf_counter() - started
+        logger.info(
+            f"exported {copy.rows} cleanings in {seconds:.2f}s ({copy.rows / seconds if seconds else 0:.0f} rows/s)"
+        )
+
+    return _export()
+
+
+async def _read_file(path: str) -> AsyncIterator[bytes]:
+    # Nothing else runs in the CLI meanwhile, blocking reads are fine
+    file = sys.stdin.buffer if path == "-" else open(path, "rb")
+    try:
+        while True:
+            chunk = file.read(FILE_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        if file is not sys.stdin.buffer:
+            file.close()
+
+
+def _format_of_path(path: str, bulk_format: Optional[str]) -> BulkFormat:
+    if bulk_format is not None:
+        return BulkFormat(bulk_format)
+    for candidate in BulkFormat:
+        if path.endswith(f".{candidate.value}"):
+            return candidate
+    raise SystemExit(f"Cannot tell the format of {path}, pass --format")
+
+
+def _parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m app.db.bulk", description="Bulk import and export cleanings.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    import_command = commands.add_parser("import", help="import cleanings from a CSV or NDJSON file")
+    import_command.add_argument("path", help='file to read, "-" for stdin')
+    export_command = commands.add_parser("export", help="export cleanings to a CSV or NDJSON file")
+    export_command.add_argument("path", help='file to write, "-" for stdout')
+
+    for command in (import_command, export_command):
+        command.add_argument("--format", choices=[bulk_format.value for bulk_format in BulkFormat])
+
+    return parser
+
+
+async def main(argv: List[str] = None) -> None:
+    args = _parser().parse_args(argv)
+    bulk_format = _format_of_path(args.path, args.format)
+
+    database = await connect_database(str(config.DATABASE_URL))
+    cleanings_repo = CleaningsRepository(database)
+    try:
+        if args.command == "import":
+            try:
+                result = await import_cleanings(
+                    cleanings_repo, _read_file(args.path), bulk_format,
+                    chunk_size=config.CLEANINGS_IMPORT_CHUNK_SIZE, max_errors=config.CLEANINGS_IMPORT_MAX_ERRORS,
+                )
+            except BulkImportError as e:
+                raise SystemExit(orjson.dumps(e.detail()).decode())
+            print(result.json())
+            return
+
+        output = sys.stdout.buffer if args.path == "-" else open(args.path, "wb")
+        try:
+            async for chunk in export_cleanings(cleanings_repo, bulk_format):
+                output.write(chunk)
+        finally:
+            if output is not sys.stdout.buffer:
+                output.close()
+    finally:
+        await database.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
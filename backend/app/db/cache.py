@@ -0,0 +1,138 @@
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+MISSING = object()
+
+
+class CacheBackend(ABC):
+    """
+    Interface of the read-through cache in front of repositories. Every method is a coroutine so that a shared
+    backend (redis, memcached, ...) can implement it without changing callers.
+
+    Entries live in namespaces. Each namespace has a generation that moves forward whenever anything in it is
+    deleted or invalidated, which lets `get_or_load` drop a value loaded while an invalidation happened.
+    """
+
+    @abstractmethod
+    async def get(self, namespace: str, key: Hashable) -> Any:
+        """Return the cached value or MISSING"""
+
+    @abstractmethod
+    async def set(self, namespace: str, key: Hashable, value: Any, *, generation: int = None) -> None:
+        """Store a value, unless `generation` is given and the namespace has been invalidated since"""
+
+    @abstractmethod
+    async def delete(self, namespace: str, key: Hashable) -> None:
+        pass
+
+    @abstractmethod
+    async def invalidate_namespace(self, namespace: str) -> None:
+        pass
+
+    @abstractmethod
+    async def generation(self, namespace: str) -> int:
+        pass
+
+    @abstractmethod
+    async def clear(self) -> None:
+        pass
+
+    @abstractmethod
+    def stats(self) -> Dict[str, int]:
+        pass
+
+    async def get_or_load(self, namespace: str, key: Hashable, load: Callable[[], Awaitable[Any]]) -> Any:
+        value = await self.get(namespace, key)
+        if value is not MISSING:
+            return value
+
+        generation = await self.generation(namespace)
+        value = await load()
+
+        if value is not None:
+            await self.set(namespace, key, value, generation=generation)
+
+        return value
+
+
+class InMemoryCache(CacheBackend):
+    """
+    Per-process LRU cache with a time to live. Size is bounded by `max_entries` across all namespaces.
+    """
+
+    def __init__(self, *, max_entries: int, ttl: float, clock: Callable[[], float] = time.monotonic) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()  # type: OrderedDict[Tuple[str, int, Hashable], Tuple[float, Any]]
+        # Prefix of the namespace's entry keys, only bumped when the whole namespace is dropped
+        self._key_prefixes = {}  # type: Dict[str, int]
+        self._generations = {}  # type: Dict[str, int]
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    def _key(self, namespace: str, key: Hashable) -> Tuple[str, int, Hashable]:
+        # Bumping a namespace's prefix orphans all of its entries at once; LRU order cleans them up
+        return namespace, self._key_prefixes.get(namespace, 0), key
+
+    async def get(self, namespace: str, key: Hashable) -> Any:
+        entry_key = self._key(namespace, key)
+        entry = self._entries.get(entry_key)
+
+        if entry is None:
+            self._stats["misses"] += 1
+            return MISSING
+
+        expires_at, value = entry
+        if expires_at <= self._clock():
+            del self._entries[entry_key]
+            self._stats["expirations"] += 1
+            self._stats["misses"] += 1
+            return MISSING
+
+        self._entries.move_to_end(entry_key)
+        self._stats["hits"] += 1
+        return value
+
+    async def set(self, namespace: str, key: Hashable, value: Any, *, generation: int = None) -> None:
+        if generation is not None and generation != self._generations.get(namespace, 0):
+            return
+
+        entry_key = self._key(namespace, key)
+        self._entries[entry_key] = (self._clock() + self.ttl, value)
+        self._entries.move_to_end(entry_key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    async def delete(self, namespace: str, key: Hashable) -> None:
+        self._entries.pop(self._key(namespace, key), None)
+        # Loads already in flight for this namespace may hold the old row, so make them skip their `set`
+        self._generations[namespace] = self._generations.get(namespace, 0) + 1
+        self._stats["invalidations"] += 1
+
+    async def invalidate_namespace(self, namespace: str) -> None:
+        self._key_prefixes[namespace] = self._key_prefixes.get(namespace, 0) + 1
+        self._generations[namespace] = self._generations.get(namespace, 0) + 1
+        self._stats["invalidations"] += 1
+
+    async def generation(self, namespace: str) -> int:
+        return self._generations.get(namespace, 0)
+
+    async def clear(self) -> None:
+        self._entries.clear()
+        for namespace in self._generations:
+            self._generations[namespace] += 1
+        self._stats["invalidations"] += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {**self._stats, "entries": len(self._entries), "max_entries": self.max_entries}
+
+
+def create_cache(*, enabled: bool, max_entries: int, ttl: float) -> Optional[CacheBackend]:
+    if not enabled:
+        return None
+
+    return InMemoryCache(max_entries=max_entries, ttl=ttl)
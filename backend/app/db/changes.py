@@ -0,0 +1,234 @@
+import asyncio
+from collections import deque
+from typing import Deque, Dict, List, NamedTuple, Optional, Set
+
+from databases import Database
+from loguru import logger
+
+from app.core.metrics import CHANGE_FEED_LAGGED, CHANGE_FEED_SUBSCRIBERS
+from app.db.repositories.cleanings import ChangePosition, CleaningsRepository, encode_change_cursor
+
+
+class ChangeEvent(NamedTuple):
+    position: ChangePosition
+    op: str
+    # The change as JSON, encoded once however many subscribers it goes to
+    data: str
+
+    @property
+    def cursor(self) -> str:
+        return encode_change_cursor(self.position)
+
+
+class ChangeSubscription:
+    """
+    A subscriber's place in the feed. While it keeps up, the feed pushes changes into its buffer. Once the buffer
+    is full it is dropped from the fan-out and reads the log from its own position, a page at a time as its client
+    takes them, until it has caught up. A slow client never holds up the others nor grows the worker's memory.
+    """
+
+    def __init__(self, feed: "ChangeFeed", position: ChangePosition, *, expired: bool = False) -> None:
+        self.feed = feed
+        # Position of the last change buffered or sent
+        self.position = position
+        # The cursor asked for was pruned from the log: the client must refetch, changes start from now on
+        self.expired = expired
+        self.closed = False
+        self._buffer = deque()  # type: Deque[ChangeEvent]
+        self._ready = asyncio.Event()
+
+    def push(self, events: List[ChangeEvent]) -> bool:
+        """
+        Buffer changes published by the feed, False when they do not fit
+        """
+        events = [event for event in events if event.position > self.position]
+        if len(self._buffer) + len(events) > self.feed.buffer_size:
+            return False
+
+        self.extend(events)
+        return True
+
+    def extend(self, events: List[ChangeEvent]) -> None:
+        if events:
+            self._buffer.extend(events)
+            self.position = events[-1].position
+            self._ready.set()
+
+    async def next_events(self, timeout: float) -> List[ChangeEvent]:
+        """
+        Every change buffered, waiting up to `timeout` seconds for one; empty on timeout or once closed
+        """
+        if not self._buffer and not self.closed and not self.feed.is_live(self):
+            await self.feed.catch_up(self)
+
+        if not self._buffer and not self.closed:
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        events = list(self._buffer)
+        self._buffer.clear()
+        return events
+
+    def close(self) -> None:
+        self.closed = True
+        self._ready.set()
+        self.feed.unsubscribe(self)
+
+
+class ChangeFeed:
+    """
+    Fans the change log of cleanings out to the subscribers of one worker. A single reader follows the log while
+    anyone is subscribed, woken by the cleaning_changes notification (`wake`) and every `poll_interval` seconds
+    (a change is only readable once the transactions that started before it have finished, which may not come with
+    a notification). The database sees one query per write and worker, however many clients listen.
+
+    Changes older than `retention_seconds` are pruned every `prune_interval` seconds; every worker prunes, which is
+    harmless.
+    """
+
+    def __init__(
+            self,
+            database: Database,
+            *,
+            buffer_size: int = 1000,
+            page_size: int = 500,
+            poll_interval: float = 1.0,
+            retention_seconds: float = 86400.0,
+            prune_interval: float = 300.0,
+    ) -> None:
+        self.repository = CleaningsRepository(database)
+        self.buffer_size = buffer_size
+        self.page_size = page_size
+        self.poll_interval = poll_interval
+        self.retention_seconds = retention_seconds
+        self.prune_interval = prune_interval
+        # Position of the last change published; stale while nobody is live
+        self.position = (0, 0)  # type: ChangePosition
+
+        self._subscriptions = set()  # type: Set[ChangeSubscription]
+        self._live = set()  # type: Set[ChangeSubscription]
+        self._reading = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None  # type: Optional[asyncio.Future]
+
+    async def start(self) -> None:
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+        for subscription in list(self._subscriptions):
+            subscription.close()
+
+    async def wake(self, payload: Optional[str] = None) -> None:
+        self._wakeup.set()
+
+    def is_live(self, subscription: ChangeSubscription) -> bool:
+        return subscription in self._live
+
+    async def subscribe(self, *, after: Optional[ChangePosition] = None) -> ChangeSubscription:
+        """
+        Changes after the `after` position, or from now on without one. A position the log was pruned past starts
+        from now on too, with `expired` set.
+        """
+        expired = after is not None and not await self.repository.is_change_retained(position=after)
+
+        if after is not None and not expired:
+            # Caught up by reading the log, then live
+            subscription = ChangeSubscription(self, after)
+        else:
+            async with self._reading:
+                if not self._live:
+                    # Nobody followed the log meanwhile
+                    self.position = await self.repository.get_change_head()
+                subscription = ChangeSubscription(self, self.position, expired=expired)
+                self._live.add(subscription)
+
+        self._subscriptions.add(subscription)
+        CHANGE_FEED_SUBSCRIBERS.inc()
+        return subscription
+
+    def unsubscribe(self, subscription: ChangeSubscription) -> None:
+        self._live.discard(subscription)
+        if subscription in self._subscriptions:
+            self._subscriptions.remove(subscription)
+            CHANGE_FEED_SUBSCRIBERS.dec()
+
+    async def catch_up(self, subscription: ChangeSubscription) -> None:
+        """
+        Buffer the next page of the log for a subscriber that is not live, and make it live once it has read as
+        far as the feed
+        """
+        events = self._to_events(
+            await self.repository.get_changes(after=subscription.position, limit=self.page_size)
+        )
+        subscription.extend(events)
+
+        if subscription.closed or len(events) == self.page_size:
+            return
+        if not self._live:
+            self.position = max(self.position, subscription.position)
+        # Changes the feed publishes that the subscriber already read are skipped by `push`
+        if subscription.position >= self.position:
+            self._live.add(subscription)
+
+    async def poll(self) -> None:
+        async with self._reading:
+            while self._live:
+                events = self._to_events(
+                    await self.repository.get_changes(after=self.position, limit=self.page_size)
+                )
+                if not events:
+                    return
+
+                self.position = events[-1].position
+                self._publish(events)
+                if len(events) < self.page_size:
+                    return
+
+    @staticmethod
+    def _to_events(changes: list) -> List[ChangeEvent]:
+        return [ChangeEvent(position, change.op, change.json()) for position, change in changes]
+
+    def _publish(self, events: List[ChangeEvent]) -> None:
+        for subscription in list(self._live):
+            if not subscription.push(events):
+                self._live.discard(subscription)
+                CHANGE_FEED_LAGGED.inc()
+
+    async def _run(self) -> None:
+        loop = asyncio.get_event_loop()
+        pruned_at = None  # type: Optional[float]
+
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                await self.poll()
+            except Exception as e:
+                logger.warning(f"Change feed cannot read the log of cleaning changes: {e!r}")
+
+            if pruned_at is None or loop.time() - pruned_at >= self.prune_interval:
+                pruned_at = loop.time()
+                try:
+                    pruned = await self.repository.prune_changes(retention_seconds=self.retention_seconds)
+                    if pruned:
+                        logger.info(f"pruned {pruned} cleaning changes older than {self.retention_seconds:.0f}s")
+                except Exception as e:
+                    logger.warning(f"Change feed cannot prune the log of cleaning changes: {e!r}")
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "subscribers": len(self._subscriptions),
+            "live": len(self._live),
+            "cursor": encode_change_cursor(self.position),
+        }
@@ -0,0 +1,145 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from app.core.metrics import DB_COALESCING_QUERIES, DB_COALESCING_READS
+
+SINGLE_FLIGHT = "single_flight"
+BATCH = "batch"
+
+
+def _retrieve_exception(future: asyncio.Future) -> None:
+    # Every caller may have gone away; do not let asyncio log the failure as never retrieved
+    if not future.cancelled():
+        future.exception()
+
+
+class _Batch:
+    def __init__(self, load_many: Callable[[List[Hashable]], Awaitable[Dict[Hashable, Any]]]) -> None:
+        self.load_many = load_many
+        self.keys = {}  # type: Dict[Hashable, None]
+        self.future = asyncio.get_event_loop().create_future()
+        self.future.add_done_callback(_retrieve_exception)
+        self.timer = None  # type: Optional[asyncio.Handle]
+
+
+class ReadCoalescer:
+    """
+    Shares reads between the concurrent requests of a worker.
+
+    Single flight: a read issued while an identical one (same query, same parameters, same database) is in flight
+    waits for that one's result instead of running again.
+
+    Batching: point lookups arriving within `batch_window` seconds of the first one are loaded together, by one
+    `load_many(keys)` returning the values found by key (DataLoader style). A window of 0 gathers the lookups of
+    one event loop iteration; a batch is sent early once it holds `max_batch_size` keys.
+
+    Shared calls run in a task of their own, so a caller that is cancelled does not cancel them for the others. A
+    flight whose every caller was cancelled (they disconnected, or ran out of time) is cancelled too.
+    """
+
+    def __init__(self, *, batching: bool = False, batch_window: float = 0.001, max_batch_size: int = 100) -> None:
+        self.batching = batching
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self._flights = {}  # type: Dict[Hashable, asyncio.Future]
+        # Callers still waiting for each flight
+        self._waiting = {}  # type: Dict[asyncio.Future, int]
+        self._batches = {}  # type: Dict[Hashable, _Batch]
+        self._stats = {SINGLE_FLIGHT: {"reads": 0, "queries": 0}, BATCH: {"reads": 0, "queries": 0}}
+        self._reads = {mode: DB_COALESCING_READS.labels(mode) for mode in self._stats}
+        self._queries = {mode: DB_COALESCING_QUERIES.labels(mode) for mode in self._stats}
+
+    def _count(self, mode: str, queried: bool) -> None:
+        self._stats[mode]["reads"] += 1
+        self._reads[mode].inc()
+        if queried:
+            self._stats[mode]["queries"] += 1
+            self._queries[mode].inc()
+
+    async def single_flight(self, key: Hashable, call: Callable[[], Awaitable[Any]]) -> Any:
+        flight = self._flights.get(key)
+        self._count(SINGLE_FLIGHT, queried=flight is None)
+
+        if flight is None:
+            flight = self._flights[key] = asyncio.ensure_future(call())
+            flight.add_done_callback(_retrieve_exception)
+            flight.add_done_callback(lambda _: self._land(key, flight))
+
+        self._waiting[flight] = self._waiting.get(flight, 0) + 1
+        try:
+            return await asyncio.shield(flight)
+        finally:
+            self._waiting[flight] -= 1
+            if not self._waiting[flight]:
+                del self._waiting[flight]
+                flight.cancel()
+
+    def _land(self, key: Hashable, flight: asyncio.Future) -> None:
+        # After a `forget()` the key may already belong to a newer flight
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def load(
+            self,
+            group: Hashable,
+            key: Hashable,
+            load_many: Callable[[List[Hashable]], Awaitable[Dict[Hashable, Any]]],
+    ) -> Any:
+        """
+        Value of `key`, or None when `load_many` did not find it. Lookups only share a batch within a `group`,
+        which must tell apart everything that changes what `load_many` returns.
+        """
+        batch = self._batches.get(group)
+        self._count(BATCH, queried=batch is None)
+
+        if batch is None:
+            batch = self._batches[group] = _Batch(load_many)
+            loop = asyncio.get_event_loop()
+            if self.batch_window > 0:
+                batch.timer = loop.call_later(self.batch_window, self._dispatch, group, batch)
+            else:
+                batch.timer = loop.call_soon(self._dispatch, group, batch)
+
+        batch.keys[key] = None
+        if len(batch.keys) >= self.max_batch_size:
+            batch.timer.cancel()
+            self._dispatch(group, batch)
+
+        return (await asyncio.shield(batch.future)).get(key)
+
+    def _dispatch(self, group: Hashable, batch: _Batch) -> None:
+        if self._batches.get(group) is batch:
+            del self._batches[group]
+        asyncio.ensure_future(self._run(batch))
+
+    @staticmethod
+    async def _run(batch: _Batch) -> None:
+        try:
+            batch.future.set_result(await batch.load_many(list(batch.keys)))
+        except Exception as e:
+            batch.future.set_exception(e)
+
+    def forget(self) -> None:
+        """
+        Make reads from now on run a query of their own rather than join one that may predate a write. Batches
+        still gathering keys query after the write anyway.
+        """
+        self._flights.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "batching": self.batching,
+            **{
+                mode: {**counts, "ratio": counts["reads"] / counts["queries"] if counts["queries"] else None}
+                for mode, counts in self._stats.items()
+            },
+        }
+
+
+def create_coalescer(
+        *, enabled: bool, batching: bool, batch_window: float, max_batch_size: int
+) -> Optional[ReadCoalescer]:
+    if not enabled:
+        return None
+
+    return ReadCoalescer(batching=batching, batch_window=batch_window, max_batch_size=max_batch_size)
@@ -1,26 +1,163 @@
+import asyncio
+
 from fastapi import FastAPI
 from databases import Database
-from app.core.config import DATABASE_URL
+from app.core import config
+from app.db.changes import ChangeFeed
+from app.db.notifications import NotificationListener
+from app.db.pool import InstrumentedPool, get_pool, instrument_pool, recycle_connections
+from app.db.replicas import Replica, ReplicaSet
+from app.db.repositories.cleanings import (
+    CLEANING_CHANGES_CHANNEL, CLEANINGS_CHANGED_CHANNEL, CLEANING_STATS_REFRESHED_CHANNEL,
+    create_cleanings_cache_handler, create_cleaning_stats_cache_handler, refresh_cleaning_stats,
+)
 from loguru import logger
 
 
-async def connect_to_db(app: FastAPI) -> None:
-    database = Database(DATABASE_URL, min_size=2, max_size=10)
+def _create_database(url: str) -> Database:
+    return Database(
+        url,
+        min_size=config.DB_MIN_POOL_SIZE,
+        max_size=config.DB_MAX_POOL_SIZE,
+        max_inactive_connection_lifetime=config.DB_MAX_INACTIVE_CONNECTION_LIFETIME,
+        statement_cache_size=config.DB_STATEMENT_CACHE_SIZE,
+        max_cached_statement_lifetime=0,
+        server_settings={"statement_timeout": str(config.DB_STATEMENT_TIMEOUT_MS)},
+    )
 
-    try:
-        await database.connect()
-        app.state.db = database
 
-    except Exception as e:
-        logger.warning("--- DB CONNECTION ERROR ---")
-        logger.warning(e)
-        logger.warning("--- DB CONNECTION ERROR ---")
+def _instrument_pool(database: Database) -> InstrumentedPool:
+    return instrument_pool(
+        database, acquire_timeout=config.DB_POOL_ACQUIRE_TIMEOUT, statement_cache_size=config.DB_STATEMENT_CACHE_SIZE
+    )
+
+
+async def connect_database(url: str) -> Database:
+    """
+    Open an instrumented pool on `url`. Retries with exponential backoff, then fails instead of serving without a
+    database.
+    """
+    database = _create_database(url)
+
+    delay = config.DB_CONNECT_RETRY_DELAY
+    for attempt in range(1, config.DB_CONNECT_RETRIES + 1):
+        try:
+            await database.connect()
+            break
+
+        except Exception as e:
+            logger.warning("--- DB CONNECTION ERROR ---")
+            logger.warning(f"attempt {attempt}/{config.DB_CONNECT_RETRIES}: {e!r}")
+            logger.warning("--- DB CONNECTION ERROR ---")
+
+            if attempt == config.DB_CONNECT_RETRIES:
+                raise
+
+            await asyncio.sleep(delay)
+            delay *= 2
+
+    _instrument_pool(database)
+    return database
+
+
+def start_connection_recycler(database: Database) -> asyncio.Future:
+    return asyncio.ensure_future(
+        recycle_connections(get_pool(database), max_lifetime=config.DB_MAX_CONNECTION_LIFETIME)
+    )
+
+
+async def connect_to_db(app: FastAPI) -> None:
+    database = await connect_database(str(config.DATABASE_URL))
+    app.state.db = database
+    app.state.db_recycler = start_connection_recycler(database)
 
 
 async def close_db_connection(app: FastAPI) -> None:
+    recycler = getattr(app.state, "db_recycler", None)
+    if recycler is not None:
+        recycler.cancel()
+
     try:
         await app.state.db.disconnect()
     except Exception as e:
         logger.warning("--- DB CONNECTION ERROR ---")
         logger.warning(e)
         logger.warning("--- DB CONNECTION ERROR ---")
+
+
+async def connect_to_replicas(app: FastAPI) -> None:
+    """
+    Replicas that are down at startup are not fatal; they join the rotation once a health check passes
+    """
+    if not config.DATABASE_REPLICA_URLS:
+        app.state.replicas = None
+        return
+
+    replicas = ReplicaSet(
+        [Replica(url, _create_database(url)) for url in config.DATABASE_REPLICA_URLS],
+        selection=config.DB_REPLICA_SELECTION,
+        max_lag_seconds=config.DB_REPLICA_MAX_LAG_SECONDS,
+        on_connect=_instrument_pool,
+    )
+    await replicas.start(check_interval=config.DB_REPLICA_CHECK_INTERVAL)
+    app.state.replicas = replicas
+
+
+async def close_replica_connections(app: FastAPI) -> None:
+    replicas = getattr(app.state, "replicas", None)
+    if replicas is not None:
+        await replicas.stop()
+
+
+async def start_notification_listener(app: FastAPI) -> None:
+    listener = NotificationListener(str(config.DATABASE_URL))
+
+    cache = getattr(app.state, "cache", None)
+    if cache is not None:
+        listener.add_handler(CLEANINGS_CHANGED_CHANNEL, create_cleanings_cache_handler(cache))
+        listener.add_handler(CLEANING_STATS_REFRESHED_CHANNEL, create_cleaning_stats_cache_handler(cache))
+
+    change_feed = getattr(app.state, "change_feed", None)
+    if change_feed is not None:
+        listener.add_handler(CLEANING_CHANGES_CHANNEL, change_feed.wake)
+
+    await listener.start()
+    app.state.notifications = listener
+
+
+async def stop_notification_listener(app: FastAPI) -> None:
+    listener = getattr(app.state, "notifications", None)
+    if listener is not None:
+        await listener.stop()
+
+
+async def start_stats_refresher(app: FastAPI) -> None:
+    app.state.stats_refresher = asyncio.ensure_future(
+        refresh_cleaning_stats(app.state.db, interval=config.CLEANINGS_STATS_REFRESH_SECONDS)
+    )
+
+
+async def stop_stats_refresher(app: FastAPI) -> None:
+    refresher = getattr(app.state, "stats_refresher", None)
+    if refresher is not None:
+        refresher.cancel()
+        await asyncio.gather(refresher, return_exceptions=True)
+
+
+async def start_change_feed(app: FastAPI) -> None:
+    change_feed = ChangeFeed(
+        app.state.db,
+        buffer_size=config.CLEANINGS_CHANGES_BUFFER_SIZE,
+        page_size=config.CLEANINGS_CHANGES_PAGE_SIZE,
+        poll_interval=config.CLEANINGS_CHANGES_POLL_INTERVAL,
+        retention_seconds=config.CLEANINGS_CHANGES_RETENTION_SECONDS,
+        prune_interval=config.CLEANINGS_CHANGES_PRUNE_INTERVAL,
+    )
+    await change_feed.start()
+    app.state.change_feed = change_feed
+
+
+async def stop_change_feed(app: FastAPI) -> None:
+    change_feed = getattr(app.state, "change_feed", None)
+    if change_feed is not None:
+        await change_feed.stop()
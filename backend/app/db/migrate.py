@@ -10,11 +10,17 @@ migrations_path = pathlib.Path(app.db.__file__).parents[0] / 'migrations'
 
 
 class Migrate:
-    def __init__(self,
-                 db_uri: str = os.environ["DATABASE_URL"],
-                 migration_folder: str = read_migrations(str(migrations_path))):
-        self.backend = get_backend(db_uri)
-        self.migration_folder = migration_folder
+    def __init__(self, db_uri: str = None, migration_folder=None):
+        # Not defaults of the arguments, which importing this module would evaluate
+        self.backend = get_backend(db_uri or os.environ["DATABASE_URL"])
+        self._migration_folder = migration_folder
+
+    @property
+    def migration_folder(self):
+        # Migrations are read from disk when first needed
+        if self._migration_folder is None:
+            self._migration_folder = read_migrations(str(migrations_path))
+        return self._migration_folder
 
     def apply(self):
         self.backend.apply_migrations(self.backend.to_apply(self.migration_folder))
@@ -28,3 +34,6 @@ class Migrate:
     def reapply(self):
         self.rollback_all()
         self.apply()
+
+    def close(self):
+        self.backend.connection.close()
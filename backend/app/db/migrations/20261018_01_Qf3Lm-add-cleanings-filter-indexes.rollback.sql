@@ -0,0 +1,9 @@
+-- ADD_INDEXES_cleanings
+
+DROP INDEX idx_cleanings_description_fts;
+DROP INDEX idx_cleanings_price_id;
+DROP INDEX idx_cleanings_cleaning_type_id;
+DROP INDEX idx_cleanings_name_pattern;
+DROP INDEX idx_cleanings_name_id;
+
+CREATE INDEX idx_name ON cleanings (name);
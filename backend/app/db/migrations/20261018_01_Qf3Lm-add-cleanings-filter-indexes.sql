@@ -0,0 +1,16 @@
+-- ADD_INDEXES_cleanings
+-- depends: 20210324_01_7KSWq-create-table-cleanings
+
+-- Sorting by name pages on (name, id), which supersedes the single column index
+DROP INDEX idx_name;
+CREATE INDEX idx_cleanings_name_id ON cleanings (name, id);
+
+-- Name prefix filters (LIKE 'abc%') need pattern ops to use a btree under non-C collations
+CREATE INDEX idx_cleanings_name_pattern ON cleanings (name text_pattern_ops);
+
+CREATE INDEX idx_cleanings_cleaning_type_id ON cleanings (cleaning_type, id);
+CREATE INDEX idx_cleanings_price_id ON cleanings (price, id);
+
+-- Full-text search on description; queries must use the exact same expression
+CREATE INDEX idx_cleanings_description_fts ON cleanings
+    USING GIN (to_tsvector('english', coalesce(description, '')));
@@ -0,0 +1,5 @@
+-- ADD_VERSION_cleanings
+
+ALTER TABLE cleanings
+    DROP COLUMN updated_at,
+    DROP COLUMN version;
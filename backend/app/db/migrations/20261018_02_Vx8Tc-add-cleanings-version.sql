@@ -0,0 +1,6 @@
+-- ADD_VERSION_cleanings
+-- depends: 20261018_01_Qf3Lm-add-cleanings-filter-indexes
+
+ALTER TABLE cleanings
+    ADD COLUMN version    INTEGER     NOT NULL DEFAULT 1,
+    ADD COLUMN updated_at TIMESTAMPTZ NOT NULL DEFAULT now();
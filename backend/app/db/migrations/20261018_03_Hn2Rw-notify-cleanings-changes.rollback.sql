@@ -0,0 +1,7 @@
+-- NOTIFY_CHANGES_cleanings
+
+DROP TRIGGER cleanings_deleted_notify ON cleanings;
+DROP TRIGGER cleanings_updated_notify ON cleanings;
+DROP TRIGGER cleanings_inserted_notify ON cleanings;
+
+DROP FUNCTION notify_cleanings_changed();
@@ -0,0 +1,43 @@
+-- NOTIFY_CHANGES_cleanings
+-- depends: 20261018_02_Vx8Tc-add-cleanings-version
+
+-- Statement level triggers send one notification per write statement, so bulk writes stay cheap.
+-- Listeners get {"op": ..., "ids": [...]}; ids is null when a statement touched too many rows to list.
+CREATE FUNCTION notify_cleanings_changed() RETURNS trigger AS
+$$
+DECLARE
+    changed_ids INTEGER[];
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        SELECT array_agg(id) INTO changed_ids FROM (SELECT id FROM old_rows LIMIT 101) AS changed;
+    ELSE
+        SELECT array_agg(id) INTO changed_ids FROM (SELECT id FROM new_rows LIMIT 101) AS changed;
+    END IF;
+
+    IF changed_ids IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    PERFORM pg_notify('cleanings_changed', json_build_object(
+        'op', TG_OP,
+        'ids', CASE WHEN array_length(changed_ids, 1) > 100 THEN NULL ELSE changed_ids END
+    )::text);
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER cleanings_inserted_notify
+    AFTER INSERT ON cleanings
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_cleanings_changed();
+
+CREATE TRIGGER cleanings_updated_notify
+    AFTER UPDATE ON cleanings
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_cleanings_changed();
+
+CREATE TRIGGER cleanings_deleted_notify
+    AFTER DELETE ON cleanings
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_cleanings_changed();
@@ -0,0 +1,5 @@
+-- CREATE_TABLE_table_versions
+
+DROP TRIGGER cleanings_bump_table_version ON cleanings;
+DROP FUNCTION bump_table_version();
+DROP TABLE table_versions;
@@ -0,0 +1,24 @@
+-- CREATE_TABLE_table_versions
+-- depends: 20261018_03_Hn2Rw-notify-cleanings-changes
+
+-- One counter per table, bumped by every write statement; lets a whole collection be revalidated
+-- (collection ETags) without reading or hashing its rows
+CREATE TABLE table_versions
+(
+    table_name TEXT PRIMARY KEY,
+    version    BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO table_versions (table_name) VALUES ('cleanings');
+
+CREATE FUNCTION bump_table_version() RETURNS trigger AS
+$$
+BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE table_name = TG_TABLE_NAME;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER cleanings_bump_table_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON cleanings
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
@@ -0,0 +1,12 @@
+-- CREATE_TABLE_cleaning_stats
+
+DROP FUNCTION refresh_cleaning_price_distribution();
+DROP TABLE cleaning_price_distribution;
+DELETE FROM table_versions WHERE table_name = 'cleaning_price_distribution';
+
+DROP TRIGGER cleanings_stats_truncated ON cleanings;
+DROP TRIGGER cleanings_stats_deleted ON cleanings;
+DROP TRIGGER cleanings_stats_updated ON cleanings;
+DROP TRIGGER cleanings_stats_inserted ON cleanings;
+DROP FUNCTION maintain_cleaning_stats();
+DROP TABLE cleaning_stats;
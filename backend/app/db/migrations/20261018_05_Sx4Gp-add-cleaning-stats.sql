@@ -0,0 +1,119 @@
+-- CREATE_TABLE_cleaning_stats
+-- depends: 20261018_04_Kp7Ds-add-table-versions
+
+-- Count and price total per cleaning type, kept exact by statement level triggers, so the stats endpoint reads
+-- one row per type instead of aggregating cleanings. Every write statement first bumps table_versions (the
+-- triggers fire in name order), which serializes writers before they touch these rows.
+CREATE TABLE cleaning_stats
+(
+    cleaning_type VARCHAR(30) PRIMARY KEY,
+    count         BIGINT  NOT NULL DEFAULT 0,
+    price_sum     NUMERIC NOT NULL DEFAULT 0
+);
+
+INSERT INTO cleaning_stats (cleaning_type, count, price_sum)
+SELECT cleaning_type, count(*), sum(price)
+FROM cleanings
+GROUP BY cleaning_type;
+
+CREATE FUNCTION maintain_cleaning_stats() RETURNS trigger AS
+$$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        UPDATE cleaning_stats SET count = 0, price_sum = 0;
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE cleaning_stats
+        SET count = cleaning_stats.count - removed.count,
+            price_sum = cleaning_stats.price_sum - removed.price_sum
+        FROM (SELECT cleaning_type, count(*) AS count, sum(price) AS price_sum
+              FROM old_rows
+              GROUP BY cleaning_type) AS removed
+        WHERE cleaning_stats.cleaning_type = removed.cleaning_type;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO cleaning_stats (cleaning_type, count, price_sum)
+        SELECT cleaning_type, count(*), sum(price)
+        FROM new_rows
+        GROUP BY cleaning_type
+        ON CONFLICT (cleaning_type) DO UPDATE
+            SET count = cleaning_stats.count + excluded.count,
+                price_sum = cleaning_stats.price_sum + excluded.price_sum;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER cleanings_stats_inserted
+    AFTER INSERT ON cleanings
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION maintain_cleaning_stats();
+
+CREATE TRIGGER cleanings_stats_updated
+    AFTER UPDATE ON cleanings
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION maintain_cleaning_stats();
+
+CREATE TRIGGER cleanings_stats_deleted
+    AFTER DELETE ON cleanings
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION maintain_cleaning_stats();
+
+CREATE TRIGGER cleanings_stats_truncated
+    AFTER TRUNCATE ON cleanings
+    FOR EACH STATEMENT EXECUTE FUNCTION maintain_cleaning_stats();
+
+-- Price distribution per cleaning type. Percentiles cannot be maintained incrementally, so this is recomputed
+-- from cleanings in the background by refresh_cleaning_price_distribution() and lags by up to the refresh
+-- interval. Writers never touch it, so a refresh does not block them.
+CREATE TABLE cleaning_price_distribution
+(
+    cleaning_type VARCHAR(30) PRIMARY KEY,
+    min_price     NUMERIC(10, 2)   NOT NULL,
+    max_price     NUMERIC(10, 2)   NOT NULL,
+    p50_price     DOUBLE PRECISION NOT NULL,
+    p90_price     DOUBLE PRECISION NOT NULL,
+    p99_price     DOUBLE PRECISION NOT NULL,
+    refreshed_at  TIMESTAMPTZ      NOT NULL DEFAULT now()
+);
+
+-- Here the version is the one of cleanings the distribution was computed at; -1 means never
+INSERT INTO table_versions (table_name, version) VALUES ('cleaning_price_distribution', -1);
+
+-- Recompute the distribution if cleanings changed since the last refresh. Returns whether it did. Safe to call
+-- from every worker: concurrent callers skip instead of waiting, and an unchanged table costs two index lookups.
+CREATE FUNCTION refresh_cleaning_price_distribution() RETURNS BOOLEAN AS
+$$
+DECLARE
+    current_version BIGINT;
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('refresh_cleaning_price_distribution')) THEN
+        RETURN FALSE;
+    END IF;
+
+    -- Read before aggregating: a write committing in between makes the next call refresh again
+    SELECT version INTO current_version FROM table_versions WHERE table_name = 'cleanings';
+    IF current_version = (SELECT version FROM table_versions WHERE table_name = 'cleaning_price_distribution') THEN
+        RETURN FALSE;
+    END IF;
+
+    DELETE FROM cleaning_price_distribution;
+    INSERT INTO cleaning_price_distribution (cleaning_type, min_price, max_price, p50_price, p90_price, p99_price)
+    SELECT cleaning_type,
+           min(price),
+           max(price),
+           percentile_cont(0.5) WITHIN GROUP (ORDER BY price),
+           percentile_cont(0.9) WITHIN GROUP (ORDER BY price),
+           percentile_cont(0.99) WITHIN GROUP (ORDER BY price)
+    FROM cleanings
+    GROUP BY cleaning_type;
+
+    UPDATE table_versions SET version = current_version WHERE table_name = 'cleaning_price_distribution';
+    PERFORM pg_notify('cleaning_stats_refreshed', current_version::text);
+    RETURN TRUE;
+END;
+$$ LANGUAGE plpgsql;
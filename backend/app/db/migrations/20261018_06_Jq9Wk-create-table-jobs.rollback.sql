@@ -0,0 +1,5 @@
+-- CREATE_TABLE_jobs
+
+DROP TRIGGER jobs_queued_notify ON jobs;
+DROP FUNCTION notify_jobs_queued();
+DROP TABLE jobs;
@@ -0,0 +1,41 @@
+-- CREATE_TABLE_jobs
+-- depends: 20261018_05_Sx4Gp-add-cleaning-stats
+
+-- Work queued by the API and run by job workers (python -m app.jobs.worker). Workers claim runnable jobs with
+-- FOR UPDATE SKIP LOCKED, so they never wait on each other, and hold a claimed job for a lease; a job whose
+-- worker died is put back once its lease expires.
+CREATE TABLE jobs
+(
+    id           BIGSERIAL PRIMARY KEY,
+    kind         TEXT        NOT NULL,
+    payload      JSONB       NOT NULL DEFAULT '{}',
+    status       VARCHAR(20) NOT NULL DEFAULT 'queued',
+    attempts     INTEGER     NOT NULL DEFAULT 0,
+    max_attempts INTEGER     NOT NULL DEFAULT 5,
+    -- Not claimed before this time; pushed back after every failed attempt
+    run_at       TIMESTAMPTZ NOT NULL DEFAULT now(),
+    locked_by    TEXT,
+    locked_until TIMESTAMPTZ,
+    result       JSONB,
+    error        TEXT,
+    created_at   TIMESTAMPTZ NOT NULL DEFAULT now(),
+    started_at   TIMESTAMPTZ,
+    finished_at  TIMESTAMPTZ
+);
+
+-- Finished jobs, the bulk of the table, stay out of the indexes workers scan
+CREATE INDEX idx_jobs_runnable ON jobs (run_at) WHERE status = 'queued';
+CREATE INDEX idx_jobs_leases ON jobs (locked_until) WHERE status = 'running';
+
+-- Wake idle workers as soon as something is queued instead of at their next poll
+CREATE FUNCTION notify_jobs_queued() RETURNS trigger AS
+$$
+BEGIN
+    PERFORM pg_notify('jobs_queued', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER jobs_queued_notify
+    AFTER INSERT ON jobs
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_jobs_queued();
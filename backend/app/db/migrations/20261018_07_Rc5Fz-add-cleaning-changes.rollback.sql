@@ -0,0 +1,8 @@
+-- CREATE_TABLE_cleaning_changes
+
+DROP TRIGGER cleanings_deleted_record_changes ON cleanings;
+DROP TRIGGER cleanings_updated_record_changes ON cleanings;
+DROP TRIGGER cleanings_inserted_record_changes ON cleanings;
+
+DROP FUNCTION record_cleaning_changes();
+DROP TABLE cleaning_changes;
@@ -0,0 +1,72 @@
+-- CREATE_TABLE_cleaning_changes
+-- depends: 20261018_06_Jq9Wk-create-table-jobs
+
+-- Log of writes to cleanings behind the change feed (/api/cleanings/changes). Changes are read in the order of
+-- (txid, id) and only once every transaction with a lower txid has finished, so that a reader never moves past a
+-- change that is committed later; a resumable cursor is the (txid, id) of the last change seen.
+CREATE TABLE cleaning_changes
+(
+    id          BIGSERIAL,
+    txid        BIGINT      NOT NULL DEFAULT txid_current(),
+    op          VARCHAR(10) NOT NULL,
+    -- NULL when one statement changed more cleanings than are worth listing: readers refetch instead
+    cleaning_id INTEGER,
+    version     INTEGER,
+    changed_at  TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (txid, id)
+);
+
+CREATE INDEX idx_cleaning_changes_changed_at ON cleaning_changes (changed_at);
+
+-- Pruning keeps the last change it could have removed, so a cursor is good while some change at or before it is
+-- left. Until the log is first pruned, this one plays that part; it is never read as a change.
+INSERT INTO cleaning_changes (txid, id, op) VALUES (0, 0, 'create');
+
+-- Statement level like notify_cleanings_changed, with one notification per statement. Listeners are woken
+-- with an empty payload and read the log themselves.
+CREATE FUNCTION record_cleaning_changes() RETURNS trigger AS
+$$
+DECLARE
+    change_op TEXT := CASE TG_OP WHEN 'INSERT' THEN 'create' WHEN 'UPDATE' THEN 'update' ELSE 'delete' END;
+    many      BOOLEAN;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        SELECT count(*) > 1000 INTO many FROM (SELECT 1 FROM old_rows LIMIT 1001) AS changed;
+        IF many THEN
+            INSERT INTO cleaning_changes (op) VALUES (change_op);
+        ELSE
+            INSERT INTO cleaning_changes (op, cleaning_id, version)
+            SELECT change_op, id, version FROM old_rows ORDER BY id;
+        END IF;
+    ELSE
+        SELECT count(*) > 1000 INTO many FROM (SELECT 1 FROM new_rows LIMIT 1001) AS changed;
+        IF many THEN
+            INSERT INTO cleaning_changes (op) VALUES (change_op);
+        ELSE
+            INSERT INTO cleaning_changes (op, cleaning_id, version)
+            SELECT change_op, id, version FROM new_rows ORDER BY id;
+        END IF;
+    END IF;
+
+    IF FOUND THEN
+        PERFORM pg_notify('cleaning_changes', '');
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER cleanings_inserted_record_changes
+    AFTER INSERT ON cleanings
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION record_cleaning_changes();
+
+CREATE TRIGGER cleanings_updated_record_changes
+    AFTER UPDATE ON cleanings
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION record_cleaning_changes();
+
+CREATE TRIGGER cleanings_deleted_record_changes
+    AFTER DELETE ON cleanings
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION record_cleaning_changes();
@@ -0,0 +1,55 @@
+-- CREATE_TABLE_table_version_bumps
+
+CREATE OR REPLACE FUNCTION refresh_cleaning_price_distribution() RETURNS BOOLEAN AS
+$$
+DECLARE
+    current_version BIGINT;
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('refresh_cleaning_price_distribution')) THEN
+        RETURN FALSE;
+    END IF;
+
+    -- Read before aggregating: a write committing in between makes the next call refresh again
+    SELECT version INTO current_version FROM table_versions WHERE table_name = 'cleanings';
+    IF current_version = (SELECT version FROM table_versions WHERE table_name = 'cleaning_price_distribution') THEN
+        RETURN FALSE;
+    END IF;
+
+    DELETE FROM cleaning_price_distribution;
+    INSERT INTO cleaning_price_distribution (cleaning_type, min_price, max_price, p50_price, p90_price, p99_price)
+    SELECT cleaning_type,
+           min(price),
+           max(price),
+           percentile_cont(0.5) WITHIN GROUP (ORDER BY price),
+           percentile_cont(0.9) WITHIN GROUP (ORDER BY price),
+           percentile_cont(0.99) WITHIN GROUP (ORDER BY price)
+    FROM cleanings
+    GROUP BY cleaning_type;
+
+    UPDATE table_versions SET version = current_version WHERE table_name = 'cleaning_price_distribution';
+    PERFORM pg_notify('cleaning_stats_refreshed', current_version::text);
+    RETURN TRUE;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER cleanings_truncated_bump_table_version ON cleanings;
+DROP TRIGGER cleanings_deleted_bump_table_version ON cleanings;
+DROP TRIGGER cleanings_updated_bump_table_version ON cleanings;
+DROP TRIGGER cleanings_inserted_bump_table_version ON cleanings;
+
+CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger AS
+$$
+BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE table_name = TG_TABLE_NAME;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER cleanings_bump_table_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON cleanings
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+
+SELECT compact_table_versions();
+DROP FUNCTION compact_table_versions();
+DROP FUNCTION table_version(TEXT);
+DROP TABLE table_version_bumps;
@@ -0,0 +1,107 @@
+-- CREATE_TABLE_table_version_bumps
+-- depends: 20261018_07_Rc5Fz-add-cleaning-changes
+
+-- Write statements used to bump their table's row in table_versions, and held that row locked until they
+-- committed: writers queued behind one another, and behind any long transaction. Each statement that changed
+-- rows now appends a bump here instead, which no other writer waits for. A table's version is its row in
+-- table_versions plus its committed bumps, see table_version(), so it still moves exactly when a write commits.
+CREATE TABLE table_version_bumps
+(
+    id         BIGSERIAL PRIMARY KEY,
+    table_name TEXT NOT NULL
+);
+
+CREATE FUNCTION table_version(versioned_table TEXT) RETURNS BIGINT AS
+$$
+SELECT version + (SELECT count(*) FROM table_version_bumps WHERE table_name = versioned_table)
+FROM table_versions
+WHERE table_name = versioned_table;
+$$ LANGUAGE sql STABLE;
+
+-- Fold the bumps into table_versions, which leaves every version as it was. Concurrent calls wait for each other:
+-- a bump is only ever folded once.
+CREATE FUNCTION compact_table_versions() RETURNS VOID AS
+$$
+WITH folded AS (
+    DELETE FROM table_version_bumps RETURNING table_name
+)
+UPDATE table_versions
+SET version = table_versions.version + bumps.count
+FROM (SELECT table_name, count(*) AS count FROM folded GROUP BY table_name) AS bumps
+WHERE table_versions.table_name = bumps.table_name;
+$$ LANGUAGE sql;
+
+-- Statements that changed no rows leave the version alone. A TRUNCATE has no transition table and always bumps it.
+CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger AS
+$$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        IF NOT EXISTS (SELECT FROM old_rows) THEN
+            RETURN NULL;
+        END IF;
+    ELSIF TG_OP IN ('INSERT', 'UPDATE') THEN
+        IF NOT EXISTS (SELECT FROM new_rows) THEN
+            RETURN NULL;
+        END IF;
+    END IF;
+
+    INSERT INTO table_version_bumps (table_name) VALUES (TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER cleanings_bump_table_version ON cleanings;
+
+CREATE TRIGGER cleanings_inserted_bump_table_version
+    AFTER INSERT ON cleanings
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+
+CREATE TRIGGER cleanings_updated_bump_table_version
+    AFTER UPDATE ON cleanings
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+
+CREATE TRIGGER cleanings_deleted_bump_table_version
+    AFTER DELETE ON cleanings
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+
+CREATE TRIGGER cleanings_truncated_bump_table_version
+    AFTER TRUNCATE ON cleanings
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+
+-- Also folds the bumps, at most once per refresh interval, which keeps reading a version cheap
+CREATE OR REPLACE FUNCTION refresh_cleaning_price_distribution() RETURNS BOOLEAN AS
+$$
+DECLARE
+    current_version BIGINT;
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('refresh_cleaning_price_distribution')) THEN
+        RETURN FALSE;
+    END IF;
+
+    PERFORM compact_table_versions();
+
+    -- Read before aggregating: a write committing in between makes the next call refresh again
+    current_version := table_version('cleanings');
+    IF current_version = (SELECT version FROM table_versions WHERE table_name = 'cleaning_price_distribution') THEN
+        RETURN FALSE;
+    END IF;
+
+    DELETE FROM cleaning_price_distribution;
+    INSERT INTO cleaning_price_distribution (cleaning_type, min_price, max_price, p50_price, p90_price, p99_price)
+    SELECT cleaning_type,
+           min(price),
+           max(price),
+           percentile_cont(0.5) WITHIN GROUP (ORDER BY price),
+           percentile_cont(0.9) WITHIN GROUP (ORDER BY price),
+           percentile_cont(0.99) WITHIN GROUP (ORDER BY price)
+    FROM cleanings
+    GROUP BY cleaning_type;
+
+    UPDATE table_versions SET version = current_version WHERE table_name = 'cleaning_price_distribution';
+    PERFORM pg_notify('cleaning_stats_refreshed', current_version::text);
+    RETURN TRUE;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,72 @@
+-- CREATE_TABLE_cleaning_stats_deltas
+
+CREATE OR REPLACE FUNCTION refresh_cleaning_price_distribution() RETURNS BOOLEAN AS
+$$
+DECLARE
+    current_version BIGINT;
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('refresh_cleaning_price_distribution')) THEN
+        RETURN FALSE;
+    END IF;
+
+    PERFORM compact_table_versions();
+
+    -- Read before aggregating: a write committing in between makes the next call refresh again
+    current_version := table_version('cleanings');
+    IF current_version = (SELECT version FROM table_versions WHERE table_name = 'cleaning_price_distribution') THEN
+        RETURN FALSE;
+    END IF;
+
+    DELETE FROM cleaning_price_distribution;
+    INSERT INTO cleaning_price_distribution (cleaning_type, min_price, max_price, p50_price, p90_price, p99_price)
+    SELECT cleaning_type,
+           min(price),
+           max(price),
+           percentile_cont(0.5) WITHIN GROUP (ORDER BY price),
+           percentile_cont(0.9) WITHIN GROUP (ORDER BY price),
+           percentile_cont(0.99) WITHIN GROUP (ORDER BY price)
+    FROM cleanings
+    GROUP BY cleaning_type;
+
+    UPDATE table_versions SET version = current_version WHERE table_name = 'cleaning_price_distribution';
+    PERFORM pg_notify('cleaning_stats_refreshed', current_version::text);
+    RETURN TRUE;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION maintain_cleaning_stats() RETURNS trigger AS
+$$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        UPDATE cleaning_stats SET count = 0, price_sum = 0;
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE cleaning_stats
+        SET count = cleaning_stats.count - removed.count,
+            price_sum = cleaning_stats.price_sum - removed.price_sum
+        FROM (SELECT cleaning_type, count(*) AS count, sum(price) AS price_sum
+              FROM old_rows
+              GROUP BY cleaning_type) AS removed
+        WHERE cleaning_stats.cleaning_type = removed.cleaning_type;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO cleaning_stats (cleaning_type, count, price_sum)
+        SELECT cleaning_type, count(*), sum(price)
+        FROM new_rows
+        GROUP BY cleaning_type
+        ON CONFLICT (cleaning_type) DO UPDATE
+            SET count = cleaning_stats.count + excluded.count,
+                price_sum = cleaning_stats.price_sum + excluded.price_sum;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT compact_cleaning_stats();
+DROP FUNCTION compact_cleaning_stats();
+DROP VIEW cleaning_stats_totals;
+DROP TABLE cleaning_stats_deltas;
@@ -0,0 +1,108 @@
+-- CREATE_TABLE_cleaning_stats_deltas
+-- depends: 20261018_08_Tb6Nv-add-table-version-bumps
+
+-- Write statements used to update or upsert the cleaning_stats row of each type they changed, and held it locked
+-- until they committed: writers of a type queued behind one another, and behind any long transaction writing that
+-- type. Each statement now appends its change, per type, here instead, which no other writer waits for. The
+-- stats of a type are its row in cleaning_stats plus its committed deltas; compact_cleaning_stats() folds the
+-- deltas into cleaning_stats, which is then only written by the stats refresher.
+CREATE TABLE cleaning_stats_deltas
+(
+    id            BIGSERIAL PRIMARY KEY,
+    cleaning_type VARCHAR(30) NOT NULL,
+    count         BIGINT      NOT NULL,
+    price_sum     NUMERIC     NOT NULL
+);
+
+-- Totals per cleaning type, as committed
+CREATE VIEW cleaning_stats_totals AS
+SELECT cleaning_type, sum(count) AS count, sum(price_sum) AS price_sum
+FROM (SELECT cleaning_type, count, price_sum FROM cleaning_stats
+      UNION ALL
+      SELECT cleaning_type, count, price_sum FROM cleaning_stats_deltas) AS parts
+GROUP BY cleaning_type;
+
+-- Concurrent calls wait for each other: a delta is only ever folded once
+CREATE FUNCTION compact_cleaning_stats() RETURNS VOID AS
+$$
+WITH folded AS (
+    DELETE FROM cleaning_stats_deltas RETURNING cleaning_type, count, price_sum
+)
+INSERT INTO cleaning_stats (cleaning_type, count, price_sum)
+SELECT cleaning_type, sum(count), sum(price_sum)
+FROM folded
+GROUP BY cleaning_type
+ON CONFLICT (cleaning_type) DO UPDATE
+    SET count = cleaning_stats.count + excluded.count,
+        price_sum = cleaning_stats.price_sum + excluded.price_sum;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION maintain_cleaning_stats() RETURNS trigger AS
+$$
+BEGIN
+    -- Writers of cleanings wait for a TRUNCATE, so the totals it reads cannot change underneath it
+    IF TG_OP = 'TRUNCATE' THEN
+        INSERT INTO cleaning_stats_deltas (cleaning_type, count, price_sum)
+        SELECT cleaning_type, -count, -price_sum
+        FROM cleaning_stats_totals
+        WHERE count <> 0 OR price_sum <> 0;
+    ELSIF TG_OP = 'INSERT' THEN
+        INSERT INTO cleaning_stats_deltas (cleaning_type, count, price_sum)
+        SELECT cleaning_type, count(*), sum(price)
+        FROM new_rows
+        GROUP BY cleaning_type;
+    ELSIF TG_OP = 'DELETE' THEN
+        INSERT INTO cleaning_stats_deltas (cleaning_type, count, price_sum)
+        SELECT cleaning_type, -count(*), -sum(price)
+        FROM old_rows
+        GROUP BY cleaning_type;
+    ELSE
+        -- Updates that change neither the type nor the price of any cleaning leave no delta
+        INSERT INTO cleaning_stats_deltas (cleaning_type, count, price_sum)
+        SELECT cleaning_type, sum(count), sum(price_sum)
+        FROM (SELECT cleaning_type, 1 AS count, price AS price_sum FROM new_rows
+              UNION ALL
+              SELECT cleaning_type, -1, -price FROM old_rows) AS changed
+        GROUP BY cleaning_type
+        HAVING sum(count) <> 0 OR sum(price_sum) <> 0;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Folds the deltas too, at most once per refresh interval, which keeps reading the stats cheap
+CREATE OR REPLACE FUNCTION refresh_cleaning_price_distribution() RETURNS BOOLEAN AS
+$$
+DECLARE
+    current_version BIGINT;
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('refresh_cleaning_price_distribution')) THEN
+        RETURN FALSE;
+    END IF;
+
+    PERFORM compact_table_versions();
+    PERFORM compact_cleaning_stats();
+
+    -- Read before aggregating: a write committing in between makes the next call refresh again
+    current_version := table_version('cleanings');
+    IF current_version = (SELECT version FROM table_versions WHERE table_name = 'cleaning_price_distribution') THEN
+        RETURN FALSE;
+    END IF;
+
+    DELETE FROM cleaning_price_distribution;
+    INSERT INTO cleaning_price_distribution (cleaning_type, min_price, max_price, p50_price, p90_price, p99_price)
+    SELECT cleaning_type,
+           min(price),
+           max(price),
+           percentile_cont(0.5) WITHIN GROUP (ORDER BY price),
+           percentile_cont(0.9) WITHIN GROUP (ORDER BY price),
+           percentile_cont(0.99) WITHIN GROUP (ORDER BY price)
+    FROM cleanings
+    GROUP BY cleaning_type;
+
+    UPDATE table_versions SET version = current_version WHERE table_name = 'cleaning_price_distribution';
+    PERFORM pg_notify('cleaning_stats_refreshed', current_version::text);
+    RETURN TRUE;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,86 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+import asyncpg
+from loguru import logger
+
+# Handlers get the notification payload, or None when notifications may have been missed and state must be resynced
+NotificationHandler = Callable[[Optional[str]], Awaitable[None]]
+
+
+class NotificationListener:
+    """
+    One dedicated connection per worker LISTENing on Postgres channels, kept out of the pool so it never
+    competes with queries. If the connection drops it is re-established in the background.
+    """
+
+    def __init__(self, dsn: str, *, reconnect_interval: float = 1.0) -> None:
+        self.dsn = dsn
+        self.reconnect_interval = reconnect_interval
+        self._handlers = {}  # type: Dict[str, List[NotificationHandler]]
+        self._connection = None  # type: Optional[asyncpg.Connection]
+        self._watchdog = None  # type: Optional[asyncio.Task]
+        self._pending = set()  # type: Set[asyncio.Future]
+
+    def add_handler(self, channel: str, handler: NotificationHandler) -> None:
+        self._handlers.setdefault(channel, []).append(handler)
+
+    @property
+    def connected(self) -> bool:
+        return self._connection is not None and not self._connection.is_closed()
+
+    async def start(self) -> None:
+        try:
+            await self._connect()
+        except Exception as e:
+            logger.warning("--- NOTIFICATION LISTENER ERROR ---")
+            logger.warning(e)
+            logger.warning("--- NOTIFICATION LISTENER ERROR ---")
+
+        self._watchdog = asyncio.ensure_future(self._watch())
+
+    async def stop(self) -> None:
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            await asyncio.gather(self._watchdog, return_exceptions=True)
+
+        if self.connected:
+            await self._connection.close()
+
+        await asyncio.gather(*self._pending, return_exceptions=True)
+
+    async def _connect(self) -> None:
+        self._connection = await asyncpg.connect(self.dsn)
+        for channel in self._handlers:
+            await self._connection.add_listener(channel, self._on_notification)
+
+    def _on_notification(self, connection: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+        for handler in self._handlers.get(channel, []):
+            self._dispatch(handler(payload))
+
+    def _dispatch(self, handling: Awaitable[None]) -> None:
+        task = asyncio.ensure_future(handling)
+        self._pending.add(task)
+        task.add_done_callback(self._on_handled)
+
+    def _on_handled(self, task: asyncio.Future) -> None:
+        self._pending.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Notification handler failed: {task.exception()!r}")
+
+    async def _watch(self) -> None:
+        while True:
+            await asyncio.sleep(self.reconnect_interval)
+            if self.connected:
+                continue
+
+            try:
+                await self._connect()
+            except Exception as e:
+                logger.warning(f"Notification listener cannot reconnect: {e!r}")
+                continue
+
+            # Anything sent while we were disconnected is lost, so let every handler resync
+            for handlers in self._handlers.values():
+                for handler in handlers:
+                    self._dispatch(handler(None))
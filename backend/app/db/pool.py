@@ -0,0 +1,135 @@
+import asyncio
+import bisect
+import time
+from typing import Any, Callable, Dict, Optional
+
+import asyncpg
+from databases import Database
+from databases.core import Connection
+
+from app.db.queries import StatementCache
+
+# Upper bounds, in seconds, of the acquire latency histogram buckets
+ACQUIRE_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class PoolAcquireTimeout(Exception):
+    """
+    No pooled connection became free within DB_POOL_ACQUIRE_TIMEOUT
+    """
+
+
+class InstrumentedPool:
+    """
+    Wraps the asyncpg pool behind a `databases.Database` to bound how long a request may wait for a connection
+    and to count how the pool is used. Everything else is delegated to the wrapped pool.
+    """
+
+    def __init__(
+        self,
+        pool: asyncpg.pool.Pool,
+        *,
+        acquire_timeout: Optional[float],
+        on_acquire_timeout: Callable[[], None] = None,
+        statements: StatementCache = None,
+    ) -> None:
+        self._pool = pool
+        self.statements = statements
+        self.acquire_timeout = acquire_timeout
+        self.on_acquire_timeout = on_acquire_timeout
+        self.in_use = 0
+        self.waiting = 0
+        self.acquired_total = 0
+        self.timeouts_total = 0
+        self.acquire_seconds_sum = 0.0
+        self.acquire_seconds_buckets = [0] * (len(ACQUIRE_LATENCY_BUCKETS) + 1)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._pool, name)
+
+    async def acquire(self, *, timeout: float = None) -> asyncpg.Connection:
+        started = time.perf_counter()
+        self.waiting += 1
+
+        try:
+            connection = await self._pool.acquire(timeout=timeout or self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts_total += 1
+            if self.on_acquire_timeout is not None:
+                self.on_acquire_timeout()
+            raise PoolAcquireTimeout(f"no database connection available after {self.acquire_timeout}s")
+        finally:
+            self.waiting -= 1
+
+        elapsed = time.perf_counter() - started
+        self.in_use += 1
+        self.acquired_total += 1
+        self.acquire_seconds_sum += elapsed
+        self.acquire_seconds_buckets[bisect.bisect_left(ACQUIRE_LATENCY_BUCKETS, elapsed)] += 1
+
+        return connection
+
+    async def release(self, connection: asyncpg.Connection, *, timeout: float = None) -> None:
+        self.in_use -= 1
+        return await self._pool.release(connection, timeout=timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        size = self._pool.get_size() if hasattr(self._pool, "get_size") else None
+        cumulative, buckets = 0, {}  # type: int, Dict[str, int]
+        for bound, count in zip(list(ACQUIRE_LATENCY_BUCKETS) + ["+Inf"], self.acquire_seconds_buckets):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+
+        return {
+            "min_size": self._pool._minsize,  # asyncpg only has public getters for these from 0.25 on
+            "max_size": self._pool._maxsize,
+            "size": size,
+            "in_use": self.in_use,
+            "idle": size - self.in_use if size is not None else None,
+            "waiting": self.waiting,
+            "acquired_total": self.acquired_total,
+            "timeouts_total": self.timeouts_total,
+            "acquire_seconds_sum": self.acquire_seconds_sum,
+            "acquire_seconds_buckets": buckets,
+            "statements": self.statements.stats() if self.statements is not None else None,
+        }
+
+
+def instrument_pool(
+    database: Database, *, acquire_timeout: Optional[float], statement_cache_size: int = 100
+) -> InstrumentedPool:
+    """
+    `databases` keeps its asyncpg pool on the backend once connected; swap it for the instrumented wrapper.
+    `statement_cache_size` must match the one the pool was created with.
+    """
+    backend = database._backend
+
+    def discard_connection() -> None:
+        # `databases` counts a connection as acquired before asking the pool for it, so after a failed acquire the
+        # connection bound to the current context would never be acquired again; bind a fresh one instead
+        database._connection_context.set(Connection(backend))
+
+    pool = InstrumentedPool(
+        backend._pool,
+        acquire_timeout=acquire_timeout,
+        on_acquire_timeout=discard_connection,
+        statements=StatementCache(statement_cache_size),
+    )
+    backend._pool = pool
+
+    return pool
+
+
+def get_pool(database: Database) -> Optional[InstrumentedPool]:
+    pool = getattr(database._backend, "_pool", None)
+    return pool if isinstance(pool, InstrumentedPool) else None
+
+
+async def recycle_connections(pool: InstrumentedPool, *, max_lifetime: float) -> None:
+    """
+    Bound connection lifetime: every `max_lifetime` seconds all open connections are marked expired, and asyncpg
+    replaces each one the next time it is acquired or released
+    """
+    while True:
+        await asyncio.sleep(max_lifetime)
+        await pool.expire_connections()
@@ -0,0 +1,140 @@
+import re
+from collections import OrderedDict
+from types import ModuleType
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional, Tuple
+from weakref import WeakKeyDictionary
+
+import asyncpg
+
+from app.core.metrics import DB_STATEMENT_CACHE_HITS, DB_STATEMENT_CACHE_MISSES
+
+# `:name` bind parameters, but not `::type` casts or times such as 12:30
+_BIND_PARAMETER = re.compile(r"(?<![:\w]):([A-Za-z_]\w*)")
+
+
+class CompiledQuery(NamedTuple):
+    """
+    A query with its `:name` parameters rewritten to asyncpg's positional `$n` form
+    """
+    sql: str
+    parameters: Tuple[str, ...]
+    name: Optional[str] = None
+
+    def arguments(self, values: Optional[Mapping[str, Any]]) -> List[Any]:
+        values = values or {}
+        try:
+            return [values[parameter] for parameter in self.parameters]
+        except KeyError as e:
+            raise KeyError(f"missing value for query parameter {e}") from None
+
+
+def compile_query(sql: str, name: str = None) -> CompiledQuery:
+    positions = {}  # type: Dict[str, int]
+
+    def to_position(match) -> str:
+        parameter = match.group(1)
+        if parameter not in positions:
+            positions[parameter] = len(positions) + 1
+        return f"${positions[parameter]}"
+
+    return CompiledQuery(_BIND_PARAMETER.sub(to_position, sql), tuple(positions), name)
+
+
+class QueryRegistry:
+    """
+    Compiles every distinct statement once. Queries are registered under the name of the module constant that
+    holds them; statements built at runtime (filters, assignments) are compiled on first use and kept in a
+    bounded LRU.
+    """
+
+    def __init__(self, max_adhoc: int = 1000) -> None:
+        self.max_adhoc = max_adhoc
+        self._named = {}  # type: Dict[str, CompiledQuery]
+        self._adhoc = OrderedDict()  # type: OrderedDict[str, CompiledQuery]
+
+    def register(self, name: str, sql: str) -> CompiledQuery:
+        compiled = self._named[sql] = compile_query(sql, name)
+        return compiled
+
+    def register_module(self, module: ModuleType) -> None:
+        """
+        Register the `*_QUERY` constants of a repository module; templates with format slots are skipped
+        """
+        for name, value in vars(module).items():
+            if name.endswith("_QUERY") and isinstance(value, str) and "{" not in value:
+                self.register(name, value)
+
+    def compile(self, sql: str) -> CompiledQuery:
+        compiled = self._named.get(sql)
+        if compiled is not None:
+            return compiled
+
+        compiled = self._adhoc.get(sql)
+        if compiled is not None:
+            self._adhoc.move_to_end(sql)
+            return compiled
+
+        compiled = self._adhoc[sql] = compile_query(sql)
+        if len(self._adhoc) > self.max_adhoc:
+            self._adhoc.popitem(last=False)
+
+        return compiled
+
+
+QUERIES = QueryRegistry()
+
+
+class StatementCache:
+    """
+    Runs compiled queries on a pooled connection and accounts for asyncpg's statement cache. asyncpg prepares
+    every statement server-side and keeps the last `statement_cache_size` of them per connection; pooled
+    connections outlive requests and the reset on release does not deallocate them, so a hot query is parsed and
+    planned once per connection rather than on every call. asyncpg also re-prepares statements invalidated by a
+    schema change.
+
+    asyncpg has no public view of its cache, so hits are counted against a mirror of it: an LRU of the same size
+    per connection. The pool is created with no statement lifetime so that only the LRU evicts.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._seen = WeakKeyDictionary()  # type: WeakKeyDictionary[asyncpg.Connection, OrderedDict[str, None]]
+
+    def _record_lookup(self, connection: asyncpg.Connection, sql: str) -> None:
+        if self.max_size <= 0:
+            return
+
+        # The pool hands out a fresh proxy on every acquire; the cache belongs to the connection behind it
+        seen = self._seen.setdefault(getattr(connection, "_con", None) or connection, OrderedDict())
+        if sql in seen:
+            seen.move_to_end(sql)
+            self.hits += 1
+            DB_STATEMENT_CACHE_HITS.inc()
+            return
+
+        seen[sql] = None
+        if len(seen) > self.max_size:
+            seen.popitem(last=False)
+        self.misses += 1
+        DB_STATEMENT_CACHE_MISSES.inc()
+
+    async def run(self, connection: asyncpg.Connection, compiled: CompiledQuery, values: Optional[Mapping],
+                  method: str, **kwargs: Any) -> Any:
+        """
+        Call `method` (fetch, fetchrow or fetchval) of the connection with the compiled statement
+        """
+        arguments = compiled.arguments(values)
+        self._record_lookup(connection, compiled.sql)
+        return await getattr(connection, method)(compiled.sql, *arguments, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "max_size": self.max_size,
+            "connections": len(self._seen),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+        }
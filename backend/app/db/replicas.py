@@ -0,0 +1,149 @@
+import asyncio
+import itertools
+from typing import Any, Callable, Dict, List, Optional
+
+import asyncpg
+from databases import Database, DatabaseURL
+from loguru import logger
+
+from app.db.pool import PoolAcquireTimeout, get_pool
+
+ROUND_ROBIN = "round_robin"
+LEAST_LOADED = "least_loaded"
+
+# Errors after which a replica is taken out of rotation and the query is retried on the primary
+REPLICA_FAILURE_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    PoolAcquireTimeout,
+    asyncpg.exceptions.InterfaceError,
+    asyncpg.exceptions.PostgresConnectionError,
+    asyncpg.exceptions.CannotConnectNowError,
+)
+
+# Seconds the replica is behind the primary. A replica that has replayed everything it received is not behind,
+# however long ago the last write on the primary was.
+REPLICA_LAG_QUERY = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END;
+"""
+
+
+class Replica:
+    def __init__(self, url: str, database: Database) -> None:
+        self.url = url
+        self.database = database
+        self.connected = False
+        self.healthy = False
+        self.lag_seconds = None  # type: Optional[float]
+
+    @property
+    def name(self) -> str:
+        url = DatabaseURL(self.url)
+        return f"{url.hostname}:{url.port or 5432}/{url.database}"
+
+    def load(self) -> int:
+        pool = get_pool(self.database)
+        return pool.in_use + pool.waiting if pool is not None else 0
+
+
+class ReplicaSet:
+    """
+    Read replicas repositories may send read-only queries to. Only healthy replicas are handed out: a replica
+    is taken out of rotation when it cannot be reached, fails a query, or lags more than `max_lag_seconds`
+    behind the primary, and put back once a later check passes. With no healthy replica reads go to the primary.
+    """
+
+    def __init__(
+        self,
+        replicas: List[Replica],
+        *,
+        selection: str = ROUND_ROBIN,
+        max_lag_seconds: Optional[float] = None,
+        check_timeout: float = 2.0,
+        on_connect: Callable[[Database], Any] = None,
+    ) -> None:
+        if selection not in (ROUND_ROBIN, LEAST_LOADED):
+            raise ValueError(f"unknown replica selection {selection!r}")
+
+        self.replicas = replicas
+        self.selection = selection
+        self.max_lag_seconds = max_lag_seconds
+        self.check_timeout = check_timeout
+        self._on_connect = on_connect
+        self._turn = itertools.count()
+        self._watcher = None  # type: Optional[asyncio.Future]
+
+    def choose(self) -> Optional[Database]:
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+
+        if self.selection == LEAST_LOADED:
+            return min(healthy, key=lambda replica: replica.load()).database
+
+        return healthy[next(self._turn) % len(healthy)].database
+
+    def mark_unhealthy(self, database: Database, error: Exception) -> None:
+        for replica in self.replicas:
+            if replica.database is database and replica.healthy:
+                replica.healthy = False
+                logger.warning(f"replica {replica.name} taken out of rotation: {error!r}")
+
+    async def check(self, replica: Replica) -> None:
+        try:
+            if not replica.connected:
+                await asyncio.wait_for(replica.database.connect(), self.check_timeout)
+                replica.connected = True
+                if self._on_connect is not None:
+                    self._on_connect(replica.database)
+
+            lag = await asyncio.wait_for(replica.database.fetch_val(REPLICA_LAG_QUERY), self.check_timeout)
+        except Exception as e:
+            self.mark_unhealthy(replica.database, e)
+            return
+
+        replica.lag_seconds = float(lag)
+        if self.max_lag_seconds is not None and replica.lag_seconds > self.max_lag_seconds:
+            self.mark_unhealthy(replica.database, RuntimeError(f"{replica.lag_seconds:.1f}s behind the primary"))
+        elif not replica.healthy:
+            replica.healthy = True
+            logger.info(f"replica {replica.name} in rotation")
+
+    async def check_all(self) -> None:
+        await asyncio.gather(*(self.check(replica) for replica in self.replicas))
+
+    async def _watch(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            await self.check_all()
+
+    async def start(self, check_interval: float) -> None:
+        await self.check_all()
+        self._watcher = asyncio.ensure_future(self._watch(check_interval))
+
+    async def stop(self) -> None:
+        if self._watcher is not None:
+            self._watcher.cancel()
+
+        for replica in self.replicas:
+            if replica.connected:
+                try:
+                    await replica.database.disconnect()
+                except Exception as e:
+                    logger.warning(f"closing replica {replica.name}: {e!r}")
+                replica.connected = replica.healthy = False
+
+    def stats(self) -> List[Dict[str, Any]]:
+        stats = []
+        for replica in self.replicas:
+            pool = get_pool(replica.database) if replica.connected else None
+            stats.append({
+                "name": replica.name,
+                "healthy": replica.healthy,
+                "lag_seconds": replica.lag_seconds,
+                "pool": pool.stats() if pool is not None else None,
+            })
+        return stats
@@ -1,6 +1,468 @@
+import asyncio
+import functools
+import inspect
+import sys
+import time
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, Iterable, List, Mapping, Optional, Sequence
+
 from databases import Database
+from databases.core import Connection
+from loguru import logger
+
+from app.core.context import DeadlineExceeded, get_request_context
+from app.core.metrics import observe_db_query
+from app.db.cache import CacheBackend
+from app.db.coalescing import ReadCoalescer
+from app.db.pool import get_pool
+from app.db.queries import QUERIES, CompiledQuery, StatementCache
+from app.db.replicas import REPLICA_FAILURE_ERRORS, ReplicaSet
+
+EXPLAIN_QUERY_PREFIX = "EXPLAIN (ANALYZE, BUFFERS) "
+
+# Chunks of COPY output held while the consumer is busy; past that the COPY waits, and so does the server
+COPY_OUT_BUFFERED_CHUNKS = 16
+
+# Public repository method currently running, used to label the queries it issues
+_repository_method = ContextVar("repository_method", default="unknown")  # type: ContextVar[str]
+
+
+def _parameter_shapes(values: Optional[dict]) -> Dict[str, str]:
+    """
+    Types (and lengths of arrays) of the bound parameters; the values themselves are never logged
+    """
+    shapes = {}
+    for key, value in (values or {}).items():
+        if isinstance(value, (list, tuple)):
+            shapes[key] = f"{type(value).__name__}[{len(value)}]"
+        else:
+            shapes[key] = type(value).__name__
+    return shapes
+
+
+def _frozen_values(values: Optional[dict]) -> tuple:
+    return tuple(sorted(
+        (key, tuple(value) if isinstance(value, list) else value) for key, value in (values or {}).items()
+    ))
+
+
+async def _before_deadline(awaitable: Awaitable, deadline: Optional[float]) -> Any:
+    """
+    Await `awaitable`, cancelled when the monotonic `deadline` passes. Cancelling a query makes asyncpg ask the
+    server to cancel it too, so it ends as a statement_timeout would, and its connection goes back to the pool.
+    """
+    if deadline is None:
+        return await awaitable
+
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        if inspect.iscoroutine(awaitable):
+            awaitable.close()
+        raise DeadlineExceeded("the request deadline passed before the query ran")
+
+    # A timer cancelling this task rather than asyncio.wait_for, which would run every query in a task of its own
+    task = asyncio.current_task()
+    expired = False
+
+    def expire() -> None:
+        nonlocal expired
+        expired = True
+        task.cancel()
+
+    timer = asyncio.get_event_loop().call_later(remaining, expire)
+    try:
+        return await awaitable
+    except asyncio.CancelledError:
+        if expired:
+            raise DeadlineExceeded(f"query cancelled at the request deadline, after {remaining:.3f}s")
+        raise
+    finally:
+        timer.cancel()
+
+
+class InstrumentedDatabase:
+    """
+    Stands in for `databases.Database` inside repositories and times every query, labelled with the repository
+    and the repository method that issued it. Timings go to the metrics and to the current request's totals, and
+    queries slower than `slow_query_ms` are logged, optionally with their EXPLAIN (ANALYZE, BUFFERS) plan.
+    When the pool has a statement cache, SQL strings skip `databases`' SQLAlchemy compilation and run as prepared
+    statements of the connection `databases` would have used, so transactions still apply.
+    With a `fallback`, queries failing for connection reasons are reported to `on_failure` and retried there; that
+    is how reads from a replica fail over to the primary.
+    With a `coalescer`, fetches outside of transactions join an identical one in flight; only give it to
+    databases that serve reads.
+    With a `deadline` (time.monotonic()), queries still running then are cancelled and raise DeadlineExceeded.
+    Streams (`iterate`, `copy_from_query`) are not bounded: they last as long as their consumer reads.
+    Anything else (transactions, connections) goes to the database.
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        repository: str,
+        *,
+        slow_query_ms: float = None,
+        explain_slow_queries: bool = False,
+        fallback: "InstrumentedDatabase" = None,
+        on_failure: Callable[[Database, Exception], None] = None,
+        coalescer: ReadCoalescer = None,
+        deadline: float = None,
+    ) -> None:
+        self._db = db
+        self._repository = repository
+        self._slow_query_seconds = slow_query_ms / 1000 if slow_query_ms is not None else None
+        self._explain_slow_queries = explain_slow_queries
+        self._fallback = fallback
+        self._on_failure = on_failure
+        self._coalescer = coalescer
+        self._deadline = deadline
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._db, name)
+
+    def _observe(self, method: str, seconds: float) -> None:
+        observe_db_query(self._repository, method, seconds)
+        context = get_request_context()
+        if context is not None:
+            context.record_query(seconds)
+
+    def _is_slow(self, seconds: float) -> bool:
+        return self._slow_query_seconds is not None and seconds >= self._slow_query_seconds
+
+    def _log_slow_query(self, method: str, query: Any, values: Optional[dict], seconds: float) -> None:
+        name = QUERIES.compile(query).name if isinstance(query, str) else None
+        statement = " ".join(str(query).split())
+        logger.warning(
+            f"slow query {self._repository}.{method} [{name or 'adhoc'}] took {seconds * 1000:.1f}ms "
+            f"params={_parameter_shapes(values)}: {statement}"
+        )
+
+    async def _explain(self, method: str, query: Any, values: Optional[dict]) -> None:
+        """
+        ANALYZE runs the statement again, so do it in a transaction that is always rolled back
+        """
+        if not isinstance(query, str):
+            return
+
+        try:
+            async with self._db.transaction(force_rollback=True):
+                plan = await self._db.fetch_all(query=EXPLAIN_QUERY_PREFIX + query, values=values)
+        except Exception as e:
+            logger.warning(f"could not explain slow query {self._repository}.{method}: {e!r}")
+            return
+
+        logger.warning(f"plan of slow query {self._repository}.{method}:\n" + "\n".join(row[0] for row in plan))
+
+    async def _timed(self, call: Callable, query: Any, values: Any, **kwargs: Any) -> Any:
+        method, started = _repository_method.get(), time.perf_counter()
+        try:
+            result = await call(query=query, values=values, **kwargs)
+        finally:
+            seconds = time.perf_counter() - started
+            self._observe(method, seconds)
+            slow = self._is_slow(seconds)
+            if slow:
+                self._log_slow_query(method, query, values if isinstance(values, dict) else None, seconds)
+
+        if slow and self._explain_slow_queries and not isinstance(values, list):
+            await self._explain(method, query, values)
+
+        return result
+
+    def _statements(self) -> Optional[StatementCache]:
+        pool = get_pool(self._db)
+        return pool.statements if pool is not None else None
+
+    async def _execute(self, db_method: str, statement_method: str, query: Any, values: Optional[dict],
+                       **kwargs: Any) -> Any:
+        statements = self._statements()
+        if statements is None or not isinstance(query, str):
+            return await getattr(self._db, db_method)(query=query, values=values, **kwargs)
+
+        compiled = QUERIES.compile(query)
+        async with self._db.connection() as connection:
+            # Tasks sharing a context share the connection; take the lock `databases` holds around its own queries
+            async with connection._query_lock:
+                return await statements.run(connection.raw_connection, compiled, values, statement_method, **kwargs)
+
+    def _runner(self, db_method: str, statement_method: str) -> Callable:
+        async def run(query: Any, values: Optional[dict], **kwargs: Any) -> Any:
+            try:
+                return await self._execute(db_method, statement_method, query, values, **kwargs)
+            except REPLICA_FAILURE_ERRORS as e:
+                if self._fallback is None:
+                    raise
+                if self._on_failure is not None:
+                    self._on_failure(self._db, e)
+
+            return await self._fallback._execute(db_method, statement_method, query, values, **kwargs)
+
+        return run
+
+    @property
+    def database(self) -> Database:
+        return self._db
+
+    def _coalescing_key(self, query: Any, values: Optional[dict], *args: Any) -> Optional[Hashable]:
+        if self._coalescer is None or not isinstance(query, str):
+            return None
+        # Reads within a transaction may depend on its writes, or be expected to take locks
+        connection = self._db._connection_context.get(None)
+        if connection is not None and connection._transaction_stack:
+            return None
+
+        key = (id(self._db), query, _frozen_values(values), *args)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    async def _fetch(self, db_method: str, statement_method: str, query: Any, values: Optional[dict],
+                     **kwargs: Any) -> Any:
+        def fetch() -> Awaitable:
+            return self._timed(self._runner(db_method, statement_method), query, values, **kwargs)
+
+        key = self._coalescing_key(query, values, db_method, *kwargs.values())
+        if key is None:
+            return await _before_deadline(fetch(), self._deadline)
+
+        async def fetch_for_everyone() -> Any:
+            # Runs in a task of its own answering other requests too: it must not share the connection of the
+            # request that started it, nor leave that one unusable when acquiring fails
+            self._db._connection_context.set(Connection(self._db._backend))
+            return await fetch()
+
+        # Only this request stops waiting at its deadline, the query goes on for the others
+        return await _before_deadline(self._coalescer.single_flight(key, fetch_for_everyone), self._deadline)
+
+    async def fetch_all(self, query: Any, values: dict = None) -> List[Mapping]:
+        return await self._fetch("fetch_all", "fetch", query, values)
+
+    async def fetch_one(self, query: Any, values: dict = None) -> Optional[Mapping]:
+        return await self._fetch("fetch_one", "fetchrow", query, values)
+
+    async def fetch_val(self, query: Any, values: dict = None, column: Any = 0) -> Any:
+        return await self._fetch("fetch_val", "fetchval", query, values, column=column)
+
+    async def execute(self, query: Any, values: dict = None) -> Any:
+        return await _before_deadline(self._timed(self._runner("execute", "fetchval"), query, values), self._deadline)
+
+    async def execute_many(self, query: Any, values: list) -> None:
+        return await _before_deadline(self._timed(self._db.execute_many, query, values), self._deadline)
+
+    async def copy_records_to_table(self, table: str, *, records: Iterable[tuple], columns: Sequence[str]) -> str:
+        """
+        Binary COPY of `records` into `table` on the connection `databases` would have used, so transactions apply
+        """
+        method, started = _repository_method.get(), time.perf_counter()
+        try:
+            async with self._db.connection() as connection:
+                async with connection._query_lock:
+                    return await _before_deadline(
+                        connection.raw_connection.copy_records_to_table(table, records=records, columns=columns),
+                        self._deadline,
+                    )
+        finally:
+            self._observe(method, time.perf_counter() - started)
+
+    def copy_from_query(self, query: str, values: dict = None, **options: Any) -> "CopyOut":
+        """
+        COPY (`query`) TO STDOUT, streamed; `options` are asyncpg's COPY options (format, header, ...). As with
+        `iterate`, create it inside the repository method.
+        """
+        return CopyOut(self, QUERIES.compile(query), values, options, _repository_method.get())
+
+    def iterate(self, query: Any, values: dict = None) -> AsyncIterator[Mapping]:
+        """
+        Only the time spent waiting on the cursor counts, not the time the consumer spends between rows. The method
+        label is taken when the iterator is created, so create it inside the repository method.
+        """
+        return self._iterate(query, values, _repository_method.get())
+
+    async def _iterate(self, query: Any, values: Optional[dict], method: str) -> AsyncIterator[Mapping]:
+        records = self._db.iterate(query=query, values=values).__aiter__()
+        seconds = 0.0
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    record = await records.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    seconds += time.perf_counter() - started
+                yield record
+        finally:
+            self._observe(method, seconds)
+            if self._is_slow(seconds):
+                self._log_slow_query(method, query, values, seconds)
+
+
+class CopyOut:
+    """
+    Output of a COPY ... TO STDOUT as an async iterator of byte chunks. asyncpg pushes the output to a callback, so
+    the COPY runs in a task of its own feeding a bounded queue; a consumer that stops early cancels it. `rows` is
+    the number of rows copied once the output has been consumed.
+    """
+
+    def __init__(self, database: InstrumentedDatabase, compiled: CompiledQuery, values: Optional[dict],
+                 options: Dict[str, Any], method: str) -> None:
+        self._database = database
+        self._compiled = compiled
+        self._values = values
+        self._options = options
+        self._method = method
+        self.rows = None  # type: Optional[int]
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self._stream()
+
+    async def _copy(self, chunks: asyncio.Queue) -> None:
+        async def output(data: bytearray) -> None:
+            await chunks.put(bytes(data))
+
+        db, started = self._database._db, time.perf_counter()
+        try:
+            async with db.connection() as connection:
+                async with connection._query_lock:
+                    status = await connection.raw_connection.copy_from_query(
+                        self._compiled.sql, *self._compiled.arguments(self._values), output=output,
+                        **self._options
+                    )
+        except Exception as e:
+            await chunks.put(e)
+        else:
+            # "COPY <rows>"
+            await chunks.put(int(status.split()[-1]))
+        finally:
+            self._database._observe(self._method, time.perf_counter() - started)
+
+    async def _stream(self) -> AsyncIterator[bytes]:
+        chunks = asyncio.Queue(maxsize=COPY_OUT_BUFFERED_CHUNKS)  # type: asyncio.Queue
+        copying = asyncio.ensure_future(self._copy(chunks))
+        try:
+            while True:
+                chunk = await chunks.get()
+                if isinstance(chunk, Exception):
+                    raise chunk
+                if isinstance(chunk, int):
+                    self.rows = chunk
+                    return
+                yield chunk
+        finally:
+            copying.cancel()
+            await asyncio.gather(copying, return_exceptions=True)
+
+
+def _label_queries(method: Callable, name: str) -> Callable:
+    if inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def labelled(*args, **kwargs):
+            token = _repository_method.set(name)
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                _repository_method.reset(token)
+    else:
+        @functools.wraps(method)
+        def labelled(*args, **kwargs):
+            token = _repository_method.set(name)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                _repository_method.reset(token)
+
+    return labelled
 
 
 class BaseRepository:
-    def __init__(self, db: Database) -> None:
-        self.db = db
+    def __init__(
+        self,
+        db: Database,
+        cache: Optional[CacheBackend] = None,
+        *,
+        trust_rows: bool = False,
+        slow_query_ms: float = None,
+        explain_slow_queries: bool = False,
+        replicas: ReplicaSet = None,
+        read_primary: bool = False,
+        coalescer: ReadCoalescer = None,
+        deadline: float = None,
+    ) -> None:
+        self.db = InstrumentedDatabase(
+            db,
+            type(self).__name__,
+            slow_query_ms=slow_query_ms,
+            explain_slow_queries=explain_slow_queries,
+            deadline=deadline,
+        )
+        # Read-only methods query `read_db`: a replica when one is healthy, unless this client must read its own
+        # writes, and the primary otherwise. Only those reads are coalesced, like the ones of `primary_read_db`.
+        self.read_primary = read_primary
+        replica = replicas.choose() if replicas is not None and not read_primary else None
+        if coalescer is None:
+            self.primary_read_db = self.db
+        else:
+            self.primary_read_db = InstrumentedDatabase(
+                db,
+                type(self).__name__,
+                slow_query_ms=slow_query_ms,
+                explain_slow_queries=explain_slow_queries,
+                coalescer=coalescer,
+                deadline=deadline,
+            )
+        if replica is None:
+            self.read_db = self.primary_read_db
+        else:
+            self.read_db = InstrumentedDatabase(
+                replica,
+                type(self).__name__,
+                slow_query_ms=slow_query_ms,
+                explain_slow_queries=explain_slow_queries,
+                fallback=self.db,
+                on_failure=replicas.mark_unhealthy,
+                coalescer=coalescer,
+                deadline=deadline,
+            )
+        self.cache = cache
+        self.coalescer = coalescer
+        # When set, rows are turned into models without validation (see FAST_SERIALIZATION)
+        self.trust_rows = trust_rows
+
+    @property
+    def batching(self) -> bool:
+        return self.coalescer is not None and self.coalescer.batching
+
+    async def _load_batched(
+            self,
+            name: str,
+            key: Hashable,
+            load_many: Callable[[List[Hashable]], Awaitable[Dict[Hashable, Any]]],
+            database: InstrumentedDatabase = None,
+    ) -> Any:
+        """
+        Look `key` up with `load_many` together with the concurrent lookups of `name` on `database` (`read_db` by
+        default); only when `batching`
+        """
+        database = database if database is not None else self.read_db
+        group = (type(self).__name__, name, id(database.database), self.trust_rows)
+        return await self.coalescer.load(group, key, load_many)
+
+    def _forget_reads(self) -> None:
+        """
+        Called after writes, so this worker's next reads do not join ones that started before
+        """
+        if self.coalescer is not None:
+            self.coalescer.forget()
+
+    def __init_subclass__(cls, **kwargs: Any) -> None:
+        """
+        Label the queries of every public method so DB timings can be broken down per repository method, and
+        register the repository module's queries so each is compiled once
+        """
+        super().__init_subclass__(**kwargs)
+        QUERIES.register_module(sys.modules[cls.__module__])
+        for name, attribute in list(vars(cls).items()):
+            if not name.startswith("_") and inspect.isfunction(attribute):
+                setattr(cls, name, _label_queries(attribute, name))
@@ -1,91 +1,827 @@
-from typing import List
+import asyncio
+import json
+from contextlib import suppress
+from decimal import Decimal, InvalidOperation
+from typing import AsyncIterable, AsyncIterator, Dict, Iterable, List, Optional, Sequence, Tuple
 
+import asyncpg
+from databases import Database
 from fastapi import HTTPException, status
 from pydantic import parse_obj_as
 from loguru import logger
 
-from app.db.repositories.base import BaseRepository
-from app.models.cleaning import CleaningCreate, CleaningInDB, CleaningUpdate
+from app.db.cache import CacheBackend
+from app.db.notifications import NotificationHandler
+from app.db.repositories.base import BaseRepository, CopyOut, InstrumentedDatabase
+from app.models.cleaning import (
+    CLEANING_FIELDS, CleaningBatchUpdate, CleaningChange, CleaningCreate, CleaningFilter, CleaningInDB,
+    CleaningPublic, CleaningStats, CleaningTypeStats, CleaningUpdate, cleaning_fields_model,
+)
+from app.models.enum_type import BulkFormat, CleaningSort, CleaningType
 
 CREATE_CLEANING_QUERY = """
     INSERT INTO cleanings (name, description, price, cleaning_type)
     VALUES (:name, :description, :price, :cleaning_type)
-    RETURNING id, name, description, price, cleaning_type
+    RETURNING id, name, description, price, cleaning_type, version, updated_at
 """
 
 GET_CLEANING_BY_ID_QUERY = """
-    SELECT id, name, description, price, cleaning_type
+    SELECT id, name, description, price, cleaning_type, version, updated_at
     FROM cleanings
     WHERE id = :id
 """
 
+GET_CLEANINGS_BY_IDS_QUERY = """
+    SELECT id, name, description, price, cleaning_type, version, updated_at
+    FROM cleanings
+    WHERE id = ANY(:ids)
+"""
+
+# Lists select every column unless the client picked fields, see _projection
+CLEANING_COLUMNS = "id, name, description, cleaning_type, price, version, updated_at"
+
 GET_ALL_CLEANINGS_QUERY = """
-    SELECT id, name, description, cleaning_type, price
+    SELECT {columns}
+    FROM cleanings
+    {where}
+    ORDER BY {order}
+    LIMIT :limit
+"""
+
+ITERATE_CLEANINGS_QUERY = """
+    SELECT {columns}
+    FROM cleanings
+    {where}
+    ORDER BY {order}
+"""
+
+# JSON text escapes every control character, so with these as quote and delimiter COPY's CSV output is the
+# documents exactly, one per line
+EXPORT_CLEANINGS_NDJSON_QUERY = """
+    SELECT json_build_object(
+        'id', id, 'name', name, 'description', description, 'cleaning_type', cleaning_type, 'price', price,
+        'version', version, 'updated_at', updated_at
+    )
     FROM cleanings
+    {where}
+    ORDER BY {order}
 """
+NDJSON_COPY_OPTIONS = {"format": "csv", "quote": "\x01", "delimiter": "\x02"}
 
+# Only the columns sent by the client are assigned, so a partial update is a single statement
 UPDATE_CLEANING_BY_ID_QUERY = """
     UPDATE cleanings
-    
-    SET name = :name,
-        description = :description,
-        price = :price,
-        cleaning_type = :cleaning_type
-        
-    WHERE id = :id
-    RETURNING id, name, description, price, cleaning_type
+
+    SET {assignments},
+        version = version + 1,
+        updated_at = now()
+
+    WHERE id = :id {version_condition}
+    RETURNING id, name, description, price, cleaning_type, version, updated_at
 """
 
 DELETE_CLEANING_BY_ID_QUERY = """
     DELETE FROM cleanings
+    WHERE id = :id {version_condition}
+    RETURNING id
+"""
+
+GET_CLEANING_VERSION_QUERY = """
+    SELECT version
+    FROM cleanings
     WHERE id = :id
+"""
+
+# See the add-table-version-bumps migration
+GET_CLEANINGS_TABLE_VERSION_QUERY = """
+    SELECT table_version('cleanings')
+"""
+
+# A few rows per cleaning type, plus the deltas of the writes since the last refresh, see the add-cleaning-stats
+# and add-cleaning-stats-deltas migrations
+GET_CLEANING_STATS_QUERY = """
+    SELECT stats.cleaning_type,
+           stats.count,
+           round(stats.price_sum / NULLIF(stats.count, 0), 2) AS average_price,
+           distribution.min_price,
+           distribution.max_price,
+           distribution.p50_price,
+           distribution.p90_price,
+           distribution.p99_price,
+           distribution.refreshed_at
+    FROM cleaning_stats_totals AS stats
+    LEFT JOIN cleaning_price_distribution AS distribution USING (cleaning_type)
+"""
+
+REFRESH_CLEANING_PRICE_DISTRIBUTION_QUERY = """
+    SELECT refresh_cleaning_price_distribution()
+"""
+
+# Changes are only read once every transaction with a lower txid has finished, see the add-cleaning-changes
+# migration. Changes carry the cleaning as it is now, which may be at a later version than the change.
+GET_CLEANING_CHANGES_QUERY = """
+    SELECT changes.txid, changes.id, changes.op, changes.cleaning_id, changes.version, changes.changed_at,
+           cleanings.id AS current_id, cleanings.name, cleanings.description, cleanings.price,
+           cleanings.cleaning_type, cleanings.version AS current_version, cleanings.updated_at
+    FROM cleaning_changes AS changes
+    LEFT JOIN cleanings ON cleanings.id = changes.cleaning_id AND changes.op <> 'delete'
+    WHERE (changes.txid, changes.id) > (:after_txid, :after_id)
+      AND changes.txid < txid_snapshot_xmin(txid_current_snapshot())
+    ORDER BY changes.txid, changes.id
+    LIMIT :limit
+"""
+
+GET_CLEANING_CHANGES_HEAD_QUERY = """
+    SELECT txid, id
+    FROM cleaning_changes
+    WHERE txid < txid_snapshot_xmin(txid_current_snapshot())
+    ORDER BY txid DESC, id DESC
+    LIMIT 1
+"""
+
+# Pruning removes a prefix of the log but keeps its last change, which marks how far the log was pruned: a cursor
+# is good as long as some change at or before it is left
+CLEANING_CHANGE_RETAINED_QUERY = """
+    SELECT EXISTS (
+        SELECT 1
+        FROM cleaning_changes
+        WHERE (txid, id) <= (:txid, :id)
+    )
+"""
+
+PRUNE_CLEANING_CHANGES_QUERY = """
+    WITH pruned AS (
+        DELETE FROM cleaning_changes
+        WHERE (txid, id) < (
+            SELECT txid, id
+            FROM cleaning_changes
+            WHERE changed_at < now() - make_interval(secs => :retention_seconds)
+            ORDER BY txid DESC, id DESC
+            LIMIT 1
+        )
+        RETURNING 1
+    )
+    SELECT count(*) FROM pruned
+"""
+
+VERSION_CONDITION = "AND version = ANY(:versions)"
+
+UPDATABLE_CLEANING_COLUMNS = ("name", "description", "price", "cleaning_type")
+COPY_CLEANING_COLUMNS = ("name", "description", "price", "cleaning_type")
+
+# Imports are COPYed into a temporary table of their connection first, which locks nothing and fires no trigger,
+# and published by one INSERT once the whole upload is read. In the order of the upload: the table is only ever
+# appended to, so its physical order is the order of the COPYs.
+CREATE_CLEANINGS_IMPORT_TABLE_QUERY = """
+    CREATE TEMPORARY TABLE cleanings_import AS
+    SELECT name, description, price, cleaning_type
+    FROM cleanings
+    WITH NO DATA
+"""
+
+PUBLISH_CLEANINGS_IMPORT_QUERY = """
+    INSERT INTO cleanings (name, description, price, cleaning_type)
+    SELECT name, description, price, cleaning_type
+    FROM cleanings_import
+    ORDER BY ctid
+"""
+
+DROP_CLEANINGS_IMPORT_TABLE_QUERY = """
+    DROP TABLE IF EXISTS cleanings_import
+"""
+
+# Batches are sent as one array per column and expanded with unnest, so a batch of any size is a
+# single statement with a fixed number of parameters
+BULK_CREATE_CLEANINGS_QUERY = """
+    INSERT INTO cleanings (name, description, price, cleaning_type)
+    SELECT name, description, price, cleaning_type
+    FROM unnest(
+        CAST(:names AS text[]),
+        CAST(:descriptions AS text[]),
+        CAST(:prices AS numeric[]),
+        CAST(:cleaning_types AS varchar[])
+    ) WITH ORDINALITY AS new_cleanings (name, description, price, cleaning_type, position)
+    ORDER BY position
+    RETURNING id, name, description, price, cleaning_type, version, updated_at
+"""
+
+BULK_UPDATE_CLEANINGS_QUERY = """
+    UPDATE cleanings
+    SET name = COALESCE(updates.name, cleanings.name),
+        description = COALESCE(updates.description, cleanings.description),
+        price = COALESCE(updates.price, cleanings.price),
+        cleaning_type = COALESCE(updates.cleaning_type, cleanings.cleaning_type),
+        version = cleanings.version + 1,
+        updated_at = now()
+    FROM unnest(
+        CAST(:ids AS integer[]),
+        CAST(:names AS text[]),
+        CAST(:descriptions AS text[]),
+        CAST(:prices AS numeric[]),
+        CAST(:cleaning_types AS varchar[])
+    ) AS updates (id, name, description, price, cleaning_type)
+    WHERE cleanings.id = updates.id
+    RETURNING cleanings.id, cleanings.name, cleanings.description, cleanings.price, cleanings.cleaning_type,
+              cleanings.version, cleanings.updated_at
+"""
+
+BULK_DELETE_CLEANINGS_QUERY = """
+    DELETE FROM cleanings
+    WHERE id = ANY(:ids)
     RETURNING id
 """
 
+# Must match the expression of idx_cleanings_description_fts for the index to be used
+DESCRIPTION_SEARCH_CONDITION = (
+    "to_tsvector('english', coalesce(description, '')) @@ plainto_tsquery('english', :search)"
+)
+
+# Whitelisted sort orders mapped to (column, direction); id always breaks ties so keysets are unique
+CLEANING_SORT_COLUMNS = {
+    CleaningSort.id: ("id", "ASC"),
+    CleaningSort.id_desc: ("id", "DESC"),
+    CleaningSort.name: ("name", "ASC"),
+    CleaningSort.name_desc: ("name", "DESC"),
+    CleaningSort.price: ("price", "ASC"),
+    CleaningSort.price_desc: ("price", "DESC"),
+}
+
+
+CLEANING_CACHE_NAMESPACE = "cleaning"
+CLEANINGS_LIST_CACHE_NAMESPACE = "cleanings"
+CLEANING_STATS_CACHE_NAMESPACE = "cleaning_stats"
+
+# Published by the notify_cleanings_changed trigger after every write statement on cleanings
+CLEANINGS_CHANGED_CHANNEL = "cleanings_changed"
+# Published by the record_cleaning_changes trigger, with an empty payload, after every write statement on cleanings
+CLEANING_CHANGES_CHANNEL = "cleaning_changes"
+# Published by refresh_cleaning_price_distribution() whenever it recomputed the distribution
+CLEANING_STATS_REFRESHED_CHANNEL = "cleaning_stats_refreshed"
+
+
+async def invalidate_cleanings_cache(cache: CacheBackend, ids: Optional[Iterable[int]]) -> None:
+    """
+    Drop every cached listing plus the given cleanings; `ids=None` drops all cached cleanings
+    """
+    await cache.invalidate_namespace(CLEANINGS_LIST_CACHE_NAMESPACE)
+    await cache.invalidate_namespace(CLEANING_STATS_CACHE_NAMESPACE)
+
+    if ids is None:
+        await cache.invalidate_namespace(CLEANING_CACHE_NAMESPACE)
+        return
+
+    for cleaning_id in ids:
+        await cache.delete(CLEANING_CACHE_NAMESPACE, cleaning_id)
+
+
+def create_cleanings_cache_handler(cache: CacheBackend) -> NotificationHandler:
+    """
+    Keep this worker's cache in sync with writes made by other workers
+    """
+    async def handle_cleanings_changed(payload: Optional[str]) -> None:
+        ids = json.loads(payload)["ids"] if payload is not None else None
+        await invalidate_cleanings_cache(cache, ids)
+
+    return handle_cleanings_changed
+
+
+def create_cleaning_stats_cache_handler(cache: CacheBackend) -> NotificationHandler:
+    """
+    Drop cached stats once any worker has refreshed the price distribution
+    """
+    async def handle_cleaning_stats_refreshed(payload: Optional[str]) -> None:
+        await cache.invalidate_namespace(CLEANING_STATS_CACHE_NAMESPACE)
+
+    return handle_cleaning_stats_refreshed
+
+
+async def refresh_cleaning_stats(database: Database, *, interval: float) -> None:
+    """
+    Keep the price distribution at most `interval` seconds behind cleanings. Every worker runs this; the database
+    function makes sure only one of them recomputes, and only after a write.
+    """
+    repository = CleaningsRepository(database)
+    while True:
+        try:
+            await repository.refresh_price_distribution()
+        except Exception as e:
+            logger.warning(f"Cannot refresh the cleaning price distribution: {e!r}")
+
+        await asyncio.sleep(interval)
+
+
+# Where a change sits in the log, (txid, id); cursors handed to clients encode it
+ChangePosition = Tuple[int, int]
+
+
+def encode_change_cursor(position: ChangePosition) -> str:
+    return f"{position[0]}-{position[1]}"
+
+
+def decode_change_cursor(cursor: str) -> ChangePosition:
+    try:
+        txid, change_id = cursor.split("-")
+        return int(txid), int(change_id)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid change cursor.")
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _parse_sort_key(column: str, key) -> object:
+    try:
+        if column == "price":
+            return Decimal(key)
+        if not isinstance(key, str):
+            raise TypeError(key)
+        return key
+    except (InvalidOperation, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor.")
+
+
+def _projection(fields: Optional[Sequence[str]], sort: CleaningSort = None) -> Optional[Tuple[str, ...]]:
+    """
+    Columns to select for `fields`, None for all of them. The id is always selected, and so is the column lists are
+    sorted by since page keys are made of them.
+    """
+    if fields is None:
+        return None
+
+    unknown = set(fields).difference(CLEANING_FIELDS)
+    if unknown:
+        # Columns are written into the query, only whitelisted ones may get there
+        raise ValueError(f"Unknown cleaning fields: {sorted(unknown)}")
+
+    selected = {*fields, "id"}
+    if sort is not None:
+        selected.add(CLEANING_SORT_COLUMNS[sort][0])
+    return tuple(name for name in CLEANING_FIELDS if name in selected)
+
+
+def _build_list_clauses(
+        filters: Optional[CleaningFilter], sort: CleaningSort, after: Optional[dict]
+) -> Tuple[str, str, dict]:
+    conditions, values = [], {}
+
+    if filters is not None:
+        if filters.cleaning_type is not None:
+            conditions.append("cleaning_type = :cleaning_type")
+            values["cleaning_type"] = filters.cleaning_type
+        if filters.min_price is not None:
+            conditions.append("price >= :min_price")
+            values["min_price"] = Decimal(str(filters.min_price))
+        if filters.max_price is not None:
+            conditions.append("price <= :max_price")
+            values["max_price"] = Decimal(str(filters.max_price))
+        if filters.name_prefix is not None:
+            conditions.append("name LIKE :name_prefix")
+            values["name_prefix"] = _escape_like(filters.name_prefix) + "%"
+        if filters.search is not None:
+            conditions.append(DESCRIPTION_SEARCH_CONDITION)
+            values["search"] = filters.search
+
+    column, direction = CLEANING_SORT_COLUMNS[sort]
+    comparison = ">" if direction == "ASC" else "<"
+
+    if after is not None:
+        if after.get("sort", CleaningSort.id.value) != sort.value:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail="Pagination cursor does not match the requested sort.")
+
+        values["after_id"] = after["id"]
+        if column == "id":
+            conditions.append(f"id {comparison} :after_id")
+        else:
+            conditions.append(f"({column}, id) {comparison} (:after_key, :after_id)")
+            values["after_key"] = _parse_sort_key(column, after.get("key"))
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    order = f"{column} {direction}, id {direction}" if column != "id" else f"id {direction}"
+
+    return where, order, values
+
 
 class CleaningsRepository(BaseRepository):
+    def _to_cleaning(self, record, fields: Tuple[str, ...] = None) -> CleaningInDB:
+        """
+        Rows come from our own SQL and already have the model's shape, so the fast path skips validation. Rows of
+        only some `fields` make a model of just those.
+        """
+        model = CleaningInDB if fields is None else cleaning_fields_model(fields)
+        if not self.trust_rows:
+            return model.parse_obj(record)
+
+        values = dict(record)
+        if "price" in values:
+            values["price"] = float(values["price"])
+        return model.construct(**values)
+
+    def _to_cleanings(self, records, fields: Tuple[str, ...] = None) -> List[CleaningInDB]:
+        if not self.trust_rows:
+            return parse_obj_as(List[CleaningInDB if fields is None else cleaning_fields_model(fields)], records)
+
+        return [self._to_cleaning(record, fields) for record in records]
+
+    async def _invalidate_cache(self, ids: Optional[Iterable[int]]) -> None:
+        self._forget_reads()
+        # Other workers catch up through the cleanings_changed notification, this covers our own next read
+        if self.cache is not None:
+            await invalidate_cleanings_cache(self.cache, ids)
+
     async def create_cleaning(self, *, new_cleaning: CleaningCreate) -> CleaningInDB:
         cleaning = await self.db.fetch_one(query=CREATE_CLEANING_QUERY, values=new_cleaning.dict())
-        return CleaningInDB.parse_obj(cleaning)
+        await self._invalidate_cache(ids=[])
+        return self._to_cleaning(cleaning)
 
-    async def get_cleaning_by_id(self, *, get_id: int):
-        cleaning = await self.db.fetch_one(query=GET_CLEANING_BY_ID_QUERY, values={"id": get_id})
+    async def create_cleanings(self, *, new_cleanings: List[CleaningCreate]) -> List[CleaningInDB]:
+        if not new_cleanings:
+            return []
 
-        if not cleaning:
-            return None
+        cleaning_records = await self.db.fetch_all(query=BULK_CREATE_CLEANINGS_QUERY, values={
+            "names": [cleaning.name for cleaning in new_cleanings],
+            "descriptions": [cleaning.description for cleaning in new_cleanings],
+            "prices": [cleaning.price for cleaning in new_cleanings],
+            "cleaning_types": [cleaning.cleaning_type for cleaning in new_cleanings],
+        })
+        await self._invalidate_cache(ids=[])
+        return self._to_cleanings(cleaning_records)
+
+    async def copy_cleanings_in(self, *, chunks: AsyncIterable[List[CleaningCreate]]) -> int:
+        """
+        COPY each chunk into a temporary table, then insert them all into cleanings at once: an import that fails
+        part way leaves nothing behind, and until then no transaction is open and no lock taken, however slowly
+        `chunks` is produced. The connection is held meanwhile. The triggers are per statement, so versions, stats
+        and notifications cost one run per import.
+        """
+        imported, copying = 0, None
+        async with self.db.connection():
+            # An import cut short may have left its table on this connection
+            await self.db.execute(DROP_CLEANINGS_IMPORT_TABLE_QUERY)
+            await self.db.execute(CREATE_CLEANINGS_IMPORT_TABLE_QUERY)
+            try:
+                async for chunk in chunks:
+                    records = [
+                        (cleaning.name, cleaning.description, Decimal(str(cleaning.price)), cleaning.cleaning_type)
+                        for cleaning in chunk
+                    ]
+                    # Each chunk is copied while the next one is produced; only one COPY runs at a time
+                    if copying is not None:
+                        await copying
+                    copying = asyncio.ensure_future(
+                        self.db.copy_records_to_table(
+                            "cleanings_import", columns=COPY_CLEANING_COLUMNS, records=records
+                        )
+                    )
+                    imported += len(chunk)
+
+                if copying is not None:
+                    await copying
+                if imported:
+                    await self.db.execute(PUBLISH_CLEANINGS_IMPORT_QUERY)
+            except BaseException:
+                if copying is not None:
+                    copying.cancel()
+                    await asyncio.gather(copying, return_exceptions=True)
+                raise
+            finally:
+                with suppress(Exception):
+                    await self.db.execute(DROP_CLEANINGS_IMPORT_TABLE_QUERY)
+
+        await self._invalidate_cache(ids=[])
+        return imported
+
+    def copy_cleanings_out(
+            self, *, format: BulkFormat, filters: CleaningFilter = None, sort: CleaningSort = CleaningSort.id
+    ) -> CopyOut:
+        """
+        Every matching cleaning as CSV (with a header) or NDJSON, encoded by Postgres and streamed as it comes
+        """
+        where, order, values = _build_list_clauses(filters, sort, None)
+        if format == BulkFormat.csv:
+            return self.read_db.copy_from_query(
+                ITERATE_CLEANINGS_QUERY.format(columns=CLEANING_COLUMNS, where=where, order=order), values,
+                format="csv", header=True,
+            )
+
+        return self.read_db.copy_from_query(
+            EXPORT_CLEANINGS_NDJSON_QUERY.format(where=where, order=order), values, **NDJSON_COPY_OPTIONS
+        )
+
+    async def update_cleanings(self, *, cleaning_updates: List[CleaningBatchUpdate]) -> List[CleaningInDB]:
+        """
+        Apply many partial updates in one statement. Ids must be unique within the batch; missing ids are skipped.
+        """
+        if not cleaning_updates:
+            return []
 
-        return CleaningInDB.parse_obj(cleaning)
+        cleaning_records = await self.db.fetch_all(query=BULK_UPDATE_CLEANINGS_QUERY, values={
+            "ids": [update.id for update in cleaning_updates],
+            "names": [update.name for update in cleaning_updates],
+            "descriptions": [update.description for update in cleaning_updates],
+            "prices": [update.price for update in cleaning_updates],
+            "cleaning_types": [update.cleaning_type for update in cleaning_updates],
+        })
+        await self._invalidate_cache(ids=[record["id"] for record in cleaning_records])
+        return self._to_cleanings(cleaning_records)
 
-    async def get_all_cleanings(self):
-        cleaning_records = await self.db.fetch_all(query=GET_ALL_CLEANINGS_QUERY)
-        return parse_obj_as(List[CleaningInDB], cleaning_records)
+    async def delete_cleanings(self, *, delete_ids: List[int]) -> List[int]:
+        if not delete_ids:
+            return []
 
-    async def update_cleaning(self, *, update_id: int, cleaning_update: CleaningUpdate) -> CleaningInDB:
-        cleaning = await self.get_cleaning_by_id(get_id=update_id)
+        deleted_records = await self.db.fetch_all(query=BULK_DELETE_CLEANINGS_QUERY, values={"ids": delete_ids})
+        deleted_ids = [record["id"] for record in deleted_records]
+        await self._invalidate_cache(ids=deleted_ids)
+        return deleted_ids
+
+    async def get_cleaning_by_id(self, *, get_id: int) -> Optional[CleaningInDB]:
+        # A client pinned to the primary reads its own writes, which other workers' caches may not have dropped yet
+        if self.cache is None or self.read_primary:
+            return await self._fetch_cleaning_by_id(get_id, self.read_db)
+
+        # Filled from the primary only: a lagging replica read right after an invalidation would put the old row
+        # back for the whole TTL
+        return await self.cache.get_or_load(
+            CLEANING_CACHE_NAMESPACE, get_id, lambda: self._fetch_cleaning_by_id(get_id, self.primary_read_db)
+        )
+
+    async def _fetch_cleaning_by_id(self, get_id: int, database: InstrumentedDatabase) -> Optional[CleaningInDB]:
+        if self.batching:
+            return await self._load_batched(
+                "get_cleaning_by_id", get_id, lambda ids: self._fetch_cleanings_by_ids(ids, database), database
+            )
+
+        cleaning = await database.fetch_one(query=GET_CLEANING_BY_ID_QUERY, values={"id": get_id})
 
         if not cleaning:
             return None
 
-        cleaning_update_params = cleaning.copy(update=cleaning_update.dict(exclude_unset=True))
-        if cleaning_update_params.cleaning_type is None:
+        return self._to_cleaning(cleaning)
+
+    async def _fetch_cleanings_by_ids(self, ids: List[int], database: InstrumentedDatabase) -> Dict[int, CleaningInDB]:
+        records = await database.fetch_all(query=GET_CLEANINGS_BY_IDS_QUERY, values={"ids": ids})
+        return {record["id"]: self._to_cleaning(record) for record in records}
+
+    async def get_all_cleanings(
+            self,
+            *,
+            limit: int,
+            filters: CleaningFilter = None,
+            sort: CleaningSort = CleaningSort.id,
+            after: dict = None,
+            fields: Sequence[str] = None,
+    ) -> List[CleaningInDB]:
+        """
+        With `fields`, only those columns are selected (with the id and the sort column) and the cleanings are
+        models of just those, see `cleaning_fields_model`
+        """
+        where, order, values = _build_list_clauses(filters, sort, after)
+        projection = _projection(fields, sort)
+        query = GET_ALL_CLEANINGS_QUERY.format(
+            columns=", ".join(projection) if projection else CLEANING_COLUMNS, where=where, order=order
+        )
+
+        async def load() -> List[CleaningInDB]:
+            cleaning_records = await self.read_db.fetch_all(query=query, values={**values, "limit": limit})
+            return self._to_cleanings(cleaning_records, projection)
+
+        if self.cache is None:
+            return await load()
+
+        cache_key = (
+            limit,
+            sort.value,
+            filters.json() if filters is not None else None,
+            json.dumps(after, sort_keys=True) if after is not None else None,
+            projection,
+        )
+        return await self.cache.get_or_load(CLEANINGS_LIST_CACHE_NAMESPACE, cache_key, load)
+
+    async def get_table_version(self) -> int:
+        """
+        Counter bumped by every write statement that changed cleanings, once it commits. Cached next to the listings,
+        which are invalidated together.
+        """
+        async def load() -> int:
+            return await self.read_db.fetch_val(query=GET_CLEANINGS_TABLE_VERSION_QUERY)
+
+        if self.cache is None:
+            return await load()
+
+        return await self.cache.get_or_load(CLEANINGS_LIST_CACHE_NAMESPACE, "table_version", load)
+
+    def iterate_cleanings(
+            self,
+            *,
+            filters: CleaningFilter = None,
+            sort: CleaningSort = CleaningSort.id,
+            after: dict = None,
+            fields: Sequence[str] = None,
+    ) -> AsyncIterator[CleaningInDB]:
+        """
+        Walk every matching cleaning after the `after` keyset through a server-side cursor, so memory use stays flat.
+        Invalid arguments raise here rather than once a streamed response has already started. `fields` are
+        projected as in `get_all_cleanings`.
+        """
+        where, order, values = _build_list_clauses(filters, sort, after)
+        projection = _projection(fields, sort)
+        records = self.read_db.iterate(
+            query=ITERATE_CLEANINGS_QUERY.format(
+                columns=", ".join(projection) if projection else CLEANING_COLUMNS, where=where, order=order
+            ),
+            values=values,
+        )
+
+        async def _iterate() -> AsyncIterator[CleaningInDB]:
+            async for record in records:
+                yield self._to_cleaning(record, projection)
+
+        return _iterate()
+
+    async def get_stats(self) -> CleaningStats:
+        """
+        Read from the summary tables kept by the database, never from cleanings itself
+        """
+        async def load() -> CleaningStats:
+            records = {
+                record["cleaning_type"]: record
+                for record in await self.read_db.fetch_all(query=GET_CLEANING_STATS_QUERY)
+            }
+            return self._to_stats(records)
+
+        if self.cache is None:
+            return await load()
+
+        return await self.cache.get_or_load(CLEANING_STATS_CACHE_NAMESPACE, "stats", load)
+
+    @staticmethod
+    def _to_stats(records: dict) -> CleaningStats:
+        types, refreshed_at = [], None
+        for cleaning_type in CleaningType:
+            record = records.get(cleaning_type.value)
+            if record is None or not record["count"]:
+                types.append(CleaningTypeStats(cleaning_type=cleaning_type, count=0))
+                continue
+
+            types.append(CleaningTypeStats.parse_obj(record))
+            if record["refreshed_at"] is not None:
+                refreshed_at = max(refreshed_at or record["refreshed_at"], record["refreshed_at"])
+
+        return CleaningStats(types=types, distribution_refreshed_at=refreshed_at)
+
+    async def refresh_price_distribution(self) -> bool:
+        """
+        Recompute the price distribution if cleanings changed since the last refresh; False when it was current or
+        another worker is already refreshing it
+        """
+        refreshed = await self.db.fetch_val(query=REFRESH_CLEANING_PRICE_DISTRIBUTION_QUERY)
+        if refreshed:
+            self._forget_reads()
+        # Other workers catch up through the cleaning_stats_refreshed notification
+        if refreshed and self.cache is not None:
+            await self.cache.invalidate_namespace(CLEANING_STATS_CACHE_NAMESPACE)
+        return refreshed
+
+    async def get_changes(self, *, after: ChangePosition, limit: int) -> List[Tuple[ChangePosition, CleaningChange]]:
+        """
+        Up to `limit` changes logged after `after`, oldest first. Read from the primary even with replicas: which
+        changes are safe to read depends on the transactions running there.
+        """
+        records = await self.db.fetch_all(query=GET_CLEANING_CHANGES_QUERY, values={
+            "after_txid": after[0], "after_id": after[1], "limit": limit,
+        })
+        return [((record["txid"], record["id"]), self._to_change(record)) for record in records]
+
+    @staticmethod
+    def _to_change(record) -> CleaningChange:
+        cleaning = None
+        if record["current_id"] is not None:
+            cleaning = CleaningPublic(
+                id=record["current_id"],
+                name=record["name"],
+                description=record["description"],
+                price=record["price"],
+                cleaning_type=record["cleaning_type"],
+                version=record["current_version"],
+                updated_at=record["updated_at"],
+            )
+
+        return CleaningChange(
+            cursor=encode_change_cursor((record["txid"], record["id"])),
+            op=record["op"],
+            cleaning_id=record["cleaning_id"],
+            version=record["version"],
+            changed_at=record["changed_at"],
+            cleaning=cleaning,
+        )
+
+    async def get_change_head(self) -> ChangePosition:
+        """
+        Position of the last change readers can see, where a subscriber without a cursor starts
+        """
+        record = await self.db.fetch_one(query=GET_CLEANING_CHANGES_HEAD_QUERY)
+        return (record["txid"], record["id"]) if record else (0, 0)
+
+    async def is_change_retained(self, *, position: ChangePosition) -> bool:
+        """
+        False once changes after `position` may have been pruned, and reading on from it would miss them
+        """
+        return await self.db.fetch_val(query=CLEANING_CHANGE_RETAINED_QUERY, values={
+            "txid": position[0], "id": position[1],
+        })
+
+    async def prune_changes(self, *, retention_seconds: float) -> int:
+        return await self.db.fetch_val(query=PRUNE_CLEANING_CHANGES_QUERY, values={
+            "retention_seconds": retention_seconds,
+        })
+
+    @staticmethod
+    def get_page_key(cleaning: CleaningInDB, *, sort: CleaningSort) -> dict:
+        """
+        Keyset identifying the position of `cleaning` in a listing ordered by `sort`
+        """
+        column, _ = CLEANING_SORT_COLUMNS[sort]
+
+        if column == "id":
+            return {"id": cleaning.id, "sort": sort.value}
+
+        return {"id": cleaning.id, "sort": sort.value, "key": str(getattr(cleaning, column))}
+
+    async def update_cleaning(
+            self, *, update_id: int, cleaning_update: CleaningUpdate, expected_versions: List[int] = None
+    ) -> Optional[CleaningInDB]:
+        """
+        Update only the fields that were sent. When `expected_versions` is given the row must still be at one of
+        those versions, otherwise nothing is written and a 412 is raised.
+        """
+        update_params = cleaning_update.dict(exclude_unset=True)
+        if "cleaning_type" in update_params and update_params["cleaning_type"] is None:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                                 detail="Invalid cleaning type. Cannot be None.")
 
+        if not update_params:
+            cleaning = await self.get_cleaning_by_id(get_id=update_id)
+            if cleaning and expected_versions is not None and cleaning.version not in expected_versions:
+                raise self._version_mismatch()
+            return cleaning
+
+        assignments = ", ".join(f"{column} = :{column}" for column in UPDATABLE_CLEANING_COLUMNS
+                                if column in update_params)
+        values = {**update_params, "id": update_id}
+        version_condition = ""
+        if expected_versions is not None:
+            version_condition = VERSION_CONDITION
+            values["versions"] = expected_versions
+
         try:
             updated_cleaning = await self.db.fetch_one(
-                query=UPDATE_CLEANING_BY_ID_QUERY, values=cleaning_update_params.dict()
+                query=UPDATE_CLEANING_BY_ID_QUERY.format(assignments=assignments, version_condition=version_condition),
+                values=values,
             )
-
-            return CleaningInDB.parse_obj(updated_cleaning)
-
-        except Exception as e:
+        except (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError) as e:
+            # Values the database rejects, such as a null name or a price out of range. Anything else, running out
+            # of time included, is not the client's input to blame.
             logger.error(e)
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid update params.")
 
-    async def delete_cleanings_by_id(self, delete_id: int):
-        cleaning = await self.get_cleaning_by_id(get_id=delete_id)
+        if not updated_cleaning:
+            await self._check_version_conflict(update_id, expected_versions)
+            return None
 
-        if not cleaning:
+        await self._invalidate_cache(ids=[update_id])
+        return self._to_cleaning(updated_cleaning)
+
+    async def delete_cleanings_by_id(self, delete_id: int, expected_versions: List[int] = None) -> Optional[int]:
+        values = {"id": delete_id}
+        version_condition = ""
+        if expected_versions is not None:
+            version_condition = VERSION_CONDITION
+            values["versions"] = expected_versions
+
+        deleted_id = await self.db.fetch_val(
+            query=DELETE_CLEANING_BY_ID_QUERY.format(version_condition=version_condition), values=values
+        )
+
+        if not deleted_id:
+            await self._check_version_conflict(delete_id, expected_versions)
             return None
 
-        return await self.db.execute(query=DELETE_CLEANING_BY_ID_QUERY, values={"id": delete_id})
+        await self._invalidate_cache(ids=[deleted_id])
+        return deleted_id
+
+    async def _check_version_conflict(self, cleaning_id: int, expected_versions: Optional[List[int]]) -> None:
+        """
+        Only called once a conditional write matched no row, to tell a stale version apart from a missing cleaning
+        """
+        if expected_versions is None:
+            return
+
+        current_version = await self.db.fetch_val(query=GET_CLEANING_VERSION_QUERY, values={"id": cleaning_id})
+        if current_version is not None:
+            raise self._version_mismatch()
+
+    @staticmethod
+    def _version_mismatch() -> HTTPException:
+        return HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED,
+                             detail="The cleaning has been modified since it was last fetched.")
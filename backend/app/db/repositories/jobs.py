@@ -0,0 +1,167 @@
+import json
+from typing import Any, List, Optional, Type, TypeVar
+
+from app.db.repositories.base import BaseRepository
+from app.models.enum_type import JobStatus
+from app.models.job import JobCreate, JobInDB, JobPublic
+
+JobModel = TypeVar("JobModel", JobPublic, JobInDB)
+
+ENQUEUE_JOB_QUERY = """
+    INSERT INTO jobs (kind, payload, max_attempts)
+    VALUES (:kind, :payload, :max_attempts)
+    RETURNING id, kind, status, attempts, max_attempts, run_at, result, error, created_at, started_at, finished_at
+"""
+
+GET_JOB_BY_ID_QUERY = """
+    SELECT id, kind, status, attempts, max_attempts, run_at, result, error, created_at, started_at, finished_at
+    FROM jobs
+    WHERE id = :id
+"""
+
+# SKIP LOCKED: concurrent workers each take a different job instead of queueing up behind the same row
+CLAIM_JOB_QUERY = """
+    UPDATE jobs
+    SET status = 'running',
+        attempts = attempts + 1,
+        locked_by = :worker,
+        locked_until = now() + make_interval(secs => :lease_seconds),
+        started_at = now()
+    WHERE id = (
+        SELECT id
+        FROM jobs
+        WHERE status = 'queued' AND run_at <= now() AND kind = ANY(:kinds)
+        ORDER BY run_at
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, kind, payload, status, attempts, max_attempts, run_at, result, error, created_at, started_at,
+              finished_at
+"""
+
+# Every update of a claimed job checks it is still the same claim: after a lease expired the job may have been
+# claimed again, and the late worker must not overwrite that attempt
+COMPLETE_JOB_QUERY = """
+    UPDATE jobs
+    SET status = 'succeeded',
+        result = :result,
+        error = NULL,
+        locked_by = NULL,
+        locked_until = NULL,
+        finished_at = now()
+    WHERE id = :id AND status = 'running' AND attempts = :attempts
+    RETURNING id
+"""
+
+FAIL_JOB_QUERY = """
+    UPDATE jobs
+    SET status = CASE WHEN :final OR attempts >= max_attempts THEN 'failed' ELSE 'queued' END,
+        run_at = now() + make_interval(secs => :retry_delay),
+        error = :error,
+        locked_by = NULL,
+        locked_until = NULL,
+        finished_at = CASE WHEN :final OR attempts >= max_attempts THEN now() END
+    WHERE id = :id AND status = 'running' AND attempts = :attempts
+    RETURNING status
+"""
+
+# Hand a job back without counting the attempt, e.g. when its worker shuts down
+RELEASE_JOB_QUERY = """
+    UPDATE jobs
+    SET status = 'queued',
+        attempts = attempts - 1,
+        run_at = now(),
+        locked_by = NULL,
+        locked_until = NULL
+    WHERE id = :id AND status = 'running' AND attempts = :attempts
+    RETURNING id
+"""
+
+REAP_EXPIRED_JOBS_QUERY = """
+    UPDATE jobs
+    SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END,
+        run_at = now(),
+        error = 'lease expired on worker ' || coalesce(locked_by, 'unknown'),
+        locked_by = NULL,
+        locked_until = NULL,
+        finished_at = CASE WHEN attempts >= max_attempts THEN now() END
+    WHERE id IN (
+        SELECT id
+        FROM jobs
+        WHERE status = 'running' AND locked_until < now()
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id
+"""
+
+# Published by the jobs_queued_notify trigger whenever jobs are inserted
+JOBS_QUEUED_CHANNEL = "jobs_queued"
+
+
+def _load_json(value: Any) -> Any:
+    # asyncpg hands jsonb over as text
+    return json.loads(value) if isinstance(value, str) else value
+
+
+class JobsRepository(BaseRepository):
+    @staticmethod
+    def _to_job(record, model: Type[JobModel]) -> JobModel:
+        values = dict(record)
+        for column in ("payload", "result"):
+            if column in values:
+                values[column] = _load_json(values[column])
+        return model.parse_obj(values)
+
+    async def enqueue_job(self, *, new_job: JobCreate, default_max_attempts: int) -> JobPublic:
+        job = await self.db.fetch_one(query=ENQUEUE_JOB_QUERY, values={
+            "kind": new_job.kind,
+            "payload": json.dumps(new_job.payload),
+            "max_attempts": new_job.max_attempts or default_max_attempts,
+        })
+        self._forget_reads()
+        return self._to_job(job, JobPublic)
+
+    async def get_job_by_id(self, *, job_id: int) -> Optional[JobPublic]:
+        job = await self.read_db.fetch_one(query=GET_JOB_BY_ID_QUERY, values={"id": job_id})
+        return self._to_job(job, JobPublic) if job else None
+
+    async def claim_job(self, *, worker: str, kinds: List[str], lease_seconds: float) -> Optional[JobInDB]:
+        """
+        Take the job of one of `kinds` that has been runnable the longest for `lease_seconds`, or None when there is
+        none
+        """
+        job = await self.db.fetch_one(
+            query=CLAIM_JOB_QUERY, values={"worker": worker, "kinds": kinds, "lease_seconds": lease_seconds}
+        )
+        return self._to_job(job, JobInDB) if job else None
+
+    async def complete_job(self, *, job: JobInDB, result: Optional[dict]) -> bool:
+        """
+        False when the claim had been lost, the result is then dropped
+        """
+        completed = await self.db.fetch_val(query=COMPLETE_JOB_QUERY, values={
+            "id": job.id, "attempts": job.attempts, "result": json.dumps(result) if result is not None else None,
+        })
+        return completed is not None
+
+    async def fail_job(
+            self, *, job: JobInDB, error: str, retry_delay: float, final: bool = False
+    ) -> Optional[JobStatus]:
+        """
+        Queue the job again after `retry_delay` seconds, or fail it for good once it is out of attempts or when
+        `final`. Returns the new status, None when the claim had been lost.
+        """
+        status = await self.db.fetch_val(query=FAIL_JOB_QUERY, values={
+            "id": job.id, "attempts": job.attempts, "error": error, "retry_delay": retry_delay, "final": final,
+        })
+        return JobStatus(status) if status is not None else None
+
+    async def release_job(self, *, job: JobInDB) -> bool:
+        released = await self.db.fetch_val(query=RELEASE_JOB_QUERY, values={"id": job.id, "attempts": job.attempts})
+        return released is not None
+
+    async def reap_expired_jobs(self) -> List[int]:
+        """
+        Put back (or fail, when out of attempts) running jobs whose lease expired, presumably with their worker
+        """
+        return [record["id"] for record in await self.db.fetch_all(query=REAP_EXPIRED_JOBS_QUERY)]
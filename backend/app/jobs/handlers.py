@@ -0,0 +1,59 @@
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Type
+
+from databases import Database
+
+from app.core import config
+from app.db.repositories.cleanings import CleaningsRepository
+from app.models.cleaning import CleaningCreate
+from app.models.core import CoreModel
+from app.models.enum_type import JobKind
+
+
+class JobHandler(NamedTuple):
+    """
+    How to run one kind of job. `concurrency` is how many jobs of the kind a worker process runs at once. The
+    writes of a `transactional` handler commit together with the job's completion, or not at all: a job put back
+    in the queue after its worker died or its lease ran out never has its writes applied twice.
+    """
+    run: Callable[[Database, Any], Awaitable[Optional[dict]]]
+    payload_model: Type[CoreModel]
+    concurrency: int = 1
+    transactional: bool = False
+
+
+class ImportCleaningsPayload(CoreModel):
+    """
+    The cleanings travel in the job itself, so the API validates and stores all of them while enqueueing. Files
+    of more than a few thousand cleanings belong on the streaming /api/cleanings/import endpoint instead.
+    """
+    new_cleanings: List[CleaningCreate]
+
+
+class NoPayload(CoreModel):
+    pass
+
+
+async def import_cleanings(database: Database, payload: ImportCleaningsPayload) -> dict:
+    """
+    Insert the cleanings in batches, all or nothing. Transactional, so a job run again never imports twice.
+    """
+    cleanings_repo = CleaningsRepository(database)
+    batch_size = config.CLEANINGS_MAX_BATCH_SIZE
+
+    async with database.transaction():
+        for start in range(0, len(payload.new_cleanings), batch_size):
+            await cleanings_repo.create_cleanings(new_cleanings=payload.new_cleanings[start:start + batch_size])
+
+    return {"created": len(payload.new_cleanings)}
+
+
+async def refresh_cleaning_stats(database: Database, payload: NoPayload) -> dict:
+    return {"refreshed": await CleaningsRepository(database).refresh_price_distribution()}
+
+
+JOB_HANDLERS = {
+    JobKind.import_cleanings.value: JobHandler(
+        import_cleanings, ImportCleaningsPayload, concurrency=2, transactional=True
+    ),
+    JobKind.refresh_cleaning_stats.value: JobHandler(refresh_cleaning_stats, NoPayload),
+}  # type: Dict[str, JobHandler]
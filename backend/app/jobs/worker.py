@@ -0,0 +1,248 @@
+"""
+Job worker, run next to the API servers:
+
+    python -m app.jobs.worker
+
+Claims queued jobs from Postgres and runs them through the same app/db layer as the API. SIGTERM (or SIGINT) stops
+claiming, lets running jobs finish for up to JOBS_SHUTDOWN_TIMEOUT seconds, and hands the rest back to the queue.
+"""
+import asyncio
+import os
+import random
+import signal
+import socket
+import time
+from typing import Dict, List, Mapping, Optional, Set
+
+from databases import Database
+from loguru import logger
+from prometheus_client import start_http_server
+from pydantic import ValidationError
+
+from app.core import config
+from app.core.metrics import JOB_DURATION, JOB_QUEUE_WAIT, JOBS_IN_PROGRESS, metrics_registry
+from app.db.events import connect_database, start_connection_recycler
+from app.db.notifications import NotificationListener
+from app.db.repositories.jobs import JOBS_QUEUED_CHANNEL, JobsRepository
+from app.jobs.handlers import JOB_HANDLERS, JobHandler
+from app.models.core import CoreModel
+from app.models.enum_type import JobStatus
+from app.models.job import JobInDB
+
+
+class JobClaimLost(Exception):
+    """
+    The job was handed to another worker before this one could complete it
+    """
+
+
+class JobWorker:
+    """
+    Runs up to `concurrency` jobs at a time, and no more jobs of a kind than its handler's `concurrency`. Idle
+    runners wait for `wake()` (called on the jobs_queued notification) or `poll_interval`, whichever comes first.
+    A failed job is retried after an exponential backoff until it runs out of attempts.
+    """
+
+    def __init__(
+        self,
+        database: Database,
+        handlers: Mapping[str, JobHandler] = JOB_HANDLERS,
+        *,
+        name: str = None,
+        concurrency: int = 4,
+        poll_interval: float = 1.0,
+        lease_seconds: float = 900.0,
+        retry_delay: float = 5.0,
+        max_retry_delay: float = 600.0,
+        reap_interval: float = 30.0,
+        shutdown_timeout: float = 30.0,
+    ) -> None:
+        self.database = database
+        self.repository = JobsRepository(database)
+        self.handlers = handlers
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.reap_interval = reap_interval
+        self.shutdown_timeout = shutdown_timeout
+
+        self._running = {kind: 0 for kind in handlers}  # type: Dict[str, int]
+        # Claims are made one at a time so that two runners cannot both take the last free slot of a kind
+        self._claim_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._runners = set()  # type: Set[asyncio.Future]
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Seconds before retrying a job that failed its `attempt`th attempt, with jitter so failures do not retry in
+        lockstep
+        """
+        delay = min(self.retry_delay * 2 ** (attempt - 1), self.max_retry_delay)
+        return delay * random.uniform(0.5, 1.0)
+
+    def _claimable_kinds(self) -> List[str]:
+        return [kind for kind, handler in self.handlers.items() if self._running[kind] < handler.concurrency]
+
+    async def wake(self, payload: Optional[str] = None) -> None:
+        self._wakeup.set()
+
+    async def run_once(self) -> bool:
+        """
+        Claim one runnable job and run it; False when there was nothing this worker could take
+        """
+        async with self._claim_lock:
+            kinds = self._claimable_kinds()
+            if not kinds:
+                return False
+
+            job = await self.repository.claim_job(worker=self.name, kinds=kinds, lease_seconds=self.lease_seconds)
+            if job is None:
+                return False
+
+            self._running[job.kind] += 1
+
+        try:
+            await self._execute(job)
+        finally:
+            self._running[job.kind] -= 1
+
+        return True
+
+    async def _execute(self, job: JobInDB) -> None:
+        handler = self.handlers[job.kind]
+        JOB_QUEUE_WAIT.labels(job.kind).observe(max((job.started_at - job.run_at).total_seconds(), 0.0))
+        in_progress = JOBS_IN_PROGRESS.labels(job.kind)
+        in_progress.inc()
+        started = time.perf_counter()
+        outcome = "succeeded"
+
+        try:
+            payload = handler.payload_model.parse_obj(job.payload)
+            # Past its lease the job may be handed to another worker, so it must not run longer
+            result = await asyncio.wait_for(self._run(handler, job, payload), timeout=self.lease_seconds)
+
+        except asyncio.CancelledError:
+            outcome = "released"
+            await asyncio.shield(self.repository.release_job(job=job))
+            raise
+
+        except JobClaimLost:
+            outcome = "lost"
+            logger.warning(f"job {job.id} ({job.kind}) outlived its lease, its writes were rolled back")
+
+        except ValidationError as e:
+            # Retrying cannot fix a payload
+            outcome = "failed"
+            await self.repository.fail_job(job=job, error=f"invalid payload: {e}", retry_delay=0, final=True)
+
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}" if not isinstance(e, asyncio.TimeoutError) else "timed out"
+            status = await self.repository.fail_job(job=job, error=error, retry_delay=self.backoff(job.attempts))
+            outcome = "retried" if status == JobStatus.queued else "failed"
+            logger.warning(f"job {job.id} ({job.kind}) attempt {job.attempts}/{job.max_attempts} {outcome}: {error}")
+
+        else:
+            if not handler.transactional:
+                await self.repository.complete_job(job=job, result=result)
+
+        finally:
+            in_progress.dec()
+            JOB_DURATION.labels(job.kind, outcome).observe(time.perf_counter() - started)
+
+    async def _run(self, handler: JobHandler, job: JobInDB, payload: CoreModel) -> Optional[dict]:
+        if not handler.transactional:
+            return await handler.run(self.database, payload)
+
+        async with self.database.transaction():
+            result = await handler.run(self.database, payload)
+            if not await self.repository.complete_job(job=job, result=result):
+                raise JobClaimLost()
+        return result
+
+    async def _run_jobs(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                ran = await self.run_once()
+            except Exception as e:
+                logger.error(f"job worker {self.name} cannot claim jobs: {e!r}")
+                ran = False
+
+            if not ran:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+    async def _reap(self) -> None:
+        while True:
+            try:
+                reaped = await self.repository.reap_expired_jobs()
+                if reaped:
+                    logger.warning(f"jobs {reaped} outlived their lease and were put back")
+            except Exception as e:
+                logger.error(f"job worker {self.name} cannot reap expired jobs: {e!r}")
+
+            await asyncio.sleep(self.reap_interval)
+
+    async def run(self) -> None:
+        """
+        Run jobs until `stop()`, then drain
+        """
+        reaper = asyncio.ensure_future(self._reap())
+        self._runners = {asyncio.ensure_future(self._run_jobs()) for _ in range(self.concurrency)}
+        logger.info(f"job worker {self.name} running {self.concurrency} jobs at a time")
+
+        await self._stopping.wait()
+        reaper.cancel()
+
+        _, unfinished = await asyncio.wait(self._runners, timeout=self.shutdown_timeout)
+        for runner in unfinished:
+            runner.cancel()
+        await asyncio.gather(reaper, *self._runners, return_exceptions=True)
+        logger.info(f"job worker {self.name} stopped, {len(unfinished)} unfinished jobs handed back")
+
+    def stop(self) -> None:
+        self._stopping.set()
+        self._wakeup.set()
+
+
+async def main() -> None:
+    if config.JOBS_METRICS_PORT:
+        start_http_server(config.JOBS_METRICS_PORT, registry=metrics_registry())
+
+    database = await connect_database(str(config.DATABASE_URL))
+    recycler = start_connection_recycler(database)
+
+    worker = JobWorker(
+        database,
+        concurrency=config.JOBS_WORKER_CONCURRENCY,
+        poll_interval=config.JOBS_POLL_INTERVAL,
+        lease_seconds=config.JOBS_LEASE_SECONDS,
+        retry_delay=config.JOBS_RETRY_DELAY,
+        max_retry_delay=config.JOBS_MAX_RETRY_DELAY,
+        shutdown_timeout=config.JOBS_SHUTDOWN_TIMEOUT,
+    )
+
+    listener = NotificationListener(str(config.DATABASE_URL))
+    listener.add_handler(JOBS_QUEUED_CHANNEL, worker.wake)
+    await listener.start()
+
+    loop = asyncio.get_event_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, worker.stop)
+
+    try:
+        await worker.run()
+    finally:
+        await listener.stop()
+        recycler.cancel()
+        await database.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
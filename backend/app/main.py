@@ -1,31 +1,102 @@
-import uvicorn
-from fastapi import FastAPI
+from typing import Any
+
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 
-from app.api.routes import router as api_router
+from app.api.routes import routers as api_routers
+from app.api.routes.health import router as health_router
+from app.api.routes.metrics import router as metrics_router
 from app.core import config, events
+from app.core.admission import AdmissionController, AdmissionMiddleware, parse_route_limits
+from app.core.cancellation import CancellationMiddleware
+from app.core.compression import CompressionMiddleware
+from app.core.context import DeadlineExceeded, RequestContextMiddleware
+from app.core.metrics import MetricsMiddleware
+from app.db.pool import PoolAcquireTimeout
+
+
+async def pool_acquire_timeout_handler(request: Request, exc: PoolAcquireTimeout) -> JSONResponse:
+    retry_after = max(1, round(config.DB_POOL_ACQUIRE_TIMEOUT))
+    return JSONResponse(
+        {"detail": "Database is busy, please retry."}, status_code=503, headers={"Retry-After": str(retry_after)},
+    )
+
+
+async def deadline_exceeded_handler(request: Request, exc: DeadlineExceeded) -> JSONResponse:
+    return JSONResponse({"detail": "Request timed out."}, status_code=504)
 
 
 def get_application():
     fastapi_app = FastAPI(title=config.PROJECT_NAME, version=config.VERSION)
 
+    # Innermost, so the time spent compressing counts in the request metrics
+    if config.COMPRESSION_ENABLED:
+        fastapi_app.add_middleware(
+            CompressionMiddleware,
+            minimum_size=config.COMPRESSION_MINIMUM_SIZE,
+            gzip_level=config.COMPRESSION_GZIP_LEVEL,
+            brotli_quality=config.COMPRESSION_BROTLI_QUALITY,
+        )
+    # Inside CORS so that browsers can read the 503s
+    if config.ADMISSION_ENABLED:
+        fastapi_app.state.admission = AdmissionController(
+            read_concurrency=config.ADMISSION_READ_CONCURRENCY,
+            read_queue_size=config.ADMISSION_READ_QUEUE_SIZE,
+            write_concurrency=config.ADMISSION_WRITE_CONCURRENCY,
+            write_queue_size=config.ADMISSION_WRITE_QUEUE_SIZE,
+            queue_timeout=config.ADMISSION_QUEUE_TIMEOUT,
+            route_limits=parse_route_limits(config.ADMISSION_ROUTE_LIMITS),
+        )
+        fastapi_app.add_middleware(
+            AdmissionMiddleware, controller=fastapi_app.state.admission, exempt_routes=config.ADMISSION_EXEMPT_ROUTES,
+        )
+    # Outside admission control, so that requests given up on leave its queue
+    fastapi_app.add_middleware(CancellationMiddleware)
     fastapi_app.add_middleware(
         CORSMiddleware,
         allow_origins=["*"],
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=["X-Next-Cursor", "ETag", "Last-Modified", "Server-Timing", "Retry-After"],
     )
+    fastapi_app.add_middleware(
+        RequestContextMiddleware,
+        read_your_writes_seconds=config.DB_READ_YOUR_WRITES_SECONDS if config.DATABASE_REPLICA_URLS else None,
+        timeout=config.REQUEST_TIMEOUT_SECONDS or None,
+    )
+
+    if config.METRICS_ENABLED:
+        fastapi_app.add_middleware(MetricsMiddleware)
 
     fastapi_app.add_event_handler("startup", events.create_start_app_handler(fastapi_app))
     fastapi_app.add_event_handler("shutdown", events.create_stop_app_handler(fastapi_app))
 
-    fastapi_app.include_router(api_router, prefix="/api")
+    fastapi_app.add_exception_handler(PoolAcquireTimeout, pool_acquire_timeout_handler)
+    fastapi_app.add_exception_handler(DeadlineExceeded, deadline_exceeded_handler)
+
+    # Straight into the app: every router nested in another has its routes copied once more
+    for router, prefix, tags in api_routers:
+        fastapi_app.include_router(router, prefix=f"{config.API_PREFIX}{prefix}", tags=tags)
+    fastapi_app.include_router(health_router, prefix="/health", tags=["health"])
+    if config.METRICS_ENABLED:
+        fastapi_app.include_router(metrics_router)
 
     return fastapi_app
 
 
-app = get_application()
+def __getattr__(name: str) -> Any:
+    # The application is built on first use of `app.main:app` rather than when this module is imported, so that
+    # importing it for get_application() (tests, benchmarks) does not build one more
+    if name == "app":
+        globals()["app"] = get_application()
+        return globals()["app"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
+# Development server with autoreload; in production run gunicorn -c gunicorn.conf.py
 if __name__ == '__main__':
+    import uvicorn
+
     uvicorn.run("main:app", host='0.0.0.0', port=8000, reload=True, workers=1)
@@ -1,7 +1,15 @@
-from typing import Optional
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple, Type
 
-from app.models.core import CoreModel, IDModelMixin
-from app.models.enum_type import CleaningType
+from pydantic import Field, confloat, create_model
+
+from app.models.core import CoreModel, IDModelMixin, VersionModelMixin
+from app.models.enum_type import BatchItemStatus, CleaningChangeOp, CleaningType
+
+# Prices are stored as NUMERIC(10, 2), which rejects anything larger
+MAX_PRICE = 99999999.99
+Price = confloat(ge=-MAX_PRICE, le=MAX_PRICE)
 
 
 class CleaningBase(CoreModel):
@@ -10,7 +18,7 @@ class CleaningBase(CoreModel):
     """
     name: Optional[str]
     description: Optional[str]
-    price: Optional[float]
+    price: Optional[Price]
     cleaning_type: Optional[CleaningType] = CleaningType.spot_clean
 
     class Config:
@@ -19,18 +27,144 @@ class CleaningBase(CoreModel):
 
 class CleaningCreate(CleaningBase):
     name: str
-    price: float
+    price: Price
 
 
 class CleaningUpdate(CleaningBase):
     cleaning_type: Optional[CleaningType]
 
 
-class CleaningInDB(IDModelMixin, CleaningBase):
+class CleaningBatchUpdate(CleaningUpdate):
+    """
+    One entry of a bulk update; fields left out or set to null keep their current value
+    """
+    id: int = Field(..., ge=1)
+
+
+class CleaningInDB(IDModelMixin, VersionModelMixin, CleaningBase):
     name: str
     price: float
     cleaning_type: CleaningType
 
 
-class CleaningPublic(IDModelMixin, CleaningBase):
+class CleaningPublic(IDModelMixin, VersionModelMixin, CleaningBase):
     pass
+
+
+# Fields a client may pick with `fields=`, named as the columns of cleanings they are read from
+CLEANING_FIELDS = ("id", "name", "description", "price", "cleaning_type", "version", "updated_at")
+
+
+class CleaningFields(CoreModel):
+    """
+    Base of the partial cleanings sent for sparse fieldsets, see `cleaning_fields_model`
+    """
+
+    class Config:
+        use_enum_values = True
+
+
+@lru_cache(maxsize=None)
+def cleaning_fields_model(fields: Tuple[str, ...]) -> Type[CleaningFields]:
+    """
+    A model with only `fields` of CleaningInDB, typed the same. Its instances hold nothing else, so they encode to
+    just those fields.
+    """
+    return create_model(
+        "CleaningFields",
+        __base__=CleaningFields,
+        **{
+            name: (field.outer_type_, ... if field.required else field.default)
+            for name, field in ((name, CleaningInDB.__fields__[name]) for name in fields)
+        },
+    )
+
+
+def sparse_cleaning(cleaning: CleaningInDB, fields: Tuple[str, ...]) -> CleaningFields:
+    return cleaning_fields_model(fields).construct(**{name: cleaning.__dict__[name] for name in fields})
+
+
+class CleaningFilter(CoreModel):
+    """
+    Optional criteria used to narrow down a list of cleanings
+    """
+    cleaning_type: Optional[CleaningType]
+    min_price: Optional[float]
+    max_price: Optional[float]
+    name_prefix: Optional[str]
+    search: Optional[str]
+
+    class Config:
+        use_enum_values = True
+
+
+class CleaningBatchItemResult(CoreModel):
+    index: int
+    status: BatchItemStatus
+    id: Optional[int]
+    cleaning: Optional[CleaningPublic]
+    errors: Optional[List[Dict[str, Any]]]
+
+
+class CleaningBatchResult(CoreModel):
+    results: List[CleaningBatchItemResult]
+
+
+class CleaningTypeStats(CoreModel):
+    cleaning_type: CleaningType
+    count: int
+    average_price: Optional[float]
+    min_price: Optional[float]
+    max_price: Optional[float]
+    p50_price: Optional[float]
+    p90_price: Optional[float]
+    p99_price: Optional[float]
+
+    class Config:
+        use_enum_values = True
+
+
+class CleaningStats(CoreModel):
+    """
+    Aggregates per cleaning type. Counts and average prices are exact; the price distribution (min, max and
+    percentiles) is recomputed in the background and is as of `distribution_refreshed_at`.
+    """
+    types: List[CleaningTypeStats]
+    distribution_refreshed_at: Optional[datetime]
+
+
+class CleaningImportError(CoreModel):
+    """
+    `row` counts data rows from 1, leaving out the CSV header and blank lines
+    """
+    row: int
+    errors: List[Dict[str, Any]]
+
+
+class CleaningImportResult(CoreModel):
+    """
+    Outcome of a bulk import: valid rows were imported, invalid ones are listed in `errors`
+    """
+    rows: int
+    imported: int
+    invalid: int
+    errors: List[CleaningImportError]
+    seconds: float
+    rows_per_second: float
+
+
+class CleaningChange(CoreModel):
+    """
+    One cleaning created, updated or deleted, as sent by the change feed. `cleaning` is the cleaning as it is now,
+    possibly at a later version than `version`, and None once deleted. `cleaning_id` is None when one statement
+    changed too many cleanings to list them; clients then refetch what they show.
+    """
+    cursor: str
+    op: CleaningChangeOp
+    cleaning_id: Optional[int]
+    version: Optional[int]
+    changed_at: datetime
+    cleaning: Optional[CleaningPublic]
+
+    class Config:
+        use_enum_values = True
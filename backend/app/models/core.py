@@ -1,3 +1,6 @@
+from datetime import datetime
+from typing import Optional
+
 from pydantic import BaseModel
 
 
@@ -10,3 +13,11 @@ class CoreModel(BaseModel):
 
 class IDModelMixin(BaseModel):
     id: int
+
+
+class VersionModelMixin(BaseModel):
+    """
+    Row version bumped on every update, used for ETags and optimistic concurrency
+    """
+    version: int = 1
+    updated_at: Optional[datetime]
@@ -5,3 +5,51 @@ class CleaningType(str, Enum):
     dust_up = "dust_up"
     spot_clean = "spot_clean"
     full_clean = "full_clean"
+
+
+class CleaningSort(str, Enum):
+    id = "id"
+    id_desc = "-id"
+    name = "name"
+    name_desc = "-name"
+    price = "price"
+    price_desc = "-price"
+
+
+class BatchItemStatus(str, Enum):
+    created = "created"
+    updated = "updated"
+    deleted = "deleted"
+    not_found = "not_found"
+    invalid = "invalid"
+
+
+class JobKind(str, Enum):
+    import_cleanings = "import_cleanings"
+    refresh_cleaning_stats = "refresh_cleaning_stats"
+
+
+class JobStatus(str, Enum):
+    queued = "queued"
+    running = "running"
+    succeeded = "succeeded"
+    failed = "failed"
+
+
+class BulkFormat(str, Enum):
+    csv = "csv"
+    ndjson = "ndjson"
+
+
+class CleaningChangeOp(str, Enum):
+    create = "create"
+    update = "update"
+    delete = "delete"
+
+
+class ResponseFormat(str, Enum):
+    json = "json"
+    msgpack = "msgpack"
+    # Lists as one array per field instead of one object per row
+    json_columns = "json_columns"
+    msgpack_columns = "msgpack_columns"
@@ -0,0 +1,39 @@
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from pydantic import Field
+
+from app.models.core import CoreModel, IDModelMixin
+from app.models.enum_type import JobKind, JobStatus
+
+
+class JobCreate(CoreModel):
+    kind: JobKind
+    payload: Dict[str, Any] = {}
+    max_attempts: Optional[int] = Field(None, ge=1, le=100)
+
+    class Config:
+        use_enum_values = True
+
+
+class JobPublic(IDModelMixin, CoreModel):
+    """
+    A job without its payload, which can be large (a whole import)
+    """
+    kind: str
+    status: JobStatus
+    attempts: int
+    max_attempts: int
+    run_at: datetime
+    result: Optional[Dict[str, Any]]
+    error: Optional[str]
+    created_at: datetime
+    started_at: Optional[datetime]
+    finished_at: Optional[datetime]
+
+    class Config:
+        use_enum_values = True
+
+
+class JobInDB(JobPublic):
+    payload: Dict[str, Any]
@@ -0,0 +1,86 @@
+"""
+Bytes on the wire and encode CPU of a list response in every format the cleanings routes negotiate, uncompressed and
+compressed as CompressionMiddleware would with the configured levels.
+
+    python -m benchmarks.bench_formats --rows 1000 --repeat 20
+"""
+import argparse
+import random
+import time
+from typing import Any, Callable, List
+
+from app.api.responses import as_columns, dumps, msgpack_dumps
+from app.core import config
+from app.core.compression import Compressor
+from app.models.cleaning import CleaningInDB
+from app.models.enum_type import ResponseFormat
+from benchmarks.bench_serialization import make_records
+
+ENCODERS = {
+    ResponseFormat.json: dumps,
+    ResponseFormat.msgpack: msgpack_dumps,
+    ResponseFormat.json_columns: lambda rows: dumps(as_columns(rows)),
+    ResponseFormat.msgpack_columns: lambda rows: msgpack_dumps(as_columns(rows)),
+}
+ENCODINGS = ("identity", "gzip", "br")
+WORDS = (
+    "kitchen bathroom carpet window oven fridge tiles grout stains dust mould limescale deep spot weekly monthly "
+    "after party move out rental office stairs hallway balcony glass frames shampoo degrease polish sanitise"
+).split()
+
+
+def make_cleanings(count: int) -> List[CleaningInDB]:
+    # Free text of varying words, identical descriptions would make every compressor look too good
+    words = random.Random(0)
+    return [
+        CleaningInDB.construct(**{
+            **record, "price": float(record["price"]),
+            "description": " ".join(words.choice(WORDS) for _ in range(words.randint(10, 40))),
+        })
+        for record in make_records(count)
+    ]
+
+
+def encode(encoder: Callable[[Any], bytes], encoding: str) -> Callable[[List[CleaningInDB]], bytes]:
+    if encoding == "identity":
+        return encoder
+
+    def encode_and_compress(rows: List[CleaningInDB]) -> bytes:
+        compressor = Compressor(
+            encoding, gzip_level=config.COMPRESSION_GZIP_LEVEL, brotli_quality=config.COMPRESSION_BROTLI_QUALITY
+        )
+        return compressor.finish(encoder(rows))
+
+    return encode_and_compress
+
+
+def measure(path: Callable[[List[CleaningInDB]], bytes], rows: List[CleaningInDB], repeat: int) -> float:
+    path(rows)
+
+    started = time.perf_counter()
+    for _ in range(repeat):
+        path(rows)
+    return (time.perf_counter() - started) / repeat
+
+
+def main(rows: int, repeat: int) -> None:
+    cleanings = make_cleanings(rows)
+    baseline = len(dumps(cleanings))
+
+    print(f"rows per response: {rows}, responses: {repeat}")
+    print(f"{'format':<18}{'encoding':<10}{'bytes':>12}{'vs json':>9}{'encode ms':>11}")
+    for response_format, encoder in ENCODERS.items():
+        for encoding in ENCODINGS:
+            path = encode(encoder, encoding)
+            size = len(path(cleanings))
+            seconds = measure(path, cleanings, repeat)
+            print(f"{response_format.value:<18}{encoding:<10}{size:>12,}{size / baseline:>8.0%}{seconds * 1000:>11.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    main(args.rows, args.repeat)
@@ -0,0 +1,333 @@
+"""
+Load test of the cleanings API. Drives the real application from get_application() in-process through httpx
+against a real Postgres and reports requests/sec, p50/p95/p99 latency and database round trips per request
+(read from the Server-Timing header) for each scenario.
+
+    python -m benchmarks.load                                   # throwaway postgres container, like the tests
+    python -m benchmarks.load --database-url postgresql://...   # scratch database: all of its tables are dropped
+    python -m benchmarks.load --save benchmarks/baseline.json
+    python -m benchmarks.load --baseline benchmarks/baseline.json --threshold 0.15
+
+With --baseline the exit status is 1 when any scenario lost more than --threshold of its throughput, or grew its
+p95 latency or round trips per request by more than that. Client and server share one event loop, so the
+numbers include httpx's overhead and are only comparable between runs on the same machine.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional
+
+from asgi_lifespan import LifespanManager
+from httpx import AsyncClient, Response
+
+SERVER_TIMING_QUERIES = re.compile(r'desc="(\d+) queries"')
+CLEANING_TYPES = ("dust_up", "spot_clean", "full_clean")
+
+
+class State:
+    """
+    What the scenarios share: the random source and the ids of the seeded cleanings
+    """
+
+    def __init__(self, seed: int) -> None:
+        self.rng = random.Random(seed)
+        self.ids = []  # type: List[int]
+        self.cursor = None  # type: Optional[str]
+
+    def new_cleaning(self) -> dict:
+        return {
+            "name": f"cleaning {self.rng.randrange(1_000_000)}",
+            "description": "a fairly long free text description of what the cleaning involves " * 2,
+            "price": round(self.rng.uniform(5, 500), 2),
+            "cleaning_type": self.rng.choice(CLEANING_TYPES),
+        }
+
+
+Scenario = Callable[[AsyncClient, State], Awaitable[Response]]
+
+
+async def mixed(client: AsyncClient, state: State) -> Response:
+    """
+    Mostly reads: 60% by id, 20% filtered listings, 10% partial updates, 10% creates
+    """
+    roll = state.rng.random()
+    if roll < 0.6:
+        return await client.get(f"/api/cleanings/{state.rng.choice(state.ids)}/")
+    if roll < 0.8:
+        return await client.get(
+            "/api/cleanings/", params={"limit": 50, "cleaning_type": state.rng.choice(CLEANING_TYPES), "sort": "price"}
+        )
+    if roll < 0.9:
+        return await client.patch(
+            f"/api/cleanings/{state.rng.choice(state.ids)}/",
+            json={"cleaning_update": {"price": round(state.rng.uniform(5, 500), 2)}},
+        )
+    return await client.post("/api/cleanings/", json={"new_cleaning": state.new_cleaning()})
+
+
+async def list_scan(client: AsyncClient, state: State) -> Response:
+    """
+    Keyset-paginate through the whole table, 1000 rows a page, starting over at the end
+    """
+    params = {"limit": 1000}
+    if state.cursor:
+        params["after"] = state.cursor
+
+    res = await client.get("/api/cleanings/", params=params)
+    state.cursor = res.headers.get("X-Next-Cursor")
+    return res
+
+
+async def batch_insert(client: AsyncClient, state: State) -> Response:
+    return await client.post(
+        "/api/cleanings/batch", json={"new_cleanings": [state.new_cleaning() for _ in range(500)]}
+    )
+
+
+async def concurrent_updates(client: AsyncClient, state: State) -> Response:
+    """
+    Every worker updating the same ten rows
+    """
+    return await client.patch(
+        f"/api/cleanings/{state.rng.choice(state.ids[:10])}/",
+        json={"cleaning_update": {"price": round(state.rng.uniform(5, 500), 2)}},
+    )
+
+
+async def hot_reads(client: AsyncClient, state: State) -> Response:
+    """
+    A spike on ten popular cleanings: every worker reading them, with the odd update invalidating the cache
+    """
+    if state.rng.random() < 0.05:
+        return await client.patch(
+            f"/api/cleanings/{state.rng.choice(state.ids[:10])}/",
+            json={"cleaning_update": {"price": round(state.rng.uniform(5, 500), 2)}},
+        )
+    return await client.get(f"/api/cleanings/{state.rng.choice(state.ids[:10])}/")
+
+
+SCENARIOS = {
+    "mixed": mixed,
+    "list_scan": list_scan,
+    "batch_insert": batch_insert,
+    "concurrent_updates": concurrent_updates,
+    "hot_reads": hot_reads,
+}  # type: Dict[str, Scenario]
+
+
+async def isolated(requests: Awaitable[None]) -> None:
+    """
+    Make requests in a task of their own. `databases` keeps the connection it acquires in the calling context;
+    made from the main task it would be inherited, and shared, by every worker started afterwards.
+    """
+    await asyncio.ensure_future(requests)
+
+
+def percentile(cut_points: List[float], p: int) -> float:
+    return cut_points[p - 1] * 1000
+
+
+async def run_scenario(client: AsyncClient, scenario: Scenario, state: State, *, requests: int, concurrency: int,
+                       warmup: int) -> dict:
+    async def warm_up() -> None:
+        for _ in range(warmup):
+            await scenario(client, state)
+
+    await isolated(warm_up())
+
+    latencies, round_trips = [], []  # type: List[float], List[int]
+    errors = shed = 0
+    remaining = iter(range(requests))
+
+    async def worker() -> None:
+        nonlocal errors, shed
+        for _ in remaining:
+            started = time.perf_counter()
+            res = await scenario(client, state)
+            latencies.append(time.perf_counter() - started)
+
+            if res.status_code >= 400:
+                errors += 1
+            # Turned away by admission control, or by the pool
+            if res.status_code == 503:
+                shed += 1
+            match = SERVER_TIMING_QUERIES.search(res.headers.get("Server-Timing", ""))
+            if match:
+                round_trips.append(int(match.group(1)))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    cut_points = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "requests": requests,
+        "errors": errors,
+        "shed": shed,
+        "rps": requests / elapsed,
+        "p50_ms": percentile(cut_points, 50),
+        "p95_ms": percentile(cut_points, 95),
+        "p99_ms": percentile(cut_points, 99),
+        "db_round_trips_per_request": statistics.mean(round_trips) if round_trips else None,
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> List[str]:
+    """
+    Regressions of `results` against `baseline` larger than `threshold` (a fraction), as readable lines
+    """
+    regressions = []
+    for name, current in results["scenarios"].items():
+        previous = baseline["scenarios"].get(name)
+        if previous is None:
+            continue
+
+        if current["rps"] < previous["rps"] * (1 - threshold):
+            regressions.append(f"{name}: {current['rps']:.1f} rps, baseline {previous['rps']:.1f}")
+        if current["p95_ms"] > previous["p95_ms"] * (1 + threshold):
+            regressions.append(f"{name}: p95 {current['p95_ms']:.1f}ms, baseline {previous['p95_ms']:.1f}ms")
+
+        trips, previous_trips = current["db_round_trips_per_request"], previous["db_round_trips_per_request"]
+        if trips is not None and previous_trips is not None and trips > previous_trips * (1 + threshold):
+            regressions.append(f"{name}: {trips:.2f} round trips per request, baseline {previous_trips:.2f}")
+
+    return regressions
+
+
+@contextlib.contextmanager
+def postgres_container() -> Iterator[str]:
+    """
+    Same throwaway container as tests/conftest.py
+    """
+    import docker as pydocker
+    from tests.helpers import ping_postgres, pull_image
+
+    image = "postgres:12.6-alpine"
+    with pydocker.APIClient(version="auto") as client:
+        pull_image(client, image)
+        container = client.create_container(
+            image=image,
+            name=f"bench-postgres-{uuid.uuid4()}",
+            detach=True,
+            environment=["POSTGRES_USER=datguy", "POSTGRES_PASSWORD=ngandethuong", "POSTGRES_DB=phresh_bench"],
+        )
+        client.start(container=container["Id"])
+        try:
+            host = client.inspect_container(container["Id"])["NetworkSettings"]["IPAddress"]
+            dsn = f"postgres://datguy:ngandethuong@{host}/postgres"
+            ping_postgres(dsn)
+            yield dsn
+        finally:
+            client.kill(container["Id"])
+            client.remove_container(container["Id"])
+
+
+async def seed(client: AsyncClient, state: State, rows: int, batch_size: int) -> None:
+    while len(state.ids) < rows:
+        count = min(batch_size, rows - len(state.ids))
+        res = await client.post(
+            "/api/cleanings/batch", json={"new_cleanings": [state.new_cleaning() for _ in range(count)]}
+        )
+        res.raise_for_status()
+        state.ids.extend(item["id"] for item in res.json()["results"])
+
+
+async def run(args: argparse.Namespace) -> dict:
+    from app.core import config
+    from app.main import get_application
+
+    app = get_application()
+    state = State(args.seed)
+    results = {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "rows": args.rows,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+        },
+        "scenarios": {},
+    }
+
+    async with LifespanManager(app):
+        async with AsyncClient(
+                app=app, base_url="http://bench", headers={"Content-Type": "application/json"},
+        ) as client:
+            await isolated(seed(client, state, args.rows, config.CLEANINGS_MAX_BATCH_SIZE))
+
+            for name in args.scenarios:
+                result = await run_scenario(
+                    client, SCENARIOS[name], state,
+                    requests=args.requests, concurrency=args.concurrency, warmup=args.warmup,
+                )
+                results["scenarios"][name] = result
+                print(
+                    f"{name:<20} {result['rps']:>9.1f} rps  p50 {result['p50_ms']:>7.1f}ms  "
+                    f"p95 {result['p95_ms']:>7.1f}ms  p99 {result['p99_ms']:>7.1f}ms  "
+                    f"round trips {result['db_round_trips_per_request'] or 0:>5.2f}  errors {result['errors']}  "
+                    f"shed {result['shed']}"
+                )
+
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", help="scratch database to run against, all of its tables are dropped; "
+                                               "a throwaway postgres container without it")
+    parser.add_argument("--scenarios", nargs="+", choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--rows", type=int, default=20000, help="cleanings seeded before the scenarios run")
+    parser.add_argument("--requests", type=int, default=500, help="measured requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="write the results as a JSON baseline to this path")
+    parser.add_argument("--baseline", help="compare against this JSON baseline")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed regression, as a fraction")
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        dsn = args.database_url or stack.enter_context(postgres_container())
+        os.environ["DATABASE_URL"] = dsn
+        from app.db.migrate import Migrate
+
+        migrate = Migrate(db_uri=dsn)
+        migrate.rollback_all()
+        migrate.apply()
+        try:
+            results = asyncio.run(run(args))
+        finally:
+            migrate.rollback_all()
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"saved baseline to {args.save}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print(f"no regression over {args.threshold:.0%} against {args.baseline}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,154 @@
+"""
+Startup time of the API: how long a new worker takes from launching its interpreter to serving its first request,
+by phase, and where importing the application spends its time (python -X importtime, by top-level package).
+
+    python -m benchmarks.startup                          # against $DATABASE_URL, its migrations are applied
+    python -m benchmarks.startup --runs 5 --top 15
+    python -m benchmarks.startup --budget 2.5
+
+Every run is a fresh interpreter that imports app.main, builds the application, runs its startup (connecting to
+the database) and serves GET /health/live in-process through httpx. The median run is reported; with --budget
+the exit status is 1 when its time to the first request is over that many seconds.
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+BACKEND = Path(__file__).resolve().parents[1]
+IMPORT_TIME = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+PHASES = ("import", "build", "startup", "first_request", "to_first_request")
+
+
+def _serve_first_request(launched_at: float) -> Dict[str, float]:
+    """
+    Runs in the measured interpreter. What the harness itself needs is imported before the clock starts.
+    """
+    import asyncio
+
+    from asgi_lifespan import LifespanManager
+    from httpx import AsyncClient
+
+    async def serve() -> Dict[str, float]:
+        phases = {}
+        started = time.perf_counter()
+        # An import statement: -X importtime leaves out imports through importlib
+        import app.main
+        main = sys.modules["app.main"]
+        phases["import"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        application = main.app
+        phases["build"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        async with LifespanManager(application):
+            phases["startup"] = time.perf_counter() - started
+
+            started = time.perf_counter()
+            async with AsyncClient(app=application, base_url="http://startup") as client:
+                res = await client.get(application.url_path_for("health:live"))
+                res.raise_for_status()
+            phases["first_request"] = time.perf_counter() - started
+            phases["to_first_request"] = time.time() - launched_at
+
+        return phases
+
+    return asyncio.run(serve())
+
+
+def import_times(stderr: str, module: str = "app.main") -> Dict[str, float]:
+    """
+    Seconds spent importing each top-level package while `module` was imported, from the -X importtime report
+    """
+    entries = []  # type: List[Tuple[int, str, int]]
+    for line in stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match:
+            entries.append((int(match.group(1)), match.group(4), len(match.group(3))))
+
+    # A module is reported once its imports are, so the imports of `module` are the deeper entries just before it
+    end = next(index for index, (_, name, _) in enumerate(entries) if name == module)
+    depth = entries[end][2]
+    start = end
+    while start > 0 and entries[start - 1][2] > depth:
+        start -= 1
+
+    packages = defaultdict(float)  # type: Dict[str, float]
+    for self_us, name, _ in entries[start:end + 1]:
+        packages[name.split(".")[0]] += self_us / 1e6
+    return dict(packages)
+
+
+def measure(*, database_url: str = None, python: str = sys.executable) -> Dict[str, dict]:
+    """
+    Phases of one fresh interpreter serving its first request, and its import times by package
+    """
+    env = dict(os.environ)
+    if database_url:
+        env["DATABASE_URL"] = database_url
+
+    launched_at = time.time()
+    process = subprocess.run(
+        [python, "-X", "importtime", "-m", "benchmarks.startup", "--serve-first-request", str(launched_at)],
+        cwd=BACKEND, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+    )
+    if process.returncode != 0:
+        raise RuntimeError(f"startup failed:\n{process.stderr[-4000:]}")
+
+    return {"phases": json.loads(process.stdout.splitlines()[-1]), "imports": import_times(process.stderr)}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=os.environ.get("DATABASE_URL"))
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=10, help="packages listed by import time")
+    parser.add_argument("--budget", type=float, help="seconds allowed to the first request")
+    parser.add_argument("--serve-first-request", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_first_request is not None:
+        print(json.dumps(_serve_first_request(args.serve_first_request)))
+        return 0
+
+    if not args.database_url:
+        parser.error("no database, pass --database-url or set DATABASE_URL")
+    from app.db.migrate import Migrate
+
+    Migrate(db_uri=args.database_url).apply()
+
+    runs = sorted(
+        (measure(database_url=args.database_url) for _ in range(args.runs)),
+        key=lambda run: run["phases"]["to_first_request"],
+    )
+    median = runs[len(runs) // 2]
+
+    for phase in PHASES:
+        values = [run["phases"][phase] * 1000 for run in runs]
+        print(f"{phase:<18} {median['phases'][phase] * 1000:>8.1f}ms  (min {min(values):.1f}ms, "
+              f"stdev {statistics.pstdev(values):.1f}ms)")
+
+    print("\nimporting app.main, by package (median run):")
+    for package, seconds in sorted(median["imports"].items(), key=lambda item: -item[1])[:args.top]:
+        print(f"  {package:<24} {seconds * 1000:>8.1f}ms")
+
+    if args.budget is not None:
+        seconds = median["phases"]["to_first_request"]
+        if seconds > args.budget:
+            print(f"OVER BUDGET first request after {seconds:.2f}s, budget {args.budget:.2f}s")
+            return 1
+        print(f"first request after {seconds:.2f}s, within the {args.budget:.2f}s budget")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
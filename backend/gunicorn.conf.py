@@ -0,0 +1,98 @@
+"""
+Production server: gunicorn managing uvicorn workers (uvloop and httptools).
+
+    gunicorn -c gunicorn.conf.py
+
+The app is imported once in the master and forked into the workers, which share its memory copy-on-write. Nothing
+connects at import time; every worker opens its own pools in the startup handler. On SIGTERM the workers stop
+accepting connections, let in-flight requests finish for up to GRACEFUL_TIMEOUT seconds, and close their pools in
+the shutdown handler. Workers are replaced after about MAX_REQUESTS requests to cap memory growth.
+
+Environment:
+    WEB_CONCURRENCY         worker processes, defaults to the CPU count
+    BIND                    address to listen on, defaults to 0.0.0.0:8000
+    DB_CONNECTION_BUDGET    connections all workers together may open to one database server; when set, each
+                            worker's pool is sized from it (DB_MAX_POOL_SIZE)
+    GRACEFUL_TIMEOUT        seconds in-flight requests get to finish on shutdown, defaults to 30
+    MAX_REQUESTS            requests after which a worker is replaced, 0 to never recycle; defaults to 10000
+    MAX_REQUESTS_JITTER     random extra requests per worker so they are not all recycled at once
+"""
+import gc
+import multiprocessing
+import os
+import shutil
+import tempfile
+from typing import Tuple
+
+# Connections a worker holds outside its pool: the LISTEN connection of the notification listener
+CONNECTIONS_OUTSIDE_POOL = 1
+
+
+def worker_pool_sizes(budget: int, workers: int, min_size: int) -> Tuple[int, int]:
+    """
+    (min, max) pool size of each worker so that `workers` workers stay within `budget` connections
+    """
+    max_size = budget // workers - CONNECTIONS_OUTSIDE_POOL
+    if max_size < 1:
+        raise ValueError(
+            f"DB_CONNECTION_BUDGET={budget} is too small for {workers} workers, each needs at least "
+            f"{1 + CONNECTIONS_OUTSIDE_POOL} connections"
+        )
+    return min(min_size, max_size), max_size
+
+
+wsgi_app = "app.main:app"
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY") or multiprocessing.cpu_count())
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", 30))
+timeout = int(os.environ.get("WORKER_TIMEOUT", 60))
+keepalive = int(os.environ.get("KEEPALIVE", 5))
+max_requests = int(os.environ.get("MAX_REQUESTS", 10000))
+max_requests_jitter = int(os.environ.get("MAX_REQUESTS_JITTER", max_requests // 10))
+
+# Heartbeat files on tmpfs: a worker blocked on a slow disk is not mistaken for a hung one
+worker_tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+accesslog = os.environ.get("ACCESS_LOG", "-")
+loglevel = os.environ.get("LOG_LEVEL", "info")
+
+# Settings are read from the environment on first use and kept from then on. Building the preloaded app in the
+# master may be that first use, and the workers inherit what it read, so the per worker pool size has to be in the
+# environment before the app is loaded. A replica is another server with the same budget, so the same size applies
+# to the replica pools.
+if os.environ.get("DB_CONNECTION_BUDGET"):
+    _min_size, _max_size = worker_pool_sizes(
+        int(os.environ["DB_CONNECTION_BUDGET"]), workers, int(os.environ.get("DB_MIN_POOL_SIZE", 2))
+    )
+    os.environ["DB_MIN_POOL_SIZE"], os.environ["DB_MAX_POOL_SIZE"] = str(_min_size), str(_max_size)
+
+# Metrics of all workers are aggregated through files in this directory. prometheus_client picks its storage when
+# imported, so this too must happen before the app loads. Files left by a previous run would be added to this one's
+# counters.
+_metrics_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR") or os.environ.get("prometheus_multiproc_dir")
+if _metrics_dir:
+    for _name in os.listdir(_metrics_dir):
+        if _name.endswith(".db"):
+            os.remove(os.path.join(_metrics_dir, _name))
+else:
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="phresh-metrics-")
+
+
+def when_ready(server) -> None:
+    # Keep the collector from writing to (and so copying) the pages of the objects preloaded in the master
+    gc.freeze()
+    server.log.info(f"{workers} workers, DB pool size {os.environ.get('DB_MAX_POOL_SIZE', 'default')} per worker")
+
+
+def child_exit(server, worker) -> None:
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def on_exit(server) -> None:
+    directory = os.environ.get("PROMETHEUS_MULTIPROC_DIR", "")
+    if directory.startswith(os.path.join(tempfile.gettempdir(), "phresh-metrics-")):
+        shutil.rmtree(directory, ignore_errors=True)
@@ -1,17 +1,38 @@
+import functools
 import os
+import statistics
+import time
 import uuid
+from typing import List, Optional
 
 import docker as pydocker
 import pytest
 from asgi_lifespan import LifespanManager
-from databases import Database
+from databases import Database, DatabaseURL
 from fastapi import FastAPI
 from httpx import AsyncClient
 
 from app.db.migrate import Migrate
 from app.db.repositories.cleanings import CleaningsRepository
 from app.models.cleaning import CleaningInDB, CleaningCreate
-from tests.helpers import pull_image, ping_postgres
+from tests.helpers import create_database, drop_database, pull_image, ping_postgres, reset_sequences
+
+# How tests are kept apart, see the database_url fixture: "rolled_back", or "clone" for every test
+ROLLED_BACK = "rolled_back"
+CLONED = "clone"
+TEST_DB_ISOLATION = os.environ.get("TEST_DB_ISOLATION", ROLLED_BACK)
+
+# Each pytest-xdist worker runs a session of its own, with databases of its own
+WORKER = os.environ.get("PYTEST_XDIST_WORKER", "main")
+
+
+async def start_nothing(*args) -> None:
+    pass
+
+
+def database_dsn(name: str) -> str:
+    # DATABASE_URL points to the server's default database until a test sets its own
+    return str(DatabaseURL(os.environ["DATABASE_URL"]).replace(database=name))
 
 
 @pytest.fixture(scope="session")
@@ -54,17 +75,141 @@ def postgres_container(docker: pydocker.APIClient):
         docker.remove_container(container["Id"])
 
 
-@pytest.fixture
-async def apply_migrations(postgres_container: None) -> None:
-    db_migrate = Migrate(db_uri=os.environ["DATABASE_URL"])
+class DatabaseSetup:
+    """
+    Time spent giving tests their databases, against what migrating up and down around each test would take
+    """
+
+    def __init__(self) -> None:
+        self.tests = {ROLLED_BACK: 0, CLONED: 0}
+        self.seconds = 0.0
+        # Measured once per session, so once per pytest-xdist worker
+        self.migration_cycles = []  # type: List[float]
+
+    def as_dict(self) -> dict:
+        return {"tests": self.tests, "seconds": self.seconds, "migration_cycles": self.migration_cycles}
+
+    def add(self, setup: dict) -> None:
+        for isolation, count in setup["tests"].items():
+            self.tests[isolation] += count
+        self.seconds += setup["seconds"]
+        self.migration_cycles += setup["migration_cycles"]
+
+    def report(self) -> Optional[str]:
+        tests = sum(self.tests.values())
+        if not tests or not self.migration_cycles:
+            return None
+
+        migrating = tests * statistics.mean(self.migration_cycles)
+        return (
+            f"{tests} tests got their database in {self.seconds:.1f}s ({self.tests[ROLLED_BACK]} rolled back, "
+            f"{self.tests[CLONED]} cloned); migrating up and down around each would have taken about "
+            f"{migrating:.1f}s"
+        )
+
+
+DATABASE_SETUP = DatabaseSetup()
+
+
+def pytest_terminal_summary(terminalreporter) -> None:
+    report = DATABASE_SETUP.report()
+    if report is not None:
+        terminalreporter.write_sep("-", "test databases")
+        terminalreporter.write_line(report)
 
+
+def pytest_sessionfinish(session) -> None:
+    # On a pytest-xdist worker, handed over to the controller
+    if hasattr(session.config, "workeroutput"):
+        session.config.workeroutput["database_setup"] = DATABASE_SETUP.as_dict()
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_testnodedown(node) -> None:
+    if "database_setup" in getattr(node, "workeroutput", {}):
+        DATABASE_SETUP.add(node.workeroutput["database_setup"])
+
+
+@pytest.fixture(scope="session")
+def template_database(postgres_container: None) -> str:
+    """
+    Name of a database migrated once for the session (each pytest-xdist worker has its own), copied for the tests
+    """
+    server_dsn = os.environ["DATABASE_URL"]
+    name = f"phresh_test_{WORKER}"
+    drop_database(server_dsn, name)
+    create_database(server_dsn, name)
+
+    db_migrate = Migrate(db_uri=database_dsn(name))
+    started = time.perf_counter()
     db_migrate.apply()
-    yield
     db_migrate.rollback_all()
+    DATABASE_SETUP.migration_cycles.append(time.perf_counter() - started)
+    db_migrate.apply()
+    # A database cannot be copied while anyone is connected to it
+    db_migrate.close()
+
+    yield name
+    drop_database(server_dsn, name)
+
+
+@pytest.fixture(scope="session")
+def shared_database(template_database: str) -> str:
+    """
+    Name of the database shared by the tests whose writes are rolled back
+    """
+    server_dsn = os.environ["DATABASE_URL"]
+    name = f"{template_database}_shared"
+    drop_database(server_dsn, name)
+    create_database(server_dsn, name, template=template_database)
+
+    yield name
+    drop_database(server_dsn, name)
+
+
+@pytest.fixture
+def database_url(request, monkeypatch, template_database: str) -> str:
+    """
+    Migrated database of the test, which the app and DATABASE_URL point to.
+
+    Unless TEST_DB_ISOLATION=clone, tests share one database and the app runs every query on one connection, in a
+    transaction rolled back on shutdown (transactions of the test become savepoints). Tests marked `committed`
+    need more than that: writes committed for notifications or other connections, a real pool, transactions
+    alongside the app's own work. Those get a copy of the template database of their own, dropped afterwards.
+    """
+    started = time.perf_counter()
+    server_dsn = os.environ["DATABASE_URL"]
+
+    if TEST_DB_ISOLATION == ROLLED_BACK and request.node.get_closest_marker("committed") is None:
+        isolation, name = ROLLED_BACK, request.getfixturevalue("shared_database")
+        reset_sequences(database_dsn(name))
+        monkeypatch.setattr("app.db.events.Database", functools.partial(Database, force_rollback=True))
+        # Nothing queries in the background then: it would use the one connection while requests start and end
+        # transactions there
+        monkeypatch.setattr("app.core.events.start_stats_refresher", start_nothing)
+        monkeypatch.setattr("app.db.changes.ChangeFeed.start", start_nothing)
+    else:
+        isolation, name = CLONED, f"{template_database}_{uuid.uuid4().hex[:12]}"
+        create_database(server_dsn, name, template=template_database)
+
+        def drop() -> None:
+            dropping = time.perf_counter()
+            drop_database(server_dsn, name)
+            DATABASE_SETUP.seconds += time.perf_counter() - dropping
+
+        request.addfinalizer(drop)
+
+    dsn = database_dsn(name)
+    monkeypatch.setenv("DATABASE_URL", dsn)
+    monkeypatch.setattr("app.core.config.DATABASE_URL", DatabaseURL(dsn))
+
+    DATABASE_SETUP.tests[isolation] += 1
+    DATABASE_SETUP.seconds += time.perf_counter() - started
+    return dsn
 
 
 @pytest.fixture
-def app(apply_migrations) -> FastAPI:
+def app(database_url: str) -> FastAPI:
     from app.main import get_application
 
     return get_application()
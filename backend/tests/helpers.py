@@ -1,9 +1,11 @@
 import time
+from contextlib import contextmanager
 from functools import wraps
-from typing import Type, Callable, Any
+from typing import Type, Callable, Any, Iterator
 
 import docker.errors
 import psycopg2
+import psycopg2.extensions
 from docker import APIClient
 
 
@@ -43,3 +45,48 @@ def ping_postgres(dsn: str) -> None:
     cur.execute("CREATE EXTENSION hstore;")
     cur.close()
     conn.close()
+
+
+@contextmanager
+def autocommit(dsn: str) -> Iterator[psycopg2.extensions.connection]:
+    # CREATE and DROP DATABASE cannot run in a transaction
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def create_database(dsn: str, name: str, *, template: str = None) -> None:
+    """
+    Create database `name` on the server of `dsn`, as a copy of `template` when given. Copying the files is much
+    faster than the WAL logged copy that Postgres 15 and later default to.
+    """
+    with autocommit(dsn) as conn, conn.cursor() as cur:
+        statement = f'CREATE DATABASE "{name}"'
+        if template is not None:
+            statement += f' TEMPLATE "{template}"'
+            if conn.server_version >= 150000:
+                statement += " STRATEGY FILE_COPY"
+        cur.execute(statement)
+
+
+def drop_database(dsn: str, name: str) -> None:
+    """
+    Drop database `name` if it exists, closing whatever connections to it were left open
+    """
+    with autocommit(dsn) as conn, conn.cursor() as cur:
+        cur.execute(
+            "SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = %s AND pid <> pg_backend_pid()",
+            (name,),
+        )
+        cur.execute(f'DROP DATABASE IF EXISTS "{name}"')
+
+
+def reset_sequences(dsn: str) -> None:
+    """
+    Restart every sequence of the database of `dsn`: rolling a transaction back does not give its ids back
+    """
+    with autocommit(dsn) as conn, conn.cursor() as cur:
+        cur.execute("SELECT setval(oid, 1, false) FROM pg_class WHERE relkind = 'S'")
@@ -0,0 +1,145 @@
+import asyncio
+
+import pytest
+from fastapi import FastAPI, status
+from httpx import AsyncClient
+from prometheus_client import REGISTRY
+
+from app.core.admission import (
+    QUEUE_FULL, QUEUE_TIMEOUT, READ, WRITE, AdmissionController, AdmissionRejected, Limiter, parse_route_limits,
+)
+
+pytestmark = pytest.mark.asyncio
+
+
+def sample(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+class TestLimiter:
+    async def test_released_slots_go_to_waiters_in_order(self) -> None:
+        limiter = Limiter(1, 2)
+        assert await limiter.acquire(1) is False
+
+        admitted = []
+
+        async def wait(name: str) -> None:
+            assert await limiter.acquire(1) is True
+            admitted.append(name)
+
+        waiting = [asyncio.ensure_future(wait(name)) for name in ("first", "second")]
+        await asyncio.sleep(0)
+        assert limiter.queued == 2
+
+        with pytest.raises(AdmissionRejected) as rejected:
+            await limiter.acquire(1)
+        assert rejected.value.reason == QUEUE_FULL
+
+        limiter.release()
+        await asyncio.sleep(0)
+        limiter.release()
+        await asyncio.gather(*waiting)
+        assert admitted == ["first", "second"]
+        assert limiter.active == 1
+
+        limiter.release()
+        assert limiter.stats() == {
+            "concurrency": 1, "queue_size": 2, "active": 0, "queued": 0,
+            "admitted_total": 3, "queued_total": 2, "shed_total": 1,
+        }
+
+    async def test_waits_time_out_and_cancelled_waiters_leave_the_queue(self) -> None:
+        limiter = Limiter(1, 2)
+        await limiter.acquire(1)
+
+        with pytest.raises(AdmissionRejected) as rejected:
+            await limiter.acquire(0.01)
+        assert rejected.value.reason == QUEUE_TIMEOUT
+        assert limiter.queued == 0
+
+        waiting = asyncio.ensure_future(limiter.acquire(1))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert limiter.queued == 0
+
+        limiter.release()
+        assert limiter.active == 0
+
+    async def test_route_slots_are_given_back_when_the_class_sheds(self) -> None:
+        controller = AdmissionController(
+            read_concurrency=1, read_queue_size=0, write_concurrency=1, write_queue_size=0, queue_timeout=1,
+            route_limits={"export": 1},
+        )
+        held = await controller.admit(READ, "export")
+
+        with pytest.raises(AdmissionRejected):
+            await controller.admit(READ, "other")
+        # Writes have slots of their own
+        controller.release(await controller.admit(WRITE, "other"))
+
+        controller.release(held)
+        assert controller.stats()["routes"]["export"]["active"] == 0
+        assert controller.stats()["classes"][READ]["active"] == 0
+
+
+def test_route_limits_are_parsed() -> None:
+    assert parse_route_limits(["cleanings:export-cleanings=2", " jobs:get-job = 5"]) == {
+        "cleanings:export-cleanings": 2, "jobs:get-job": 5,
+    }
+    with pytest.raises(ValueError):
+        parse_route_limits(["cleanings:export-cleanings"])
+
+
+class TestAdmissionMiddleware:
+    async def test_full_classes_shed_with_retry_after(self, app: FastAPI, client: AsyncClient) -> None:
+        controller = app.state.admission
+        controller.queue_timeout = 0.05
+        writes = controller.classes[WRITE]
+        writes.concurrency, writes.queue_size = 1, 1
+        route = "cleanings:create-cleaning"
+        shed = sample("admission_requests_total", priority=WRITE, outcome=f"shed_{QUEUE_TIMEOUT}")
+        labelled = sample("http_requests_total", route=route, method="POST", status="503")
+
+        await writes.acquire(1)
+        try:
+            res = await client.post(app.url_path_for(route), json={"new_cleaning": {"name": "shed", "price": 1}})
+            assert res.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+            assert res.headers["Retry-After"] == "1"
+
+            # Reads are admitted all the same, and health checks are never limited
+            res = await client.get(app.url_path_for("cleanings:get-all-cleanings"))
+            assert res.status_code == status.HTTP_200_OK
+            res = await client.get(app.url_path_for("health:ready"))
+            assert res.json()["admission"]["classes"][WRITE]["shed_total"] == 1
+        finally:
+            writes.release()
+
+        assert sample("admission_requests_total", priority=WRITE, outcome=f"shed_{QUEUE_TIMEOUT}") == shed + 1
+        assert sample("http_requests_total", route=route, method="POST", status="503") == labelled + 1
+
+        res = await client.post(app.url_path_for(route), json={"new_cleaning": {"name": "admitted", "price": 1}})
+        assert res.status_code == status.HTTP_201_CREATED
+        assert writes.active == 0
+
+    async def test_queued_requests_are_admitted_when_a_slot_frees(self, app: FastAPI, client: AsyncClient) -> None:
+        controller = app.state.admission
+        exports = controller.routes["cleanings:export-cleanings"]
+        queued = sample("admission_queued_total", priority=READ)
+
+        for _ in range(exports.concurrency):
+            await exports.acquire(1)
+        exporting = asyncio.ensure_future(client.get(app.url_path_for("cleanings:export-cleanings")))
+        for _ in range(100):
+            if exports.queued:
+                break
+            await asyncio.sleep(0.01)
+        assert exports.queued == 1
+
+        for _ in range(exports.concurrency):
+            exports.release()
+        res = await asyncio.wait_for(exporting, 5)
+
+        assert res.status_code == status.HTTP_200_OK
+        assert exports.active == 0
+        assert sample("admission_queued_total", priority=READ) == queued + 1
@@ -0,0 +1,178 @@
+import asyncio
+import csv
+import io
+import json
+from typing import AsyncIterator, List
+
+import asyncpg
+import pytest
+from databases import Database
+from fastapi import FastAPI, status
+from httpx import AsyncClient
+
+from app.db.bulk import read_rows
+from app.db.repositories.cleanings import CleaningsRepository
+from app.models.cleaning import CleaningCreate
+from app.models.enum_type import BulkFormat
+
+pytestmark = pytest.mark.asyncio
+
+CSV_IMPORT = (
+    'price,name,cleaning_type,description\n'
+    '10.50,plain,dust_up,\n'
+    '20,"quoted, with comma",full_clean,"spans\n""two"" lines"\n'
+    '\n'
+    'not a price,broken,dust_up,\n'
+    '30,defaults,,\n'
+)
+
+
+async def in_chunks(data: bytes, size: int) -> AsyncIterator[bytes]:
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+async def get_all(app: FastAPI, client: AsyncClient) -> List[dict]:
+    res = await client.get(app.url_path_for("cleanings:get-all-cleanings"))
+    return res.json()
+
+
+class TestReadRows:
+    @pytest.mark.parametrize("size", [1, 3, 7, 1024])
+    async def test_rows_survive_any_chunking(self, size: int) -> None:
+        data = ("\ufeff" + CSV_IMPORT.replace("plain", "plaîn")).encode()
+        rows = [row async for row in read_rows(in_chunks(data, size), BulkFormat.csv)]
+
+        assert [number for number, _ in rows] == [1, 2, 3, 4]
+        assert rows[0][1] == {"price": "10.50", "name": "plaîn", "cleaning_type": "dust_up"}
+        assert rows[1][1]["description"] == 'spans\n"two" lines'
+        assert rows[3][1] == {"price": "30", "name": "defaults"}
+
+    async def test_unreadable_ndjson_lines_are_numbered(self) -> None:
+        data = '{"name": "a", "price": 1}\n\n{"name": \n{"name": "c\u2028", "price": 3}'.encode()
+        rows = [row async for row in read_rows(in_chunks(data, 5), BulkFormat.ndjson)]
+
+        assert [number for number, _ in rows] == [1, 2, 3]
+        assert isinstance(rows[1][1], ValueError)
+        assert rows[2][1]["name"] == "c\u2028"
+
+
+class TestImportCleanings:
+    async def test_csv_import_reports_invalid_rows(self, app: FastAPI, client: AsyncClient, db: Database) -> None:
+        res = await client.post(app.url_path_for("cleanings:import-cleanings"), content=CSV_IMPORT.encode(),
+                                headers={"Content-Type": "text/csv; charset=utf-8"})
+        assert res.status_code == status.HTTP_200_OK
+        result = res.json()
+        assert (result["rows"], result["imported"], result["invalid"]) == (4, 3, 1)
+        assert result["errors"][0]["row"] == 3
+        assert result["errors"][0]["errors"][0]["loc"] == ["price"]
+        assert result["rows_per_second"] > 0
+
+        cleanings = await get_all(app, client)
+        assert [(c["name"], c["price"], c["cleaning_type"]) for c in cleanings] == [
+            ("plain", 10.5, "dust_up"), ("quoted, with comma", 20.0, "full_clean"), ("defaults", 30.0, "spot_clean"),
+        ]
+        assert cleanings[1]["description"] == 'spans\n"two" lines'
+
+        # Imported rows count in the stats like any other write
+        res = await client.get(app.url_path_for("cleanings:get-cleaning-stats"))
+        assert sum(stats["count"] for stats in res.json()["types"]) == 3
+
+    async def test_too_many_invalid_rows_import_nothing(
+            self, app: FastAPI, client: AsyncClient, db: Database, monkeypatch
+    ) -> None:
+        monkeypatch.setattr("app.core.config.CLEANINGS_IMPORT_CHUNK_SIZE", 1)
+        monkeypatch.setattr("app.core.config.CLEANINGS_IMPORT_MAX_ERRORS", 1)
+        ndjson = b'{"name": "first", "price": 1}\n{"name": "no price"}\n{"name": "second", "price": 2}\n[]\n'
+
+        res = await client.post(app.url_path_for("cleanings:import-cleanings"), content=ndjson,
+                                headers={"Content-Type": "application/x-ndjson"})
+        assert res.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+        assert [error["row"] for error in res.json()["detail"]["errors"]] == [2]
+
+        # The chunks already copied were never inserted
+        assert await get_all(app, client) == []
+
+    @pytest.mark.committed
+    async def test_other_writes_go_on_while_an_upload_is_read(
+            self, app: FastAPI, client: AsyncClient, db: Database
+    ) -> None:
+        paused, resume = asyncio.Event(), asyncio.Event()
+
+        async def chunks() -> AsyncIterator[List[CleaningCreate]]:
+            yield [CleaningCreate(name="imported", price=1, cleaning_type="spot_clean")]
+            yield [CleaningCreate(name="imported later", price=2, cleaning_type="spot_clean")]
+            # The first chunk is copied by now, the client is slow to send the rest
+            paused.set()
+            await resume.wait()
+
+        importing = asyncio.ensure_future(CleaningsRepository(db).copy_cleanings_in(chunks=chunks()))
+        writer = await asyncpg.connect(str(db.url), server_settings={"statement_timeout": "2000"})
+        try:
+            await asyncio.wait_for(paused.wait(), 5)
+            # Same cleaning type, same stats row: nothing is locked until the import is published
+            await writer.execute(
+                "INSERT INTO cleanings (name, price, cleaning_type) VALUES ('meanwhile', 3, 'spot_clean')"
+            )
+            assert await writer.fetchval("SELECT count(*) FROM cleanings WHERE name LIKE 'imported%'") == 0
+
+            resume.set()
+            assert await asyncio.wait_for(importing, 5) == 2
+            assert await writer.fetchval("SELECT count(*) FROM cleanings WHERE name LIKE 'imported%'") == 2
+            assert await writer.fetchval(
+                "SELECT count FROM cleaning_stats_totals WHERE cleaning_type = 'spot_clean'"
+            ) == 3
+        finally:
+            importing.cancel()
+            await writer.close()
+
+    async def test_unknown_columns_and_formats_are_rejected(self, app: FastAPI, client: AsyncClient) -> None:
+        res = await client.post(app.url_path_for("cleanings:import-cleanings"), content=b"name,colour\na,red\n",
+                                headers={"Content-Type": "text/csv"})
+        assert res.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+        assert "colour" in res.json()["detail"]["message"]
+
+        res = await client.post(app.url_path_for("cleanings:import-cleanings"), json=[{"name": "a", "price": 1}])
+        assert res.status_code == status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+
+
+class TestExportCleanings:
+    async def test_exports_round_trip(self, app: FastAPI, client: AsyncClient, db: Database) -> None:
+        tricky = 'quote " backslash \\ newline \n tab \t done'
+        await client.post(app.url_path_for("cleanings:create-cleanings-batch"), json={"new_cleanings": [
+            {"name": "first", "description": tricky, "price": 12.5, "cleaning_type": "dust_up"},
+            {"name": "second", "price": 99.99, "cleaning_type": "full_clean"},
+        ]})
+        cleanings = await get_all(app, client)
+
+        res = await client.get(app.url_path_for("cleanings:export-cleanings"), params={"format": "ndjson"})
+        assert res.status_code == status.HTTP_200_OK
+        assert res.headers["content-type"].startswith("application/x-ndjson")
+        exported = [json.loads(line) for line in res.text.splitlines()]
+        assert [(c["id"], c["description"], c["price"]) for c in exported] == [
+            (c["id"], c["description"], c["price"]) for c in cleanings
+        ]
+
+        res = await client.get(app.url_path_for("cleanings:export-cleanings"))
+        assert res.headers["content-type"].startswith("text/csv")
+        rows = list(csv.DictReader(io.StringIO(res.text)))
+        assert [(row["name"], row["description"], row["price"]) for row in rows] == [
+            ("first", tricky, "12.50"), ("second", "", "99.99"),
+        ]
+
+        # What was exported imports again, as new cleanings
+        res = await client.post(app.url_path_for("cleanings:import-cleanings"), content=res.content,
+                                headers={"Content-Type": "text/csv"})
+        assert res.json()["imported"] == 2
+        reimported = (await get_all(app, client))[2:]
+        assert [(c["name"], c["description"]) for c in reimported] == [("first", tricky), ("second", None)]
+
+    async def test_export_applies_filters(self, app: FastAPI, client: AsyncClient, db: Database) -> None:
+        await client.post(app.url_path_for("cleanings:create-cleanings-batch"), json={"new_cleanings": [
+            {"name": "cheap", "price": 5, "cleaning_type": "dust_up"},
+            {"name": "pricey", "price": 500, "cleaning_type": "dust_up"},
+        ]})
+
+        res = await client.get(app.url_path_for("cleanings:export-cleanings"),
+                               params={"format": "ndjson", "min_price": 100, "sort": "-price"})
+        assert [json.loads(line)["name"] for line in res.text.splitlines()] == ["pricey"]
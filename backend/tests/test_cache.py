@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+from databases import Database
+from fastapi import FastAPI, status
+from httpx import AsyncClient
+
+from app.db.cache import MISSING, InMemoryCache
+from app.models.cleaning import CleaningInDB
+
+pytestmark = pytest.mark.asyncio
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestInMemoryCache:
+    async def test_least_recently_used_entries_are_evicted(self) -> None:
+        cache = InMemoryCache(max_entries=2, ttl=60)
+
+        await cache.set("ns", 1, "one")
+        await cache.set("ns", 2, "two")
+        assert await cache.get("ns", 1) == "one"
+
+        await cache.set("ns", 3, "three")
+
+        assert await cache.get("ns", 2) is MISSING
+        assert await cache.get("ns", 1) == "one"
+        assert await cache.get("ns", 3) == "three"
+        assert cache.stats()["evictions"] == 1
+
+    async def test_entries_expire_after_ttl(self) -> None:
+        clock = FakeClock()
+        cache = InMemoryCache(max_entries=10, ttl=5, clock=clock)
+
+        await cache.set("ns", 1, "one")
+        clock.now = 4.9
+        assert await cache.get("ns", 1) == "one"
+
+        clock.now = 5.0
+        assert await cache.get("ns", 1) is MISSING
+        assert cache.stats()["expirations"] == 1
+
+    async def test_invalidating_a_namespace_leaves_others_alone(self) -> None:
+        cache = InMemoryCache(max_entries=10, ttl=60)
+
+        await cache.set("lists", "a", [1])
+        await cache.set("rows", 1, "one")
+        await cache.invalidate_namespace("lists")
+
+        assert await cache.get("lists", "a") is MISSING
+        assert await cache.get("rows", 1) == "one"
+
+    async def test_load_racing_an_invalidation_is_not_cached(self) -> None:
+        cache = InMemoryCache(max_entries=10, ttl=60)
+
+        async def stale_load() -> str:
+            # a write lands while the row is being read from the database
+            await cache.delete("rows", 1)
+            return "stale"
+
+        assert await cache.get_or_load("rows", 1, stale_load) == "stale"
+        assert await cache.get("rows", 1) is MISSING
+
+    async def test_stats_count_hits_and_misses(self) -> None:
+        cache = InMemoryCache(max_entries=10, ttl=60)
+
+        async def load() -> str:
+            return "one"
+
+        await cache.get_or_load("rows", 1, load)
+        await cache.get_or_load("rows", 1, load)
+
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+
+class TestCleaningsCache:
+    async def test_repeated_reads_are_served_from_cache(
+            self, app: FastAPI, client: AsyncClient, sample_cleaning: CleaningInDB
+    ) -> None:
+        url = app.url_path_for("cleanings:get-cleaning-by-id", cleaning_id=sample_cleaning.id)
+
+        await client.get(url)
+        hits = app.state.cache.stats()["hits"]
+        res = await client.get(url)
+
+        assert res.status_code == status.HTTP_200_OK
+        assert app.state.cache.stats()["hits"] == hits + 1
+
+    # Notifications are only sent on commit
+    @pytest.mark.committed
+    async def test_writes_from_other_workers_invalidate_through_notify(
+            self, app: FastAPI, client: AsyncClient, db: Database, sample_cleaning: CleaningInDB
+    ) -> None:
+        url = app.url_path_for("cleanings:get-cleaning-by-id", cleaning_id=sample_cleaning.id)
+        await client.get(url)
+        await client.get(app.url_path_for("cleanings:get-all-cleanings"))
+
+        # a write that bypasses this worker's repository, as another worker's would
+        await db.execute("UPDATE cleanings SET name = 'changed elsewhere' WHERE id = :id", {"id": sample_cleaning.id})
+
+        for _ in range(50):
+            res = await client.get(url)
+            if res.json()["name"] == "changed elsewhere":
+                break
+            await asyncio.sleep(0.02)
+
+        assert res.json()["name"] == "changed elsewhere"
+
+        res = await client.get(app.url_path_for("cleanings:get-all-cleanings"))
+        assert res.json()[0]["name"] == "changed elsewhere"
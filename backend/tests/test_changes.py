@@ -0,0 +1,248 @@
+import asyncio
+import json
+import os
+from typing import List, Tuple
+from urllib.parse import urlencode
+
+import asyncpg
+import pytest
+from databases import Database
+from fastapi import FastAPI, status
+from httpx import AsyncClient
+
+from app.db.changes import ChangeFeed
+from app.db.repositories.cleanings import CleaningsRepository
+from app.models.cleaning import CleaningCreate, CleaningInDB
+
+# The log is only read up to committed transactions, and notifications are only sent on commit
+pytestmark = [pytest.mark.asyncio, pytest.mark.committed]
+
+
+class EventStream:
+    """
+    Server-sent events read straight from the app: httpx buffers whole responses, and these never end
+    """
+
+    def __init__(self, app: FastAPI, path: str, *, params: dict = None, headers: dict = None) -> None:
+        self.scope = {
+            "type": "http", "http_version": "1.1", "method": "GET", "scheme": "http", "root_path": "",
+            "path": path, "query_string": urlencode(params or {}).encode(),
+            "headers": [(key.lower().encode(), value.encode()) for key, value in (headers or {}).items()],
+            "server": ("testserver", 80), "client": ("127.0.0.1", 50000),
+        }
+        self.app = app
+        self.status_code = None
+        self.events = []  # type: List[dict]
+        self._body = b""
+        self._requested = False
+        self._arrived = asyncio.Event()
+        self._disconnected = asyncio.Event()
+
+    async def _receive(self) -> dict:
+        if not self._requested:
+            self._requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await self._disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def _send(self, message: dict) -> None:
+        if message["type"] == "http.response.start":
+            self.status_code = message["status"]
+            return
+
+        self._body += message.get("body", b"")
+        *messages, self._body = self._body.split(b"\n\n")
+        for text in messages:
+            fields = dict(line.split(": ", 1) for line in text.decode().split("\n") if not line.startswith(":"))
+            if fields:
+                self.events.append({**fields, "data": json.loads(fields["data"])})
+        self._arrived.set()
+
+    async def __aenter__(self) -> "EventStream":
+        self._task = asyncio.ensure_future(self.app(self.scope, self._receive, self._send))
+        await self.wait_for(1)
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        self._disconnected.set()
+        await asyncio.wait_for(self._task, 5)
+
+    async def wait_for(self, count: int) -> List[dict]:
+        while len(self.events) < count:
+            self._arrived.clear()
+            await asyncio.wait_for(self._arrived.wait(), 5)
+        return self.events
+
+
+async def create_cleanings(cleanings_repo: CleaningsRepository, *names: str) -> List[CleaningInDB]:
+    return await cleanings_repo.create_cleanings(
+        new_cleanings=[CleaningCreate(name=name, price=10) for name in names]
+    )
+
+
+async def wait_until_readable(cleanings_repo: CleaningsRepository, count: int, *, after=(0, 0)) -> None:
+    """
+    Transactions of the whole server hold the log back, those of tests running in parallel against other
+    databases too; wait for `count` changes to be readable
+    """
+    for _ in range(500):
+        if len(await cleanings_repo.get_changes(after=after, limit=count)) >= count:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"fewer than {count} changes readable")
+
+
+class TestChangeStream:
+    async def test_writes_are_streamed(
+            self, app: FastAPI, client: AsyncClient, sample_cleaning: CleaningInDB
+    ) -> None:
+        url = app.url_path_for("cleanings:get-cleaning-by-id", cleaning_id=sample_cleaning.id)
+        # Or it would be streamed too
+        await wait_until_readable(CleaningsRepository(app.state.db), 1)
+
+        async with EventStream(app, app.url_path_for("cleanings:get-cleaning-changes")) as stream:
+            assert stream.status_code == status.HTTP_200_OK
+            res = await client.post(app.url_path_for("cleanings:create-cleaning"),
+                                    json={"new_cleaning": {"name": "new", "price": 5}})
+            await client.patch(url, json={"cleaning_update": {"price": 20}})
+            await client.delete(url)
+
+            events = await stream.wait_for(4)
+
+        assert [event["event"] for event in events] == ["ready", "create", "update", "delete"]
+        assert events[1]["data"]["cleaning"]["id"] == res.json()["id"]
+        assert (events[2]["data"]["cleaning_id"], events[2]["data"]["version"]) == (sample_cleaning.id, 2)
+        assert events[3]["data"]["cleaning"] is None
+        assert [event["id"] for event in events] == [event["data"]["cursor"] for event in events]
+        assert app.state.change_feed.stats()["subscribers"] == 0
+
+    async def test_streams_resume_after_their_last_event(
+            self, app: FastAPI, client: AsyncClient, db: Database
+    ) -> None:
+        cleanings_repo = CleaningsRepository(db)
+        path = app.url_path_for("cleanings:get-cleaning-changes")
+
+        async with EventStream(app, path) as stream:
+            await create_cleanings(cleanings_repo, "first", "second")
+            _, first, _ = await stream.wait_for(3)
+
+        # Missed while disconnected
+        await create_cleanings(cleanings_repo, "third")
+
+        async with EventStream(app, path, headers={"Last-Event-ID": first["id"]}) as stream:
+            await stream.wait_for(3)
+            await create_cleanings(cleanings_repo, "fourth")
+            events = await stream.wait_for(4)
+
+        assert [event["data"]["cleaning"]["name"] for event in events[1:]] == ["second", "third", "fourth"]
+
+    async def test_expired_cursors_resync(self, app: FastAPI, client: AsyncClient, db: Database) -> None:
+        cleanings_repo = CleaningsRepository(db)
+        await create_cleanings(cleanings_repo, "first")
+        await create_cleanings(cleanings_repo, "second")
+        await wait_until_readable(cleanings_repo, 2)
+        (first, _), (second, _) = await cleanings_repo.get_changes(after=(0, 0), limit=10)
+
+        # Keeps the last change it could remove
+        assert await cleanings_repo.prune_changes(retention_seconds=0) == 2
+
+        path = app.url_path_for("cleanings:get-cleaning-changes")
+        async with EventStream(app, path, params={"after": f"{first[0]}-{first[1]}"}) as stream:
+            assert stream.events[0]["event"] == "resync"
+        async with EventStream(app, path, params={"after": f"{second[0]}-{second[1]}"}) as stream:
+            assert stream.events[0]["event"] == "ready"
+
+        res = await client.get(path, params={"after": "not a cursor"})
+        assert res.status_code == status.HTTP_400_BAD_REQUEST
+
+    async def test_websocket_sends_changes(self, app: FastAPI, client: AsyncClient, db: Database) -> None:
+        messages, received, left = [], asyncio.Event(), asyncio.Event()
+        connected = False
+
+        async def receive() -> dict:
+            nonlocal connected
+            if not connected:
+                connected = True
+                return {"type": "websocket.connect"}
+            await left.wait()
+            return {"type": "websocket.disconnect", "code": 1000}
+
+        async def send(message: dict) -> None:
+            if message["type"] == "websocket.send":
+                messages.append(json.loads(message["text"]))
+                received.set()
+
+        scope = {
+            "type": "websocket", "scheme": "ws", "root_path": "", "query_string": b"", "headers": [],
+            "path": app.url_path_for("cleanings:cleaning-changes-ws"), "subprotocols": [],
+            "server": ("testserver", 80), "client": ("127.0.0.1", 50000),
+        }
+        session = asyncio.ensure_future(app(scope, receive, send))
+
+        async def wait_for(count: int) -> None:
+            while len(messages) < count:
+                received.clear()
+                await asyncio.wait_for(received.wait(), 5)
+
+        await wait_for(1)
+        await create_cleanings(CleaningsRepository(db), "over a websocket")
+        await wait_for(2)
+        left.set()
+        await asyncio.wait_for(session, 5)
+
+        assert [message["op"] for message in messages] == ["ready", "create"]
+        assert messages[1]["cleaning"]["name"] == "over a websocket"
+        assert app.state.change_feed.stats()["subscribers"] == 0
+
+
+class TestChangeFeed:
+    async def test_slow_subscribers_catch_up_from_the_log(self, client: AsyncClient, db: Database) -> None:
+        cleanings_repo = CleaningsRepository(db)
+        feed = ChangeFeed(db, buffer_size=2, page_size=2)
+        subscription = await feed.subscribe()
+
+        await create_cleanings(cleanings_repo, *(f"cleaning {n}" for n in range(5)))
+        await wait_until_readable(cleanings_repo, 5, after=subscription.position)
+        await feed.poll()
+        # Five changes do not fit the buffer
+        assert not feed.is_live(subscription)
+
+        positions = []
+        while len(positions) < 5:
+            positions += [event.position for event in await subscription.next_events(0)]
+        assert positions == sorted(set(positions))
+        assert feed.is_live(subscription)
+
+        await create_cleanings(cleanings_repo, "live again")
+        await wait_until_readable(cleanings_repo, 1, after=subscription.position)
+        await feed.poll()
+        assert [json.loads(event.data)["cleaning"]["name"] for event in await subscription.next_events(0)] == [
+            "live again"
+        ]
+
+        subscription.close()
+        assert feed.stats()["subscribers"] == 0
+
+    async def test_changes_wait_for_transactions_that_started_before(
+            self, client: AsyncClient, db: Database
+    ) -> None:
+        cleanings_repo = CleaningsRepository(db)
+        slow = await asyncpg.connect(os.environ["DATABASE_URL"])
+        fast = await asyncpg.connect(os.environ["DATABASE_URL"])
+        try:
+            transaction = slow.transaction()
+            await transaction.start()
+            await slow.fetchval("SELECT txid_current()")
+            await fast.execute("INSERT INTO cleanings (name, price) VALUES ('fast', 1)")
+
+            # 'slow' will come before 'fast', reading 'fast' now would move cursors past it
+            assert await cleanings_repo.get_changes(after=(0, 0), limit=10) == []
+
+            await slow.execute("INSERT INTO cleanings (name, price) VALUES ('slow', 1)")
+            await transaction.commit()
+            await wait_until_readable(cleanings_repo, 2)
+            changes = await cleanings_repo.get_changes(after=(0, 0), limit=10)  # type: List[Tuple]
+            assert [change.cleaning.name for _, change in changes] == ["slow", "fast"]
+        finally:
+            await slow.close()
+            await fast.close()
@@ -1,11 +1,17 @@
 from typing import List, Union
 
+import json
+
+import asyncpg
 import pytest
+from databases import Database
 from fastapi import FastAPI, status
 from httpx import AsyncClient
 from pydantic import parse_obj_as
 
+from app.db.repositories.cleanings import CleaningsRepository
 from app.models.cleaning import CleaningCreate, CleaningInDB
+from app.models.enum_type import CleaningSort
 
 pytestmark = pytest.mark.asyncio
 
@@ -95,6 +101,171 @@ class TestGetCleaning:
         all_cleanings = parse_obj_as(List[CleaningInDB], res.json())
         assert sample_cleaning in all_cleanings
 
+    async def test_get_all_cleanings_paginates_with_cursor(
+            self, app: FastAPI, client: AsyncClient, db: Database) -> None:
+        cleanings_repo = CleaningsRepository(db)
+        created_cleanings = [
+            await cleanings_repo.create_cleaning(new_cleaning=CleaningCreate(name=f"cleaning {i}", price=i))
+            for i in range(5)
+        ]
+
+        seen_cleanings = []
+        params = {"limit": 2}
+        while True:
+            res = await client.get(app.url_path_for("cleanings:get-all-cleanings"), params=params)
+            assert res.status_code == status.HTTP_200_OK
+
+            page = parse_obj_as(List[CleaningInDB], res.json())
+            assert len(page) <= 2
+            seen_cleanings.extend(page)
+
+            next_cursor = res.headers.get("X-Next-Cursor")
+            if not next_cursor:
+                break
+            params = {"limit": 2, "after": next_cursor}
+
+        assert seen_cleanings == created_cleanings
+
+    @pytest.mark.parametrize(
+        "params, status_code",
+        (
+                ({"limit": 0}, 422),
+                ({"limit": 100000}, 422),
+                ({"after": "not-a-cursor"}, 400),
+        ),
+    )
+    async def test_get_all_cleanings_with_invalid_page_params(
+            self, app: FastAPI, client: AsyncClient, params: dict, status_code: int
+    ) -> None:
+        res = await client.get(app.url_path_for("cleanings:get-all-cleanings"), params=params)
+        assert res.status_code == status_code
+
+    async def test_get_all_cleanings_streams_ndjson(
+            self, app: FastAPI, client: AsyncClient, sample_cleaning: CleaningInDB) -> None:
+        res = await client.get(
+            app.url_path_for("cleanings:get-all-cleanings"), headers={"Accept": "application/x-ndjson"}
+        )
+        assert res.status_code == status.HTTP_200_OK
+        assert res.headers["content-type"].startswith("application/x-ndjson")
+
+        streamed_cleanings = [CleaningInDB.parse_obj(json.loads(line)) for line in res.text.splitlines()]
+        assert streamed_cleanings == [sample_cleaning]
+
+
+@pytest.fixture
+async def varied_cleanings(db: Database) -> List[CleaningInDB]:
+    cleanings_repo = CleaningsRepository(db)
+    new_cleanings = [
+        CleaningCreate(name="window wash", description="streak free windows", price=20.00, cleaning_type="dust_up"),
+        CleaningCreate(name="window frames", description="dusting the frames", price=15.50, cleaning_type="dust_up"),
+        CleaningCreate(name="deep kitchen", description="degrease the oven", price=120.00, cleaning_type="full_clean"),
+        CleaningCreate(name="carpet spot", description="remove wine stains", price=35.00, cleaning_type="spot_clean"),
+        CleaningCreate(name="50%_off rug", description="rug shampoo", price=20.00, cleaning_type="spot_clean"),
+    ]
+
+    return [await cleanings_repo.create_cleaning(new_cleaning=new_cleaning) for new_cleaning in new_cleanings]
+
+
+class TestFilterCleanings:
+    @pytest.mark.parametrize(
+        "params, expected_names",
+        (
+                ({"cleaning_type": "dust_up"}, ["window wash", "window frames"]),
+                ({"min_price": 20, "max_price": 35}, ["window wash", "carpet spot", "50%_off rug"]),
+                ({"name_prefix": "window"}, ["window wash", "window frames"]),
+                ({"name_prefix": "50%_"}, ["50%_off rug"]),
+                ({"name_prefix": "5%"}, []),
+                ({"search": "stain"}, ["carpet spot"]),
+                ({"search": "frame", "cleaning_type": "dust_up"}, ["window frames"]),
+        ),
+    )
+    async def test_filters_narrow_down_cleanings(
+            self, app: FastAPI, client: AsyncClient, varied_cleanings: List[CleaningInDB],
+            params: dict, expected_names: List[str]
+    ) -> None:
+        res = await client.get(app.url_path_for("cleanings:get-all-cleanings"), params=params)
+        assert res.status_code == status.HTTP_200_OK
+        assert [cleaning["name"] for cleaning in res.json()] == expected_names
+
+    @pytest.mark.parametrize(
+        "sort, key",
+        (
+                ("id", lambda cleaning: cleaning.id),
+                ("-id", lambda cleaning: -cleaning.id),
+                ("price", lambda cleaning: (cleaning.price, cleaning.id)),
+                ("-price", lambda cleaning: (-cleaning.price, -cleaning.id)),
+                ("name", lambda cleaning: (cleaning.name, cleaning.id)),
+        ),
+    )
+    async def test_sorted_pages_cover_every_cleaning_once(
+            self, app: FastAPI, client: AsyncClient, varied_cleanings: List[CleaningInDB], sort: str, key
+    ) -> None:
+        seen_cleanings = []
+        params = {"limit": 2, "sort": sort}
+        while True:
+            res = await client.get(app.url_path_for("cleanings:get-all-cleanings"), params=params)
+            assert res.status_code == status.HTTP_200_OK
+
+            seen_cleanings.extend(parse_obj_as(List[CleaningInDB], res.json()))
+
+            next_cursor = res.headers.get("X-Next-Cursor")
+            if not next_cursor:
+                break
+            params = {"limit": 2, "sort": sort, "after": next_cursor}
+
+        if sort != "name":
+            assert seen_cleanings == sorted(varied_cleanings, key=key)
+        else:
+            # name order depends on the database collation, so only check completeness
+            assert sorted(seen_cleanings, key=lambda cleaning: cleaning.id) == varied_cleanings
+
+    async def test_cursor_from_another_sort_is_rejected(
+            self, app: FastAPI, client: AsyncClient, varied_cleanings: List[CleaningInDB]
+    ) -> None:
+        res = await client.get(app.url_path_for("cleanings:get-all-cleanings"), params={"limit": 1, "sort": "price"})
+        next_cursor = res.headers["X-Next-Cursor"]
+
+        res = await client.get(
+            app.url_path_for("cleanings:get-all-cleanings"), params={"sort": "-name", "after": next_cursor}
+        )
+        assert res.status_code == status.HTTP_400_BAD_REQUEST
+
+    @pytest.mark.parametrize(
+        "params",
+        (
+                {"cleaning_type": "not a type"},
+                {"min_price": -1},
+                {"sort": "description"},
+                {"name_prefix": ""},
+        ),
+    )
+    async def test_invalid_filters_raise_error(self, app: FastAPI, client: AsyncClient, params: dict) -> None:
+        res = await client.get(app.url_path_for("cleanings:get-all-cleanings"), params=params)
+        assert res.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+    # Its transaction would race the app's startup work on the one connection a rolled back test has
+    @pytest.mark.committed
+    @pytest.mark.parametrize(
+        "condition, index_name",
+        (
+                ("cleaning_type = 'dust_up'", "idx_cleanings_cleaning_type_id"),
+                ("price BETWEEN 10 AND 20", "idx_cleanings_price_id"),
+                ("name LIKE 'window%'", "idx_cleanings_name_pattern"),
+                (
+                        "to_tsvector('english', coalesce(description, '')) @@ plainto_tsquery('english', 'stain')",
+                        "idx_cleanings_description_fts",
+                ),
+        ),
+    )
+    async def test_filters_are_index_backed(
+            self, app: FastAPI, client: AsyncClient, db: Database, condition: str, index_name: str
+    ) -> None:
+        async with db.transaction(force_rollback=True):
+            await db.execute("SET LOCAL enable_seqscan = off")
+            plan = await db.fetch_all(f"EXPLAIN SELECT id FROM cleanings WHERE {condition}")
+
+        assert index_name in "\n".join(row[0] for row in plan)
+
 
 class TestUpdateCleaning:
     @pytest.mark.parametrize(
@@ -157,6 +328,292 @@ class TestUpdateCleaning:
         assert res.status_code == status_code
 
 
+class TestConcurrentUpdates:
+    async def test_patch_only_changes_sent_fields(
+            self, app: FastAPI, client: AsyncClient, sample_cleaning: CleaningInDB
+    ) -> None:
+        res = await client.patch(
+            app.url_path_for("cleanings:patch-cleaning-by-id", cleaning_id=sample_cleaning.id),
+            json={"cleaning_update": {"description": None}},
+        )
+        assert res.status_code == status.HTTP_200_OK
+
+        patched_cleaning = CleaningInDB.parse_obj(res.json())
+        assert patched_cleaning.description is None
+        assert patched_cleaning.name == sample_cleaning.name
+        assert patched_cleaning.price == sample_cleaning.price
+        assert patched_cleaning.version == sample_cleaning.version + 1
+
+    async def test_if_match_with_current_etag_updates(
+            self, app: FastAPI, client: AsyncClient, sample_cleaning: CleaningInDB
+    ) -> None:
+        url = app.url_path_for("cleanings:get-cleaning-by-id", cleaning_id=sample_cleaning.id)
+        etag = (await client.get(url)).headers["ETag"]
+
+        res = await client.patch(
+            app.url_path_for("cleanings:patch-cleaning-by-id", cleaning_id=sample_cleaning.id),
+            json={"cleaning_update": {"price": 12.34}},
+            headers={"If-Match": etag},
+        )
+        assert res.status_code == status.HTTP_200_OK
+        assert res.headers["ETag"] != etag
+
+        # the first write made the tag stale, so a second writer holding it is turned away
+        res = await client.patch(
+            app.url_path_for("cleanings:patch-cleaning-by-id", cleaning_id=sample_cleaning.id),
+            json={"cleaning_update": {"price": 56.78}},
+            headers={"If-Match": etag},
+        )
+        assert res.status_code == status.HTTP_412_PRECONDITION_FAILED
+
+        cleaning = CleaningInDB.parse_obj((await client.get(url)).json())
+        assert cleaning.price == 12.34
+
+    @pytest.mark.parametrize(
+        "if_match, status_code",
+        (
+                ('W/"1-1"', 200),
+                ('"1-1"', 200),
+                ('W/"1-7", W/"1-1"', 200),
+                ("*", 200),
+                ('W/"1-2"', 412),
+                ('W/"2-1"', 412),
+                ("garbage", 412),
+        ),
+    )
+    async def test_delete_honours_if_match(
+            self, app: FastAPI, client: AsyncClient, sample_cleaning: CleaningInDB, if_match: str, status_code: int
+    ) -> None:
+        res = await client.delete(
+            app.url_path_for("cleanings:delete-cleaning-by-id", cleaning_id=sample_cleaning.id),
+            headers={"If-Match": if_match},
+        )
+        assert res.status_code == status_code
+
+    async def test_if_match_on_missing_cleaning_returns_not_found(
+            self, app: FastAPI, client: AsyncClient, sample_cleaning: CleaningInDB
+    ) -> None:
+        res = await client.delete(
+            app.url_path_for("cleanings:delete-cleaning-by-id", cleaning_id=500), headers={"If-Match": 'W/"500-1"'}
+        )
+        assert res.status_code == status.HTTP_404_NOT_FOUND
+
+
+class TestConditionalRequests:
+    async def test_unchanged_cleaning_returns_not_modified(
+            self, app: FastAPI, client: AsyncClient, sample_cleaning: CleaningInDB
+    ) -> None:
+        url = app.url_path_for("cleanings:get-cleaning-by-id", cleaning_id=sample_cleaning.id)
+        res = await client.get(url)
+        assert res.headers["Cache-Control"]
+        assert "Last-Modified" in res.headers
+
+        res = await client.get(url, headers={"If-None-Match": res.headers["ETag"]})
+        assert res.status_code == status.HTTP_304_NOT_MODIFIED
+        assert res.content == b""
+
+    async def test_if_modified_since_is_honoured(
+            self, app: FastAPI, client: AsyncClient, sample_cleaning: CleaningInDB
+    ) -> None:
+        url = app.url_path_for("cleanings:get-cleaning-by-id", cleaning_id=sample_cleaning.id)
+        last_modified = (await client.get(url)).headers["Last-Modified"]
+
+        res = await client.get(url, headers={"If-Modified-Since": last_modified})
+        assert res.status_code == status.HTTP_304_NOT_MODIFIED
+
+        res = await client.get(url, headers={"If-Modified-Since": "Mon, 01 Jan 2001 00:00:00 GMT"})
+        assert res.status_code == status.HTTP_200_OK
+
+    async def test_updated_cleaning_returns_new_representation(
+            self, app: FastAPI, client: AsyncClient, sample_cleaning: CleaningInDB
+    ) -> None:
+        url = app.url_path_for("cleanings:get-cleaning-by-id", cleaning_id=sample_cleaning.id)
+        etag = (await client.get(url)).headers["ETag"]
+
+        await client.patch(
+            app.url_path_for("cleanings:patch-cleaning-by-id", cleaning_id=sample_cleaning.id),
+            json={"cleaning_update": {"name": "changed"}},
+        )
+
+        res = await client.get(url, headers={"If-None-Match": etag})
+        assert res.status_code == status.HTTP_200_OK
+        assert res.json()["name"] == "changed"
+
+    async def test_collection_etag_follows_table_writes(
+            self, app: FastAPI, client: AsyncClient, sample_cleaning: CleaningInDB, new_cleaning: CleaningCreate
+    ) -> None:
+        url = app.url_path_for("cleanings:get-all-cleanings")
+        etag = (await client.get(url)).headers["ETag"]
+
+        res = await client.get(url, params={"sort": "-price"}, headers={"If-None-Match": etag})
+        assert res.status_code == status.HTTP_304_NOT_MODIFIED
+
+        await client.post(app.url_path_for("cleanings:create-cleaning"), json={"new_cleaning": new_cleaning.dict()})
+
+        res = await client.get(url, headers={"If-None-Match": etag})
+        assert res.status_code == status.HTTP_200_OK
+        assert res.headers["ETag"] != etag
+        assert len(res.json()) == 2
+
+    async def test_table_version_only_moves_when_cleanings_change(
+            self, app: FastAPI, client: AsyncClient, db: Database, sample_cleaning: CleaningInDB
+    ) -> None:
+        cleanings_repo = CleaningsRepository(db)
+        version = await cleanings_repo.get_table_version()
+
+        await db.execute("UPDATE cleanings SET price = price + 1 WHERE id = :id", {"id": sample_cleaning.id + 1})
+        assert await cleanings_repo.get_table_version() == version
+
+        await db.execute("UPDATE cleanings SET price = price + 1 WHERE id = :id", {"id": sample_cleaning.id})
+        assert await cleanings_repo.get_table_version() == version + 1
+
+        # Folding the bumps into table_versions leaves the version as it was
+        await cleanings_repo.refresh_price_distribution()
+        assert await cleanings_repo.get_table_version() == version + 1
+        assert await db.fetch_val("SELECT count(*) FROM table_version_bumps") == 0
+
+    @pytest.mark.committed
+    async def test_open_write_transactions_do_not_hold_up_other_writes(
+            self, app: FastAPI, client: AsyncClient, db: Database, new_cleaning: CleaningCreate
+    ) -> None:
+        cleanings_repo = CleaningsRepository(db)
+        version = await cleanings_repo.get_table_version()
+
+        writer = await asyncpg.connect(str(db.url))
+        try:
+            async with writer.transaction():
+                # Of the same type as the cleaning posted meanwhile
+                await writer.execute(
+                    "INSERT INTO cleanings (name, price, cleaning_type) VALUES ('still writing', 5.0, $1)",
+                    new_cleaning.cleaning_type,
+                )
+                res = await client.post(
+                    app.url_path_for("cleanings:create-cleaning"), json={"new_cleaning": new_cleaning.dict()},
+                    headers={"X-Request-Timeout": "5"},
+                )
+                assert res.status_code == status.HTTP_201_CREATED
+                # Writes count once committed
+                assert await cleanings_repo.get_table_version() == version + 1
+        finally:
+            await writer.close()
+
+        assert await cleanings_repo.get_table_version() == version + 2
+
+
+class TestFastSerialization:
+    @pytest.fixture
+    def fast_serialization(self, monkeypatch) -> None:
+        from app.core import config
+
+        monkeypatch.setattr(config, "FAST_SERIALIZATION", True)
+
+    async def test_fast_path_matches_validated_responses(
+            self, app: FastAPI, client: AsyncClient, varied_cleanings: List[CleaningInDB], fast_serialization: None
+    ) -> None:
+        res = await client.get(app.url_path_for("cleanings:get-all-cleanings"), params={"limit": 2})
+        assert res.status_code == status.HTTP_200_OK
+        assert "X-Next-Cursor" in res.headers
+        assert parse_obj_as(List[CleaningInDB], res.json()) == varied_cleanings[:2]
+
+        res = await client.get(app.url_path_for("cleanings:get-cleaning-by-id", cleaning_id=varied_cleanings[2].id))
+        assert res.status_code == status.HTTP_200_OK
+        assert "ETag" in res.headers
+        assert CleaningInDB.parse_obj(res.json()) == varied_cleanings[2]
+
+    async def test_fast_path_keeps_status_codes(
+            self, app: FastAPI, client: AsyncClient, new_cleaning: CleaningCreate, fast_serialization: None
+    ) -> None:
+        res = await client.post(app.url_path_for("cleanings:create-cleaning"),
+                                json={"new_cleaning": new_cleaning.dict()})
+        assert res.status_code == status.HTTP_201_CREATED
+        assert CleaningCreate.parse_obj(res.json()) == new_cleaning
+
+        res = await client.post(app.url_path_for("cleanings:create-cleanings-batch"),
+                                json={"new_cleanings": [new_cleaning.dict(), {}]})
+        assert res.status_code == status.HTTP_200_OK
+        assert [result["status"] for result in res.json()["results"]] == ["created", "invalid"]
+
+    async def test_fast_path_streams_ndjson(
+            self, app: FastAPI, client: AsyncClient, varied_cleanings: List[CleaningInDB], fast_serialization: None
+    ) -> None:
+        res = await client.get(
+            app.url_path_for("cleanings:get-all-cleanings"), headers={"Accept": "application/x-ndjson"}
+        )
+        streamed_cleanings = [CleaningInDB.parse_obj(json.loads(line)) for line in res.text.splitlines()]
+        assert streamed_cleanings == varied_cleanings
+
+
+class TestSparseFieldsets:
+    @pytest.mark.parametrize("fast_serialization", (False, True))
+    async def test_lists_send_only_the_fields_asked_for(
+            self, app: FastAPI, client: AsyncClient, varied_cleanings: List[CleaningInDB], monkeypatch,
+            fast_serialization: bool
+    ) -> None:
+        monkeypatch.setattr("app.core.config.FAST_SERIALIZATION", fast_serialization)
+        url = app.url_path_for("cleanings:get-all-cleanings")
+
+        res = await client.get(url, params={"fields": "name, cleaning_type", "limit": 2})
+        assert res.status_code == status.HTTP_200_OK
+        assert res.json() == [
+            {"id": cleaning.id, "name": cleaning.name, "cleaning_type": cleaning.cleaning_type}
+            for cleaning in varied_cleanings[:2]
+        ]
+
+        # The sort column comes along, pages are keyed by it
+        seen_cleanings, params = [], {"fields": "name", "sort": "-price", "limit": 2}
+        while True:
+            res = await client.get(url, params=params)
+            assert all(set(cleaning) == {"id", "name", "price"} for cleaning in res.json())
+            seen_cleanings.extend(cleaning["id"] for cleaning in res.json())
+            if "X-Next-Cursor" not in res.headers:
+                break
+            params["after"] = res.headers["X-Next-Cursor"]
+        assert sorted(seen_cleanings) == [cleaning.id for cleaning in varied_cleanings]
+
+        res = await client.get(url, params={"fields": "price"}, headers={"Accept": "application/x-ndjson"})
+        assert [json.loads(line) for line in res.text.splitlines()] == [
+            {"id": cleaning.id, "price": cleaning.price} for cleaning in varied_cleanings
+        ]
+
+        res = await client.get(url, params={"fields": "name", "sort": "-price"},
+                               headers={"Accept": "application/x-ndjson"})
+        streamed = [json.loads(line) for line in res.text.splitlines()]
+        assert all(set(cleaning) == {"id", "name", "price"} for cleaning in streamed)
+        assert [cleaning["price"] for cleaning in streamed] == sorted(
+            (cleaning.price for cleaning in varied_cleanings), reverse=True
+        )
+
+    async def test_single_cleanings_send_only_the_fields_asked_for(
+            self, app: FastAPI, client: AsyncClient, sample_cleaning: CleaningInDB
+    ) -> None:
+        res = await client.get(app.url_path_for("cleanings:get-cleaning-by-id", cleaning_id=sample_cleaning.id),
+                               params={"fields": "description,updated_at"})
+        assert res.status_code == status.HTTP_200_OK
+        assert res.headers["ETag"] == f'W/"{sample_cleaning.id}-{sample_cleaning.version}"'
+        assert res.json().keys() == {"id", "description", "updated_at"}
+        assert res.json()["description"] == sample_cleaning.description
+
+    async def test_only_the_fields_asked_for_are_selected(
+            self, client: AsyncClient, db: Database, varied_cleanings: List[CleaningInDB]
+    ) -> None:
+        cleanings_repo = CleaningsRepository(db)
+
+        cleanings = await cleanings_repo.get_all_cleanings(limit=10, fields=("name",), sort=CleaningSort.price)
+        assert [cleaning.__dict__ for cleaning in cleanings] == [
+            {"id": cleaning.id, "name": cleaning.name, "price": cleaning.price}
+            for cleaning in sorted(varied_cleanings, key=lambda cleaning: (cleaning.price, cleaning.id))
+        ]
+
+        with pytest.raises(ValueError):
+            await cleanings_repo.get_all_cleanings(limit=10, fields=("name; DROP TABLE cleanings",))
+
+    @pytest.mark.parametrize("fields", ("secret", "name,secret"))
+    async def test_unknown_fields_raise_error(self, app: FastAPI, client: AsyncClient, fields: str) -> None:
+        res = await client.get(app.url_path_for("cleanings:get-all-cleanings"), params={"fields": fields})
+        assert res.status_code == status.HTTP_400_BAD_REQUEST
+        assert "secret" in res.json()["detail"]
+
+
 class TestDeleteCleaning:
     async def test_can_delete_cleaning_successfully(
             self, app: FastAPI, client: AsyncClient, sample_cleaning: CleaningInDB
@@ -183,3 +640,159 @@ class TestDeleteCleaning:
     ) -> None:
         res = await client.delete(app.url_path_for("cleanings:delete-cleaning-by-id", cleaning_id=cleaning_id))
         assert res.status_code == status_code
+
+
+class TestBatchCleanings:
+    async def test_batch_create_reports_each_item(self, app: FastAPI, client: AsyncClient) -> None:
+        new_cleanings = [
+            {"name": "first", "price": 10.00},
+            {"name": "missing price"},
+            {"name": "third", "price": 30.00, "cleaning_type": "full_clean"},
+            "not even an object",
+            # More than the database can store
+            {"name": "too dear", "price": 1e9},
+        ]
+
+        res = await client.post(app.url_path_for("cleanings:create-cleanings-batch"),
+                                json={"new_cleanings": new_cleanings})
+        assert res.status_code == status.HTTP_200_OK
+
+        results = res.json()["results"]
+        assert [result["status"] for result in results] == ["created", "invalid", "created", "invalid", "invalid"]
+        assert [result["index"] for result in results] == [0, 1, 2, 3, 4]
+        assert results[1]["errors"][0]["loc"] == ["price"]
+        assert results[4]["errors"][0]["loc"] == ["price"]
+        assert results[2]["cleaning"]["cleaning_type"] == "full_clean"
+
+        res = await client.get(app.url_path_for("cleanings:get-all-cleanings"))
+        assert [cleaning["name"] for cleaning in res.json()] == ["first", "third"]
+
+    async def test_batch_update_applies_partial_updates(
+            self, app: FastAPI, client: AsyncClient, varied_cleanings: List[CleaningInDB]
+    ) -> None:
+        first, second = varied_cleanings[0], varied_cleanings[1]
+        cleaning_updates = [
+            {"id": first.id, "price": 99.00},
+            {"id": second.id, "name": "renamed", "cleaning_type": "full_clean"},
+            {"id": 500, "name": "nobody"},
+            {"id": first.id, "price": 1.00},
+            {"id": second.id, "cleaning_type": "invalid cleaning type"},
+            {"id": varied_cleanings[2].id, "price": -1e12},
+        ]
+
+        res = await client.patch(app.url_path_for("cleanings:update-cleanings-batch"),
+                                 json={"cleaning_updates": cleaning_updates})
+        assert res.status_code == status.HTTP_200_OK
+
+        results = res.json()["results"]
+        assert [result["status"] for result in results] == [
+            "updated", "updated", "not_found", "invalid", "invalid", "invalid",
+        ]
+
+        versioned_fields = {"version", "updated_at"}
+
+        updated_first = CleaningInDB.parse_obj(results[0]["cleaning"])
+        assert updated_first.dict(exclude=versioned_fields) == first.copy(update={"price": 99.00}).dict(
+            exclude=versioned_fields
+        )
+        assert updated_first.version == first.version + 1
+
+        updated_second = CleaningInDB.parse_obj(results[1]["cleaning"])
+        assert updated_second.dict(exclude=versioned_fields) == second.copy(
+            update={"name": "renamed", "cleaning_type": "full_clean"}
+        ).dict(exclude=versioned_fields)
+
+    async def test_batch_delete_removes_cleanings(
+            self, app: FastAPI, client: AsyncClient, varied_cleanings: List[CleaningInDB]
+    ) -> None:
+        ids = [varied_cleanings[0].id, varied_cleanings[1].id, 500]
+
+        res = await client.request("DELETE", app.url_path_for("cleanings:delete-cleanings-batch"), json={"ids": ids})
+        assert res.status_code == status.HTTP_200_OK
+        assert [result["status"] for result in res.json()["results"]] == ["deleted", "deleted", "not_found"]
+
+        res = await client.get(app.url_path_for("cleanings:get-all-cleanings"))
+        assert [cleaning["id"] for cleaning in res.json()] == [cleaning.id for cleaning in varied_cleanings[2:]]
+
+    async def test_batch_size_is_limited(self, app: FastAPI, client: AsyncClient) -> None:
+        from app.core import config
+
+        ids = list(range(1, config.CLEANINGS_MAX_BATCH_SIZE + 2))
+
+        res = await client.request("DELETE", app.url_path_for("cleanings:delete-cleanings-batch"), json={"ids": ids})
+        assert res.status_code == status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+
+
+class TestCleaningStats:
+    @staticmethod
+    def _by_type(res) -> dict:
+        return {stats["cleaning_type"]: stats for stats in res.json()["types"]}
+
+    async def test_counts_and_averages_follow_every_write(
+            self, app: FastAPI, client: AsyncClient, varied_cleanings: List[CleaningInDB]
+    ) -> None:
+        res = await client.get(app.url_path_for("cleanings:get-cleaning-stats"))
+        assert res.status_code == status.HTTP_200_OK
+        stats = self._by_type(res)
+        assert {cleaning_type: (s["count"], s["average_price"]) for cleaning_type, s in stats.items()} == {
+            "dust_up": (2, 17.75), "spot_clean": (2, 27.5), "full_clean": (1, 120.0),
+        }
+
+        await client.patch(
+            app.url_path_for("cleanings:patch-cleaning-by-id", cleaning_id=varied_cleanings[3].id),
+            json={"cleaning_update": {"cleaning_type": "full_clean", "price": 80.00}},
+        )
+        await client.delete(app.url_path_for("cleanings:delete-cleaning-by-id", cleaning_id=varied_cleanings[0].id))
+
+        stats = self._by_type(await client.get(app.url_path_for("cleanings:get-cleaning-stats")))
+        assert {cleaning_type: (s["count"], s["average_price"]) for cleaning_type, s in stats.items()} == {
+            "dust_up": (1, 15.5), "spot_clean": (1, 20.0), "full_clean": (2, 100.0),
+        }
+
+    async def test_empty_types_are_reported(self, app: FastAPI, client: AsyncClient) -> None:
+        res = await client.get(app.url_path_for("cleanings:get-cleaning-stats"))
+        assert res.status_code == status.HTTP_200_OK
+        assert [stats["count"] for stats in res.json()["types"]] == [0, 0, 0]
+        assert all(stats["p50_price"] is None for stats in res.json()["types"])
+
+    async def test_price_distribution_is_refreshed_after_writes(
+            self, app: FastAPI, client: AsyncClient, db: Database, varied_cleanings: List[CleaningInDB]
+    ) -> None:
+        cleanings_repo = CleaningsRepository(db, app.state.cache)
+        assert await cleanings_repo.refresh_price_distribution() is True
+        # Nothing was written since
+        assert await cleanings_repo.refresh_price_distribution() is False
+
+        res = await client.get(app.url_path_for("cleanings:get-cleaning-stats"))
+        assert res.json()["distribution_refreshed_at"] is not None
+        dust_up = self._by_type(res)["dust_up"]
+        assert (dust_up["min_price"], dust_up["max_price"], dust_up["p50_price"]) == (15.5, 20.0, 17.75)
+
+        # Only the background refresh recomputes the distribution, reads never do
+        await client.post(app.url_path_for("cleanings:create-cleaning"), json={"new_cleaning": {
+            "name": "quick dust", "price": 5.00, "cleaning_type": "dust_up",
+        }})
+        dust_up = self._by_type(await client.get(app.url_path_for("cleanings:get-cleaning-stats")))["dust_up"]
+        assert (dust_up["count"], dust_up["min_price"]) == (3, 15.5)
+
+        assert await cleanings_repo.refresh_price_distribution() is True
+        dust_up = self._by_type(await client.get(app.url_path_for("cleanings:get-cleaning-stats")))["dust_up"]
+        assert (dust_up["count"], dust_up["min_price"], dust_up["p50_price"]) == (3, 5.0, 15.5)
+
+    async def test_refreshing_folds_the_write_deltas_into_the_stats(
+            self, app: FastAPI, client: AsyncClient, db: Database, varied_cleanings: List[CleaningInDB]
+    ) -> None:
+        cleanings_repo = CleaningsRepository(db)
+        deltas = await db.fetch_val("SELECT count(*) FROM cleaning_stats_deltas")
+        assert deltas > 0
+        # An update that changes neither a type nor a price leaves no delta
+        await db.execute("UPDATE cleanings SET name = upper(name)")
+        assert await db.fetch_val("SELECT count(*) FROM cleaning_stats_deltas") == deltas
+
+        await cleanings_repo.refresh_price_distribution()
+        assert await db.fetch_val("SELECT count(*) FROM cleaning_stats_deltas") == 0
+        stats = {s.cleaning_type: (s.count, s.average_price) for s in (await cleanings_repo.get_stats()).types}
+        assert stats == {"dust_up": (2, 17.75), "spot_clean": (2, 27.5), "full_clean": (1, 120.0)}
+
+        await db.execute("TRUNCATE cleanings")
+        assert [s.count for s in (await cleanings_repo.get_stats()).types] == [0, 0, 0]
@@ -0,0 +1,168 @@
+import asyncio
+from typing import Dict, List
+
+import pytest
+from databases import Database
+from fastapi import FastAPI, status
+from httpx import AsyncClient
+
+from app.db.coalescing import ReadCoalescer
+from app.db.repositories.cleanings import CleaningsRepository
+from app.models.cleaning import CleaningCreate, CleaningInDB
+
+pytestmark = pytest.mark.asyncio
+
+
+class SlowLoader:
+    def __init__(self) -> None:
+        self.calls = []  # type: List[List[int]]
+
+    async def __call__(self, keys: List[int]) -> Dict[int, str]:
+        self.calls.append(keys)
+        await asyncio.sleep(0.01)
+        return {key: f"value {key}" for key in keys if key > 0}
+
+
+class TestSingleFlight:
+    async def test_concurrent_identical_calls_share_one(self) -> None:
+        coalescer, calls = ReadCoalescer(), []
+
+        async def call(key: str) -> str:
+            calls.append(key)
+            await asyncio.sleep(0.01)
+            return key.upper()
+
+        results = await asyncio.gather(
+            *(coalescer.single_flight("a", lambda: call("a")) for _ in range(5)),
+            coalescer.single_flight("b", lambda: call("b")),
+        )
+
+        assert results == ["A"] * 5 + ["B"]
+        assert calls == ["a", "b"]
+        assert coalescer.stats()["single_flight"] == {"reads": 6, "queries": 2, "ratio": 3.0}
+
+        # Once landed, the next call runs again
+        await coalescer.single_flight("a", lambda: call("a"))
+        assert calls == ["a", "b", "a"]
+
+    async def test_cancelled_caller_does_not_cancel_the_others(self) -> None:
+        coalescer, release = ReadCoalescer(), asyncio.Event()
+
+        async def call() -> str:
+            await release.wait()
+            return "done"
+
+        first = asyncio.ensure_future(coalescer.single_flight("key", call))
+        second = asyncio.ensure_future(coalescer.single_flight("key", call))
+        await asyncio.sleep(0)
+        first.cancel()
+        release.set()
+
+        assert await second == "done"
+        assert first.cancelled()
+
+    async def test_flights_nobody_waits_for_are_cancelled(self) -> None:
+        coalescer, stopped = ReadCoalescer(), asyncio.Event()
+
+        async def call() -> None:
+            try:
+                await asyncio.sleep(5)
+            finally:
+                stopped.set()
+
+        waiting = [asyncio.ensure_future(coalescer.single_flight("key", call)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for caller in waiting:
+            caller.cancel()
+        await asyncio.wait_for(stopped.wait(), 1)
+
+    async def test_forget_starts_a_new_flight(self) -> None:
+        coalescer, versions = ReadCoalescer(), iter(range(10))
+
+        async def call() -> int:
+            version = next(versions)
+            await asyncio.sleep(0.01)
+            return version
+
+        before = asyncio.ensure_future(coalescer.single_flight("key", call))
+        await asyncio.sleep(0)
+        coalescer.forget()
+        after = await coalescer.single_flight("key", call)
+
+        assert (await before, after) == (0, 1)
+
+
+class TestBatching:
+    async def test_lookups_within_the_window_share_a_query(self) -> None:
+        coalescer, loader = ReadCoalescer(batching=True, batch_window=0.005, max_batch_size=3), SlowLoader()
+
+        results = await asyncio.gather(*(coalescer.load("group", key, loader) for key in [1, 2, 2, 3, -1]))
+
+        assert results == ["value 1", "value 2", "value 2", "value 3", None]
+        # The third distinct key filled the first batch
+        assert loader.calls == [[1, 2, 3], [-1]]
+        assert coalescer.stats()["batch"]["queries"] == 2
+
+    async def test_groups_are_batched_apart(self) -> None:
+        coalescer, loader = ReadCoalescer(batching=True, batch_window=0), SlowLoader()
+
+        await asyncio.gather(coalescer.load("primary", 1, loader), coalescer.load("replica", 2, loader))
+
+        assert sorted(loader.calls) == [[1], [2]]
+
+    async def test_failures_reach_every_lookup(self) -> None:
+        coalescer = ReadCoalescer(batching=True, batch_window=0)
+
+        async def broken(keys: List[int]) -> Dict[int, str]:
+            raise RuntimeError("database is gone")
+
+        results = await asyncio.gather(*(coalescer.load("group", key, broken) for key in [1, 2]),
+                                       return_exceptions=True)
+
+        assert [str(result) for result in results] == ["database is gone"] * 2
+
+
+class TestCoalescedCleaningReads:
+    async def test_concurrent_requests_for_a_cleaning_share_a_query(
+            self, app: FastAPI, client: AsyncClient, sample_cleaning: CleaningInDB
+    ) -> None:
+        url = app.url_path_for("cleanings:get-cleaning-by-id", cleaning_id=sample_cleaning.id)
+
+        responses = await asyncio.gather(*(client.get(url) for _ in range(20)))
+
+        assert {res.status_code for res in responses} == {status.HTTP_200_OK}
+        stats = app.state.coalescer.stats()["single_flight"]
+        assert stats["queries"] < stats["reads"]
+
+    async def test_lookups_of_different_cleanings_are_batched(
+            self, app: FastAPI, client: AsyncClient, db: Database
+    ) -> None:
+        app.state.coalescer = ReadCoalescer(batching=True, batch_window=0.01)
+        cleanings_repo = CleaningsRepository(db)
+        ids = [
+            (await cleanings_repo.create_cleaning(new_cleaning=CleaningCreate(name=f"cleaning {n}", price=n))).id
+            for n in range(1, 4)
+        ]
+
+        responses = await asyncio.gather(*(
+            client.get(app.url_path_for("cleanings:get-cleaning-by-id", cleaning_id=cleaning_id))
+            for cleaning_id in ids + [9999]
+        ))
+
+        assert [res.json().get("id") for res in responses[:3]] == ids
+        assert responses[3].status_code == status.HTTP_404_NOT_FOUND
+        assert app.state.coalescer.stats()["batch"] == {"reads": 4, "queries": 1, "ratio": 4.0}
+
+    # Every read of a rolled back test is in a transaction
+    @pytest.mark.committed
+    async def test_reads_in_a_transaction_are_not_coalesced(
+            self, app: FastAPI, client: AsyncClient, db: Database, sample_cleaning: CleaningInDB
+    ) -> None:
+        coalescer = ReadCoalescer()
+        cleanings_repo = CleaningsRepository(db, coalescer=coalescer)
+
+        async with db.transaction(force_rollback=True):
+            await cleanings_repo.get_cleaning_by_id(get_id=sample_cleaning.id)
+        await cleanings_repo.get_cleaning_by_id(get_id=sample_cleaning.id)
+
+        assert coalescer.stats()["single_flight"]["reads"] == 1
@@ -0,0 +1,178 @@
+import asyncio
+import time
+from typing import Optional
+
+import asyncpg
+import pytest
+from databases import Database
+from fastapi import FastAPI, status
+from httpx import AsyncClient
+from prometheus_client import REGISTRY
+
+from app.core.cancellation import DEADLINE, DISCONNECTED, CancellationMiddleware
+from app.core.context import DeadlineExceeded, RequestContext, RequestContextMiddleware
+from app.db.repositories.base import InstrumentedDatabase
+from app.db.repositories.cleanings import CleaningsRepository
+from app.models.cleaning import CleaningInDB, CleaningUpdate
+
+pytestmark = pytest.mark.asyncio
+
+
+def cancelled(reason: str) -> float:
+    return REGISTRY.get_sample_value("http_requests_cancelled_total", {"reason": reason}) or 0.0
+
+
+async def running_sleeps(db: Database) -> int:
+    # The server is asked to cancel over a connection of its own, give it a moment
+    for _ in range(50):
+        running = await db.fetch_val(
+            "SELECT count(*) FROM pg_stat_activity "
+            "WHERE query LIKE 'SELECT pg_sleep%' AND state = 'active' AND pid != pg_backend_pid()"
+        )
+        if not running:
+            break
+        await asyncio.sleep(0.02)
+    return running
+
+
+@pytest.mark.parametrize(
+    "timeout, requested, expected",
+    (
+            (30.0, None, 30.0),
+            (30.0, "0.5", 0.5),
+            (30.0, "60", 30.0),
+            (30.0, "soon", 30.0),
+            (30.0, "-1", 30.0),
+            (None, None, None),
+            (None, "0.5", 0.5),
+    ),
+)
+def test_clients_can_only_shorten_the_deadline(
+        timeout: Optional[float], requested: Optional[str], expected: Optional[float]
+) -> None:
+    headers = [(b"x-request-timeout", requested.encode())] if requested is not None else []
+    middleware = RequestContextMiddleware(None, timeout=timeout)
+
+    deadline = middleware._deadline({"type": "http", "headers": headers})
+    if expected is None:
+        assert deadline is None
+    else:
+        assert deadline - time.monotonic() == pytest.approx(expected, abs=0.1)
+
+
+@pytest.mark.committed
+class TestQueryDeadlines:
+    async def test_queries_are_cancelled_at_the_deadline(self, app: FastAPI, client: AsyncClient, db: Database) -> None:
+        started = time.monotonic()
+        with pytest.raises(DeadlineExceeded):
+            await InstrumentedDatabase(db, "test", deadline=started + 0.2).fetch_val("SELECT pg_sleep(5)")
+        assert time.monotonic() - started < 2
+        # Cancelled on the server too, and the connection is fit for the next query
+        assert await running_sleeps(db) == 0
+        assert await db.fetch_val("SELECT 1") == 1
+
+        with pytest.raises(DeadlineExceeded):
+            await InstrumentedDatabase(db, "test", deadline=time.monotonic()).execute("SELECT pg_sleep(5)")
+
+    async def test_requests_past_their_deadline_get_a_504(
+            self, app: FastAPI, client: AsyncClient, db: Database, sample_cleaning: CleaningInDB, monkeypatch
+    ) -> None:
+        async def slow_get_cleaning_by_id(self: CleaningsRepository, *, get_id: int) -> Optional[CleaningInDB]:
+            await self.read_db.fetch_val("SELECT pg_sleep(5)")
+
+        monkeypatch.setattr(CleaningsRepository, "get_cleaning_by_id", slow_get_cleaning_by_id)
+        url = app.url_path_for("cleanings:get-cleaning-by-id", cleaning_id=sample_cleaning.id)
+
+        started = time.monotonic()
+        res = await client.get(url, headers={"X-Request-Timeout": "0.2"})
+        assert res.status_code == status.HTTP_504_GATEWAY_TIMEOUT
+        assert res.json() == {"detail": "Request timed out."}
+        assert time.monotonic() - started < 2
+        assert await running_sleeps(db) == 0
+
+        monkeypatch.undo()
+        res = await client.get(url, headers={"X-Request-Timeout": "5"})
+        assert res.status_code == status.HTTP_200_OK
+
+    async def test_writes_past_their_deadline_are_not_blamed_on_their_input(
+            self, app: FastAPI, client: AsyncClient, db: Database, sample_cleaning: CleaningInDB
+    ) -> None:
+        cleaning_update = CleaningUpdate(price=12.5)
+        with pytest.raises(DeadlineExceeded):
+            await CleaningsRepository(db, deadline=time.monotonic()).update_cleaning(
+                update_id=sample_cleaning.id, cleaning_update=cleaning_update
+            )
+
+        url = app.url_path_for("cleanings:update-cleaning-by-id", cleaning_id=sample_cleaning.id)
+        # The row is locked by another session until long after the deadline
+        locker = await asyncpg.connect(str(db.url))
+        try:
+            async with locker.transaction():
+                await locker.execute("SELECT 1 FROM cleanings WHERE id = $1 FOR UPDATE", sample_cleaning.id)
+                res = await client.put(url, json={"cleaning_update": cleaning_update.dict(exclude_unset=True)},
+                                       headers={"X-Request-Timeout": "0.2"})
+        finally:
+            await locker.close()
+        assert res.status_code == status.HTTP_504_GATEWAY_TIMEOUT
+
+        res = await client.put(url, json={"cleaning_update": {"name": None}})
+        assert res.status_code == status.HTTP_400_BAD_REQUEST
+
+
+class TestCancellationMiddleware:
+    @staticmethod
+    async def serve(endpoint, *, deadline: float = None, disconnect: asyncio.Event = None) -> list:
+        sent, messages = [], [{"type": "http.request", "body": b""}]
+
+        async def receive() -> dict:
+            if messages:
+                return messages.pop()
+            if disconnect is None:
+                await asyncio.Future()
+            await disconnect.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message: dict) -> None:
+            sent.append(message)
+
+        scope = {
+            "type": "http", "method": "GET", "path": "/", "headers": [],
+            "state": {"context": RequestContext(deadline=deadline)},
+        }
+        await asyncio.wait_for(CancellationMiddleware(endpoint)(scope, receive, send), 5)
+        return sent
+
+    async def test_handlers_are_cancelled_when_the_client_leaves(self) -> None:
+        disconnect, handled = asyncio.Event(), asyncio.Event()
+        before = cancelled(DISCONNECTED)
+
+        async def endpoint(scope, receive, send) -> None:
+            try:
+                disconnect.set()
+                await asyncio.sleep(5)
+            finally:
+                handled.set()
+
+        assert await self.serve(endpoint, disconnect=disconnect) == []
+        assert handled.is_set()
+        assert cancelled(DISCONNECTED) == before + 1
+
+    async def test_handlers_not_answering_by_the_deadline_get_a_504(self) -> None:
+        before = cancelled(DEADLINE)
+
+        async def endpoint(scope, receive, send) -> None:
+            assert (await receive())["type"] == "http.request"
+            await asyncio.sleep(5)
+
+        sent = await self.serve(endpoint, deadline=time.monotonic() + 0.05)
+        assert sent[0]["status"] == status.HTTP_504_GATEWAY_TIMEOUT
+        assert cancelled(DEADLINE) == before + 1
+
+    async def test_started_responses_are_let_finish(self) -> None:
+        async def endpoint(scope, receive, send) -> None:
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await asyncio.sleep(0.1)
+            await send({"type": "http.response.body", "body": b"done"})
+
+        sent = await self.serve(endpoint, deadline=time.monotonic() + 0.05)
+        assert [message.get("body") for message in sent] == [None, b"done"]
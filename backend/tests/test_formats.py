@@ -0,0 +1,175 @@
+import asyncio
+import gzip
+import zlib
+from typing import List
+
+import brotli
+import msgpack
+import pytest
+from databases import Database
+from fastapi import FastAPI, status
+from httpx import AsyncClient
+from pydantic import parse_obj_as
+from starlette.responses import StreamingResponse
+
+from app.api.responses import negotiate_format
+from app.core.compression import CompressionMiddleware, accepted_encoding
+from app.db.repositories.cleanings import CleaningsRepository
+from app.models.cleaning import CleaningCreate, CleaningInDB
+from app.models.enum_type import ResponseFormat
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.fixture
+async def long_cleanings(db: Database) -> List[CleaningInDB]:
+    return await CleaningsRepository(db).create_cleanings(new_cleanings=[
+        CleaningCreate(name=f"cleaning {n}", description="a long description of what is cleaned " * 5, price=n)
+        for n in range(1, 21)
+    ])
+
+
+@pytest.mark.parametrize(
+    "accept, expected",
+    (
+            (None, ResponseFormat.json),
+            ("*/*", ResponseFormat.json),
+            ("application/msgpack", ResponseFormat.msgpack),
+            ("application/x-msgpack", ResponseFormat.msgpack),
+            ("application/json;q=0.9, application/msgpack", ResponseFormat.msgpack),
+            ("application/msgpack;q=0.5, */*;q=0.8", ResponseFormat.json),
+            ("application/msgpack;q=0, application/vnd.phresh.columns+json", ResponseFormat.json_columns),
+            ("text/html", ResponseFormat.json),
+    ),
+)
+def test_formats_are_negotiated(accept: str, expected: ResponseFormat) -> None:
+    assert negotiate_format(accept) is expected
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, expected",
+    (
+            ("", None),
+            ("gzip, deflate", "gzip"),
+            ("gzip, deflate, br", "br"),
+            ("br;q=0.5, gzip", "gzip"),
+            ("*", "br"),
+            ("gzip;q=0, identity", None),
+    ),
+)
+def test_encodings_are_negotiated(accept_encoding: str, expected: str) -> None:
+    assert accepted_encoding(accept_encoding) == expected
+
+
+class TestResponseFormats:
+    @pytest.mark.parametrize("fast_serialization", (False, True))
+    async def test_msgpack_matches_json(
+            self, app: FastAPI, client: AsyncClient, long_cleanings: List[CleaningInDB], monkeypatch,
+            fast_serialization: bool
+    ) -> None:
+        monkeypatch.setattr("app.core.config.FAST_SERIALIZATION", fast_serialization)
+        url = app.url_path_for("cleanings:get-all-cleanings")
+
+        res = await client.get(url, params={"limit": 5}, headers={"Accept": "application/msgpack"})
+        assert res.status_code == status.HTTP_200_OK
+        assert res.headers["content-type"] == "application/msgpack"
+        assert "Accept" in res.headers["vary"]
+        assert "X-Next-Cursor" in res.headers
+        assert parse_obj_as(List[CleaningInDB], msgpack.unpackb(res.content, timestamp=3)) == long_cleanings[:5]
+
+        json_res = await client.get(url, params={"limit": 5})
+        assert len(res.content) < len(json_res.content)
+
+        res = await client.get(app.url_path_for("cleanings:get-cleaning-by-id", cleaning_id=long_cleanings[0].id),
+                               headers={"Accept": "application/msgpack"})
+        assert CleaningInDB.parse_obj(msgpack.unpackb(res.content, timestamp=3)) == long_cleanings[0]
+
+    async def test_lists_can_be_sent_as_columns(
+            self, app: FastAPI, client: AsyncClient, long_cleanings: List[CleaningInDB]
+    ) -> None:
+        url = app.url_path_for("cleanings:get-all-cleanings")
+
+        res = await client.get(url, headers={"Accept": "application/vnd.phresh.columns+json"})
+        assert res.headers["content-type"] == "application/vnd.phresh.columns+json"
+        columns = res.json()
+        assert columns["id"] == [cleaning.id for cleaning in long_cleanings]
+        assert columns["price"] == [cleaning.price for cleaning in long_cleanings]
+
+        res = await client.get(url, params={"min_price": 1000},
+                               headers={"Accept": "application/vnd.phresh.columns+msgpack"})
+        assert msgpack.unpackb(res.content) == {}
+
+        # Not a list: rows in the same encoding
+        res = await client.get(app.url_path_for("cleanings:get-cleaning-by-id", cleaning_id=long_cleanings[0].id),
+                               headers={"Accept": "application/vnd.phresh.columns+msgpack"})
+        assert res.headers["content-type"] == "application/msgpack"
+        assert msgpack.unpackb(res.content, timestamp=3)["id"] == long_cleanings[0].id
+
+
+class TestCompression:
+    @pytest.mark.parametrize("encoding, decompress", (("gzip", gzip.decompress), ("br", brotli.decompress)))
+    async def test_large_responses_are_compressed(
+            self, app: FastAPI, client: AsyncClient, long_cleanings: List[CleaningInDB], encoding: str, decompress
+    ) -> None:
+        url = app.url_path_for("cleanings:get-all-cleanings")
+
+        async with client.stream("GET", url, headers={"Accept-Encoding": encoding}) as res:
+            raw = b"".join([chunk async for chunk in res.aiter_raw()])
+        assert res.headers["content-encoding"] == encoding
+        assert int(res.headers["content-length"]) == len(raw)
+        assert "Accept-Encoding" in res.headers["vary"]
+
+        plain = await client.get(url, headers={"Accept-Encoding": "identity"})
+        assert "content-encoding" not in plain.headers
+        assert decompress(raw) == plain.content
+        assert len(raw) < len(plain.content) / 4
+
+    async def test_small_responses_are_not_compressed(
+            self, app: FastAPI, client: AsyncClient, long_cleanings: List[CleaningInDB]
+    ) -> None:
+        res = await client.get(app.url_path_for("cleanings:get-cleaning-by-id", cleaning_id=long_cleanings[0].id),
+                               headers={"Accept-Encoding": "gzip"})
+        assert "content-encoding" not in res.headers
+
+    async def test_streamed_responses_are_compressed(
+            self, app: FastAPI, client: AsyncClient, long_cleanings: List[CleaningInDB]
+    ) -> None:
+        res = await client.get(app.url_path_for("cleanings:get-all-cleanings"),
+                               headers={"Accept": "application/x-ndjson", "Accept-Encoding": "gzip"})
+        assert res.headers["content-encoding"] == "gzip"
+        assert "content-length" not in res.headers
+        assert len(res.text.splitlines()) == len(long_cleanings)
+
+    async def test_event_streams_are_flushed_after_every_chunk(self) -> None:
+        sent, next_chunk = [], asyncio.Event()
+
+        async def events():
+            for n in range(3):
+                yield f"data: {n}\n\n"
+                await next_chunk.wait()
+                next_chunk.clear()
+
+        async def endpoint(scope, receive, send) -> None:
+            await StreamingResponse(events(), media_type="text/event-stream")(scope, receive, send)
+
+        async def receive() -> dict:
+            # The client never leaves
+            await asyncio.Future()
+
+        async def send(message: dict) -> None:
+            sent.append(message)
+
+        scope = {"type": "http", "method": "GET", "path": "/", "headers": [(b"accept-encoding", b"gzip")]}
+        streaming = asyncio.ensure_future(CompressionMiddleware(endpoint)(scope, receive, send))
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        for n in range(3):
+            for _ in range(500):
+                if len(sent) == n + 2:
+                    break
+                await asyncio.sleep(0.01)
+            # Readable before the next event is produced
+            assert decompressor.decompress(sent[-1]["body"]) == f"data: {n}\n\n".encode()
+            next_chunk.set()
+        await asyncio.wait_for(streaming, 5)
+
+        assert dict(sent[0]["headers"])[b"content-encoding"] == b"gzip"
@@ -0,0 +1,55 @@
+import pytest
+from databases import Database
+from fastapi import FastAPI, status
+from httpx import AsyncClient
+
+from app.db.pool import InstrumentedPool, get_pool
+
+pytestmark = pytest.mark.asyncio
+
+
+class TestHealth:
+    async def test_live_does_not_touch_database(self, app: FastAPI, client: AsyncClient) -> None:
+        res = await client.get(app.url_path_for("health:live"))
+        assert res.status_code == status.HTTP_200_OK
+        assert res.json() == {"status": "ok"}
+
+    # Pool stats need the pool, not one connection shared by everything
+    @pytest.mark.committed
+    async def test_ready_reports_pool_stats(self, app: FastAPI, client: AsyncClient, db: Database) -> None:
+        from app.core import config
+
+        res = await client.get(app.url_path_for("health:ready"))
+        assert res.status_code == status.HTTP_200_OK
+
+        body = res.json()
+        assert body["status"] == "ok"
+        assert body["pool"]["min_size"] == config.DB_MIN_POOL_SIZE
+        assert body["pool"]["max_size"] == config.DB_MAX_POOL_SIZE
+        assert body["pool"]["acquired_total"] >= 1
+        assert body["pool"]["acquire_seconds_buckets"]["+Inf"] == body["pool"]["acquired_total"]
+
+
+# Exhausting the pool needs the pool, not one connection shared by everything
+@pytest.mark.committed
+class TestPoolExhaustion:
+    async def test_exhausted_pool_returns_service_unavailable(
+        self, app: FastAPI, client: AsyncClient, db: Database
+    ) -> None:
+        pool = get_pool(db)
+        assert isinstance(pool, InstrumentedPool)
+        pool.acquire_timeout = 0.05
+
+        held = [await pool.acquire() for _ in range(pool.stats()["max_size"])]
+        try:
+            res = await client.get(app.url_path_for("cleanings:get-all-cleanings"))
+            assert res.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+            assert "Retry-After" in res.headers
+            assert pool.stats()["timeouts_total"] == 1
+            assert pool.stats()["in_use"] == len(held)
+        finally:
+            for connection in held:
+                await pool.release(connection)
+
+        res = await client.get(app.url_path_for("cleanings:get-all-cleanings"))
+        assert res.status_code == status.HTTP_200_OK
@@ -0,0 +1,212 @@
+import asyncio
+from typing import Optional
+
+import asyncpg
+import pytest
+from databases import Database
+from fastapi import FastAPI, status
+from httpx import AsyncClient
+
+from app.db.repositories.jobs import JobsRepository
+from app.jobs.handlers import ImportCleaningsPayload, JobHandler, NoPayload, import_cleanings
+from app.jobs.worker import JobWorker
+from app.models.job import JobCreate
+
+pytestmark = pytest.mark.asyncio
+
+
+def new_import(*prices: float) -> dict:
+    return {"new_job": {"kind": "import_cleanings", "payload": {"new_cleanings": [
+        {"name": f"imported {index}", "price": price, "cleaning_type": "dust_up"} for index, price in enumerate(prices)
+    ]}}}
+
+
+async def enqueue(db: Database, kind: str, max_attempts: int = 3) -> int:
+    job = await JobsRepository(db).enqueue_job(new_job=JobCreate.construct(kind=kind, payload={}, max_attempts=None),
+                                               default_max_attempts=max_attempts)
+    return job.id
+
+
+class FlakyHandler:
+    def __init__(self, failures: int) -> None:
+        self.failures = failures
+        self.calls = 0
+
+    async def __call__(self, database: Database, payload: NoPayload) -> Optional[dict]:
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise RuntimeError(f"failure {self.calls}")
+        return {"calls": self.calls}
+
+
+class TestJobsRoutes:
+    # The worker claims jobs on connections of its own
+    @pytest.mark.committed
+    async def test_enqueued_job_runs_in_the_worker(self, app: FastAPI, client: AsyncClient, db: Database) -> None:
+        res = await client.post(app.url_path_for("jobs:enqueue-job"), json=new_import(10.00, 20.00, 30.00))
+        assert res.status_code == status.HTTP_202_ACCEPTED
+        job = res.json()
+        assert job["status"] == "queued"
+        assert "payload" not in job
+        assert res.headers["Location"].endswith(app.url_path_for("jobs:get-job-by-id", job_id=str(job["id"])))
+
+        # Nothing ran inline
+        res = await client.get(app.url_path_for("cleanings:get-all-cleanings"))
+        assert res.json() == []
+
+        assert await JobWorker(db, retry_delay=0).run_once() is True
+
+        res = await client.get(app.url_path_for("jobs:get-job-by-id", job_id=str(job["id"])))
+        assert res.status_code == status.HTTP_200_OK
+        assert res.json()["status"] == "succeeded"
+        assert res.json()["attempts"] == 1
+        assert res.json()["result"] == {"created": 3}
+
+        res = await client.get(app.url_path_for("cleanings:get-all-cleanings"))
+        assert [cleaning["price"] for cleaning in res.json()] == [10.0, 20.0, 30.0]
+
+    async def test_invalid_payload_is_rejected_on_enqueue(self, app: FastAPI, client: AsyncClient) -> None:
+        res = await client.post(app.url_path_for("jobs:enqueue-job"), json={
+            "new_job": {"kind": "import_cleanings", "payload": {"new_cleanings": [{"name": "no price"}]}},
+        })
+        assert res.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+        res = await client.post(app.url_path_for("jobs:enqueue-job"), json={"new_job": {"kind": "unknown"}})
+        assert res.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+    async def test_unknown_job_returns_404(self, app: FastAPI, client: AsyncClient) -> None:
+        res = await client.get(app.url_path_for("jobs:get-job-by-id", job_id="500"))
+        assert res.status_code == status.HTTP_404_NOT_FOUND
+
+
+# The worker claims jobs on connections of its own
+@pytest.mark.committed
+class TestJobWorker:
+    async def test_failed_jobs_are_retried_until_out_of_attempts(
+            self, app: FastAPI, client: AsyncClient, db: Database
+    ) -> None:
+        flaky, broken = FlakyHandler(failures=1), FlakyHandler(failures=10)
+        worker = JobWorker(db, {"flaky": JobHandler(flaky, NoPayload), "broken": JobHandler(broken, NoPayload)},
+                           retry_delay=0)
+        jobs_repo = JobsRepository(db)
+        flaky_id, broken_id = await enqueue(db, "flaky"), await enqueue(db, "broken", max_attempts=2)
+
+        while await worker.run_once():
+            pass
+
+        flaky_job = await jobs_repo.get_job_by_id(job_id=flaky_id)
+        assert (flaky_job.status, flaky_job.attempts, flaky_job.result) == ("succeeded", 2, {"calls": 2})
+
+        broken_job = await jobs_repo.get_job_by_id(job_id=broken_id)
+        assert (broken_job.status, broken_job.attempts, broken_job.error) == ("failed", 2, "RuntimeError: failure 2")
+        assert broken_job.finished_at is not None
+
+    async def test_retries_back_off(self, app: FastAPI, client: AsyncClient, db: Database) -> None:
+        worker = JobWorker(db, {"flaky": JobHandler(FlakyHandler(failures=1), NoPayload)}, retry_delay=60)
+        await enqueue(db, "flaky")
+
+        assert await worker.run_once() is True
+        # The retry is not due yet
+        assert await worker.run_once() is False
+
+        assert 30 <= worker.backoff(1) <= 60
+        assert 60 <= worker.backoff(2) <= 120
+        assert worker.backoff(20) <= worker.max_retry_delay
+
+    async def test_concurrent_claims_skip_locked_jobs(self, app: FastAPI, client: AsyncClient, db: Database) -> None:
+        job_ids = {await enqueue(db, "noop") for _ in range(3)}
+
+        async def claim():
+            # A task of its own, so it gets its own pooled connection
+            async with db.connection():
+                return await JobsRepository(db).claim_job(worker="test", kinds=["noop"], lease_seconds=60)
+
+        claimed = await asyncio.gather(*(claim() for _ in range(5)))
+        assert {job.id for job in claimed if job is not None} == job_ids
+        assert sum(job is None for job in claimed) == 2
+
+    async def test_kind_concurrency_is_limited(self, app: FastAPI, client: AsyncClient, db: Database) -> None:
+        release, running = asyncio.Event(), []
+
+        async def slow(database: Database, payload: NoPayload) -> None:
+            running.append(payload)
+            await release.wait()
+
+        worker = JobWorker(db, {"slow": JobHandler(slow, NoPayload, concurrency=1)})
+        await enqueue(db, "slow")
+        await enqueue(db, "slow")
+
+        first = asyncio.ensure_future(worker.run_once())
+        while not running:
+            await asyncio.sleep(0.01)
+        # The only slot of the kind is taken, so the second job waits even though the worker has room
+        assert await worker.run_once() is False
+
+        release.set()
+        assert await first is True
+        assert await worker.run_once() is True
+        assert len(running) == 2
+
+    async def test_expired_leases_are_reaped(self, app: FastAPI, client: AsyncClient, db: Database) -> None:
+        jobs_repo = JobsRepository(db)
+        job_id = await enqueue(db, "noop")
+        claimed = await jobs_repo.claim_job(worker="dead worker", kinds=["noop"], lease_seconds=0)
+
+        assert await jobs_repo.reap_expired_jobs() == [job_id]
+        job = await jobs_repo.get_job_by_id(job_id=job_id)
+        assert (job.status, job.error) == ("queued", "lease expired on worker dead worker")
+
+        # The worker that lost its claim cannot complete the job anymore
+        assert await jobs_repo.complete_job(job=claimed, result=None) is False
+
+    async def test_imports_of_jobs_handed_to_another_worker_are_rolled_back(
+            self, app: FastAPI, client: AsyncClient, db: Database
+    ) -> None:
+        reaper, runs = await asyncpg.connect(str(db.url)), []
+
+        async def import_reaped_once(database: Database, payload: ImportCleaningsPayload) -> dict:
+            result = await import_cleanings(database, payload)
+            runs.append(result)
+            if len(runs) == 1:
+                # As if the lease ran out before the worker got to complete the job
+                await reaper.execute("UPDATE jobs SET status = 'queued', locked_by = NULL, locked_until = NULL")
+            return result
+
+        worker = JobWorker(db, {"import_cleanings": JobHandler(
+            import_reaped_once, ImportCleaningsPayload, transactional=True
+        )})
+        try:
+            res = await client.post(app.url_path_for("jobs:enqueue-job"), json=new_import(10.00, 20.00))
+            job_id = res.json()["id"]
+
+            assert await worker.run_once() is True
+            assert (await JobsRepository(db).get_job_by_id(job_id=job_id)).status == "queued"
+            res = await client.get(app.url_path_for("cleanings:get-all-cleanings"))
+            assert res.json() == []
+
+            # Run again, the cleanings are imported once
+            assert await worker.run_once() is True
+            job = await JobsRepository(db).get_job_by_id(job_id=job_id)
+            assert (job.status, job.attempts, job.result) == ("succeeded", 2, {"created": 2})
+            res = await client.get(app.url_path_for("cleanings:get-all-cleanings"))
+            assert [cleaning["price"] for cleaning in res.json()] == [10.0, 20.0]
+        finally:
+            await reaper.close()
+
+    async def test_stop_hands_unfinished_jobs_back(self, app: FastAPI, client: AsyncClient, db: Database) -> None:
+        started = asyncio.Event()
+
+        async def endless(database: Database, payload: NoPayload) -> None:
+            started.set()
+            await asyncio.sleep(3600)
+
+        worker = JobWorker(db, {"endless": JobHandler(endless, NoPayload)}, concurrency=1, shutdown_timeout=0.1)
+        job_id = await enqueue(db, "endless")
+
+        running = asyncio.ensure_future(worker.run())
+        await started.wait()
+        worker.stop()
+        await running
+
+        job = await JobsRepository(db).get_job_by_id(job_id=job_id)
+        assert (job.status, job.attempts) == ("queued", 0)
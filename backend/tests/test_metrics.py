@@ -0,0 +1,116 @@
+import os
+import subprocess
+import sys
+
+import pytest
+from databases import Database
+from fastapi import FastAPI, status
+from httpx import AsyncClient
+from prometheus_client import REGISTRY
+
+from app.db.repositories.cleanings import CleaningsRepository
+from app.models.cleaning import CleaningInDB
+
+pytestmark = pytest.mark.asyncio
+
+
+def sample(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+class TestRequestMetrics:
+    async def test_requests_are_labelled_by_route_name(
+        self, app: FastAPI, client: AsyncClient, sample_cleaning: CleaningInDB
+    ) -> None:
+        route = "cleanings:get-cleaning-by-id"
+        before = sample("http_requests_total", route=route, method="GET", status="200")
+        before_missing = sample("http_requests_total", route=route, method="GET", status="404")
+
+        await client.get(app.url_path_for(route, cleaning_id=str(sample_cleaning.id)))
+        await client.get(app.url_path_for(route, cleaning_id="500000"))
+
+        assert sample("http_requests_total", route=route, method="GET", status="200") == before + 1
+        assert sample("http_requests_total", route=route, method="GET", status="404") == before_missing + 1
+        assert sample("http_request_duration_seconds_count", route=route, method="GET") >= 2
+
+    async def test_routes_sharing_an_endpoint_keep_their_own_name(
+        self, app: FastAPI, client: AsyncClient, sample_cleaning: CleaningInDB
+    ) -> None:
+        route = "cleanings:patch-cleaning-by-id"
+        before = sample("http_requests_total", route=route, method="PATCH", status="200")
+
+        res = await client.patch(
+            app.url_path_for(route, cleaning_id=str(sample_cleaning.id)), json={"cleaning_update": {"price": 1.5}}
+        )
+        assert res.status_code == status.HTTP_200_OK
+
+        assert sample("http_requests_total", route=route, method="PATCH", status="200") == before + 1
+
+    async def test_unknown_paths_share_one_label(self, client: AsyncClient) -> None:
+        before = sample("http_requests_total", route="<unmatched>", method="GET", status="404")
+
+        await client.get("/api/does-not-exist/1")
+        await client.get("/api/does-not-exist/2")
+
+        assert sample("http_requests_total", route="<unmatched>", method="GET", status="404") == before + 2
+
+    async def test_metrics_endpoint_exposes_prometheus_text(self, app: FastAPI, client: AsyncClient) -> None:
+        await client.get(app.url_path_for("cleanings:get-all-cleanings"))
+
+        res = await client.get(app.url_path_for("metrics"))
+        assert res.status_code == status.HTTP_200_OK
+        assert res.headers["content-type"].startswith("text/plain")
+        assert 'route="cleanings:get-all-cleanings"' in res.text
+        assert "db_query_duration_seconds_bucket" in res.text
+
+
+class TestQueryMetrics:
+    async def test_queries_are_timed_per_repository_method(
+        self, app: FastAPI, client: AsyncClient, db: Database
+    ) -> None:
+        labels = {"repository": "CleaningsRepository", "method": "get_all_cleanings"}
+        before = sample("db_query_duration_seconds_count", **labels)
+
+        await CleaningsRepository(db).get_all_cleanings(limit=10)
+
+        assert sample("db_query_duration_seconds_count", **labels) == before + 1
+        assert sample("db_query_duration_seconds_sum", **labels) > 0
+
+    # Streams read on a connection of their own while other queries run
+    @pytest.mark.committed
+    async def test_streamed_queries_are_timed_once(self, app: FastAPI, client: AsyncClient, db: Database) -> None:
+        labels = {"repository": "CleaningsRepository", "method": "iterate_cleanings"}
+        before = sample("db_query_duration_seconds_count", **labels)
+
+        async for _ in CleaningsRepository(db).iterate_cleanings():
+            pass
+
+        assert sample("db_query_duration_seconds_count", **labels) == before + 1
+
+
+WORKER_SCRIPT = """
+from app.core.metrics import HTTP_REQUESTS
+HTTP_REQUESTS.labels("cleanings:get-all-cleanings", "GET", "200").inc(3)
+"""
+
+SCRAPE_SCRIPT = """
+import sys
+from app.core.metrics import render_metrics
+sys.stdout.write(render_metrics().decode())
+"""
+
+
+class TestMultiprocessMetrics:
+    def test_metrics_are_aggregated_across_worker_processes(self, tmp_path) -> None:
+        env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path))
+        cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+        for _ in range(2):
+            subprocess.run([sys.executable, "-c", WORKER_SCRIPT], env=env, cwd=cwd, check=True)
+        scraped = subprocess.run(
+            [sys.executable, "-c", SCRAPE_SCRIPT], env=env, cwd=cwd, check=True, stdout=subprocess.PIPE
+        ).stdout.decode()
+
+        assert (
+            'http_requests_total{method="GET",route="cleanings:get-all-cleanings",status="200"} 6.0' in scraped
+        )
@@ -0,0 +1,72 @@
+import pytest
+from databases import Database
+from fastapi import FastAPI, status
+from httpx import AsyncClient
+
+from app.db.pool import get_pool
+from app.db.queries import QUERIES, QueryRegistry, compile_query
+from app.db.repositories.cleanings import GET_CLEANING_BY_ID_QUERY, CleaningsRepository
+from app.models.cleaning import CleaningInDB
+
+pytestmark = pytest.mark.asyncio
+
+
+class TestQueryCompilation:
+    def test_named_parameters_become_positional(self) -> None:
+        compiled = compile_query("SELECT * FROM cleanings WHERE id = :id AND price > :price OR id = :id")
+
+        assert compiled.sql == "SELECT * FROM cleanings WHERE id = $1 AND price > $2 OR id = $1"
+        assert compiled.parameters == ("id", "price")
+        assert compiled.arguments({"price": 10, "id": 3}) == [3, 10]
+
+    def test_casts_and_times_are_left_alone(self) -> None:
+        compiled = compile_query("SELECT CAST(:ids AS int[]), '12:30'::time, now()::date")
+
+        assert compiled.sql == "SELECT CAST($1 AS int[]), '12:30'::time, now()::date"
+        assert compiled.parameters == ("ids",)
+
+    def test_missing_values_are_reported_by_name(self) -> None:
+        with pytest.raises(KeyError, match="price"):
+            compile_query("SELECT :price").arguments({})
+
+    def test_repository_queries_are_registered_by_name(self) -> None:
+        assert QUERIES.compile(GET_CLEANING_BY_ID_QUERY).name == "GET_CLEANING_BY_ID_QUERY"
+
+    def test_runtime_statements_are_compiled_once_and_bounded(self) -> None:
+        registry = QueryRegistry(max_adhoc=2)
+
+        first = registry.compile("SELECT :a")
+        assert registry.compile("SELECT :a") is first
+        assert first.name is None
+
+        registry.compile("SELECT :b")
+        registry.compile("SELECT :c")
+        assert registry.compile("SELECT :a") is not first
+
+
+class TestStatementCache:
+    async def test_repeated_point_lookups_reuse_the_prepared_statement(
+        self, app: FastAPI, client: AsyncClient, db: Database, sample_cleaning: CleaningInDB
+    ) -> None:
+        statements = get_pool(db).statements
+        repo = CleaningsRepository(db)
+
+        await repo.get_cleaning_by_id(get_id=sample_cleaning.id)
+        hits, misses = statements.hits, statements.misses
+        found = await repo.get_cleaning_by_id(get_id=sample_cleaning.id)
+
+        assert found == sample_cleaning
+        assert statements.hits == hits + 1
+        assert statements.misses == misses
+
+    async def test_hit_rate_is_reported_with_the_pool(
+        self, app: FastAPI, client: AsyncClient, sample_cleaning: CleaningInDB
+    ) -> None:
+        from app.core import config
+
+        res = await client.get(app.url_path_for("health:ready"))
+        assert res.status_code == status.HTTP_200_OK
+
+        statements = res.json()["pool"]["statements"]
+        assert statements["max_size"] == config.DB_STATEMENT_CACHE_SIZE
+        assert statements["hits"] + statements["misses"] >= 1
@@ -0,0 +1,96 @@
+import re
+from typing import List
+
+import pytest
+from fastapi import FastAPI, status
+from httpx import AsyncClient
+from loguru import logger
+
+from app.models.cleaning import CleaningInDB
+
+pytestmark = pytest.mark.asyncio
+
+SERVER_TIMING = re.compile(r'^db;dur=\d+\.\d;desc="(\d+) queries"$')
+
+
+@pytest.fixture
+def logs() -> List[str]:
+    messages = []
+    handler_id = logger.add(lambda message: messages.append(str(message)), level="WARNING")
+    yield messages
+    logger.remove(handler_id)
+
+
+@pytest.fixture
+def log_every_query(monkeypatch) -> None:
+    from app.core import config
+
+    monkeypatch.setattr(config, "DB_SLOW_QUERY_MS", 0.0)
+
+
+@pytest.fixture
+def explain_slow_queries(monkeypatch, log_every_query: None) -> None:
+    from app.core import config
+
+    monkeypatch.setattr(config, "DB_EXPLAIN_SLOW_QUERIES", True)
+
+
+class TestServerTiming:
+    async def test_database_totals_are_reported(
+        self, app: FastAPI, client: AsyncClient, sample_cleaning: CleaningInDB
+    ) -> None:
+        res = await client.get(app.url_path_for("cleanings:get-cleaning-by-id", cleaning_id=sample_cleaning.id))
+        assert res.status_code == status.HTTP_200_OK
+
+        match = SERVER_TIMING.match(res.headers["Server-Timing"])
+        assert match is not None
+        assert int(match.group(1)) >= 1
+
+    async def test_requests_without_queries_report_zero(self, app: FastAPI, client: AsyncClient) -> None:
+        res = await client.get(app.url_path_for("health:live"))
+        assert res.headers["Server-Timing"] == 'db;dur=0.0;desc="0 queries"'
+
+
+class TestSlowQueryLog:
+    async def test_queries_over_threshold_are_logged_without_values(
+        self, app: FastAPI, client: AsyncClient, sample_cleaning: CleaningInDB, logs: List[str],
+        log_every_query: None,
+    ) -> None:
+        res = await client.get(app.url_path_for("cleanings:get-cleaning-by-id", cleaning_id=sample_cleaning.id))
+        assert res.status_code == status.HTTP_200_OK
+
+        slow = [message for message in logs if "slow query CleaningsRepository.get_cleaning_by_id" in message]
+        assert len(slow) == 1
+        assert "params={'id': 'int'}" in slow[0]
+        assert "FROM cleanings" in slow[0]
+
+    async def test_queries_under_threshold_are_not_logged(
+        self, app: FastAPI, client: AsyncClient, sample_cleaning: CleaningInDB, logs: List[str]
+    ) -> None:
+        await client.get(app.url_path_for("cleanings:get-cleaning-by-id", cleaning_id=sample_cleaning.id))
+        assert not [message for message in logs if "slow query" in message]
+
+    async def test_negative_threshold_turns_the_log_off(
+        self, app: FastAPI, client: AsyncClient, sample_cleaning: CleaningInDB, logs: List[str], monkeypatch
+    ) -> None:
+        monkeypatch.setattr("app.core.config.DB_SLOW_QUERY_MS", -1.0)
+        await client.get(app.url_path_for("cleanings:get-cleaning-by-id", cleaning_id=sample_cleaning.id))
+        assert not [message for message in logs if "slow query" in message]
+
+    async def test_explained_writes_are_rolled_back(
+        self, app: FastAPI, client: AsyncClient, sample_cleaning: CleaningInDB, logs: List[str],
+        explain_slow_queries: None,
+    ) -> None:
+        res = await client.patch(
+            app.url_path_for("cleanings:patch-cleaning-by-id", cleaning_id=sample_cleaning.id),
+            json={"cleaning_update": {"price": 12.5}},
+        )
+        assert res.status_code == status.HTTP_200_OK
+        assert res.json()["version"] == sample_cleaning.version + 1
+
+        plans = [message for message in logs if "plan of slow query CleaningsRepository.update_cleaning" in message]
+        assert len(plans) == 1
+        assert "actual time" in plans[0]
+
+        res = await client.get(app.url_path_for("cleanings:get-cleaning-by-id", cleaning_id=sample_cleaning.id))
+        assert res.json()["version"] == sample_cleaning.version + 1
@@ -0,0 +1,206 @@
+from typing import List
+
+import pytest
+from databases import Database
+from fastapi import FastAPI, status
+from httpx import AsyncClient
+
+from app.core.context import READ_PRIMARY_COOKIE
+from app.db.cache import MISSING
+from app.db.pool import get_pool
+from app.db.replicas import LEAST_LOADED, Replica, ReplicaSet
+from app.db.repositories.cleanings import CLEANING_CACHE_NAMESPACE
+from app.models.cleaning import CleaningCreate, CleaningInDB
+
+pytestmark = pytest.mark.asyncio
+
+UNREACHABLE_URL = "postgresql://datguy@127.0.0.1:1/postgres"
+
+
+@pytest.fixture
+def new_cleaning() -> CleaningCreate:
+    return CleaningCreate(name="replicated cleaning", price=10.00, cleaning_type="spot_clean")
+
+
+@pytest.fixture
+def replica_urls(monkeypatch, database_url: str) -> List[str]:
+    from app.core import config
+
+    # The test database stands in for a healthy replica
+    urls = [database_url, UNREACHABLE_URL]
+    monkeypatch.setattr(config, "DATABASE_REPLICA_URLS", urls)
+    monkeypatch.setattr(config, "CACHE_ENABLED", False)
+    return urls
+
+
+@pytest.fixture
+def app(replica_urls: List[str]) -> FastAPI:
+    from app.main import get_application
+
+    return get_application()
+
+
+@pytest.fixture
+def replica(app: FastAPI, client: AsyncClient) -> Database:
+    healthy = [replica for replica in app.state.replicas.replicas if replica.healthy]
+    assert len(healthy) == 1
+    return healthy[0].database
+
+
+def acquired(database: Database) -> int:
+    return get_pool(database).acquired_total
+
+
+# Replicas read from connections of their own
+@pytest.mark.committed
+class TestReplicaRouting:
+    async def test_unreachable_replicas_are_out_of_rotation(self, app: FastAPI, client: AsyncClient) -> None:
+        res = await client.get(app.url_path_for("health:ready"))
+        assert res.status_code == status.HTTP_200_OK
+
+        replicas = {replica["name"]: replica for replica in res.json()["replicas"]}
+        assert replicas["127.0.0.1:1/postgres"]["healthy"] is False
+        assert sum(replica["healthy"] for replica in replicas.values()) == 1
+
+    async def test_reads_go_to_replicas_and_writes_to_primary(
+        self, app: FastAPI, client: AsyncClient, db: Database, replica: Database, new_cleaning: CleaningCreate
+    ) -> None:
+        primary_before, replica_before = acquired(db), acquired(replica)
+        res = await client.get(app.url_path_for("cleanings:get-all-cleanings"))
+        assert res.status_code == status.HTTP_200_OK
+        assert acquired(db) == primary_before
+        assert acquired(replica) > replica_before
+
+        client.cookies.clear()
+        replica_before = acquired(replica)
+        res = await client.post(
+            app.url_path_for("cleanings:create-cleaning"), json={"new_cleaning": new_cleaning.dict()}
+        )
+        assert res.status_code == status.HTTP_201_CREATED
+        assert acquired(replica) == replica_before
+
+    async def test_clients_read_their_own_writes_from_primary(
+        self, app: FastAPI, client: AsyncClient, db: Database, replica: Database, new_cleaning: CleaningCreate
+    ) -> None:
+        res = await client.post(
+            app.url_path_for("cleanings:create-cleaning"), json={"new_cleaning": new_cleaning.dict()}
+        )
+        assert res.status_code == status.HTTP_201_CREATED
+        assert READ_PRIMARY_COOKIE in res.cookies
+
+        replica_before = acquired(replica)
+        res = await client.get(app.url_path_for("cleanings:get-cleaning-by-id", cleaning_id=res.json()["id"]))
+        assert res.status_code == status.HTTP_200_OK
+        assert acquired(replica) == replica_before
+
+        client.cookies.clear()
+        await client.get(app.url_path_for("cleanings:get-all-cleanings"))
+        assert acquired(replica) > replica_before
+
+    async def test_forged_cookies_do_not_pin_clients_to_primary(
+        self, app: FastAPI, client: AsyncClient, replica: Database
+    ) -> None:
+        replica_before = acquired(replica)
+        client.cookies.set(READ_PRIMARY_COOKIE, "99999999999")
+
+        await client.get(app.url_path_for("cleanings:get-all-cleanings"))
+        assert acquired(replica) > replica_before
+
+    async def test_failing_replica_fails_over_to_primary(
+        self, app: FastAPI, client: AsyncClient, db: Database, replica: Database
+    ) -> None:
+        pool = get_pool(replica)
+        pool.acquire_timeout = 0.05
+        held = [await pool.acquire() for _ in range(pool.stats()["max_size"])]
+        try:
+            primary_before = acquired(db)
+            res = await client.get(app.url_path_for("cleanings:get-all-cleanings"))
+            assert res.status_code == status.HTTP_200_OK
+            assert acquired(db) > primary_before
+            assert app.state.replicas.choose() is None
+        finally:
+            for connection in held:
+                await pool.release(connection)
+
+        await app.state.replicas.check_all()
+        assert app.state.replicas.choose() is replica
+
+
+@pytest.mark.committed
+class TestCachedReplicaReads:
+    @pytest.fixture
+    def app(self, monkeypatch, replica_urls: List[str]) -> FastAPI:
+        from app.core import config
+        from app.main import get_application
+
+        monkeypatch.setattr(config, "CACHE_ENABLED", True)
+        return get_application()
+
+    async def test_cache_is_filled_from_primary(
+        self, app: FastAPI, client: AsyncClient, db: Database, replica: Database, new_cleaning: CleaningCreate
+    ) -> None:
+        res = await client.post(
+            app.url_path_for("cleanings:create-cleaning"), json={"new_cleaning": new_cleaning.dict()}
+        )
+        url = app.url_path_for("cleanings:get-cleaning-by-id", cleaning_id=res.json()["id"])
+        client.cookies.clear()
+
+        primary_before, replica_before = acquired(db), acquired(replica)
+        res = await client.get(url)
+        assert res.status_code == status.HTTP_200_OK
+        assert acquired(db) > primary_before
+        assert acquired(replica) == replica_before
+
+        # Then served from the cache
+        primary_before = acquired(db)
+        res = await client.get(url)
+        assert res.json()["name"] == new_cleaning.name
+        assert (acquired(db), acquired(replica)) == (primary_before, replica_before)
+
+    async def test_clients_pinned_to_primary_skip_the_cache(
+        self, app: FastAPI, client: AsyncClient, new_cleaning: CleaningCreate
+    ) -> None:
+        res = await client.post(
+            app.url_path_for("cleanings:create-cleaning"), json={"new_cleaning": new_cleaning.dict()}
+        )
+        cleaning = CleaningInDB(**res.json())
+        url = app.url_path_for("cleanings:get-cleaning-by-id", cleaning_id=cleaning.id)
+
+        res = await client.get(url)
+        assert res.json()["name"] == new_cleaning.name
+        assert await app.state.cache.get(CLEANING_CACHE_NAMESPACE, cleaning.id) is MISSING
+
+        # As if this worker had not heard of the write yet
+        await app.state.cache.set(CLEANING_CACHE_NAMESPACE, cleaning.id, cleaning.copy(update={"name": "stale"}))
+        res = await client.get(url)
+        assert res.json()["name"] == new_cleaning.name
+
+        client.cookies.clear()
+        res = await client.get(url)
+        assert res.json()["name"] == "stale"
+
+
+class LoadedReplica(Replica):
+    def __init__(self, name: str, load: int) -> None:
+        super().__init__(f"postgresql://user@{name}/db", Database(f"postgresql://user@{name}/db"))
+        self.healthy = True
+        self._load = load
+
+    def load(self) -> int:
+        return self._load
+
+
+class TestReplicaSelection:
+    def test_round_robin_alternates_between_healthy_replicas(self) -> None:
+        first, second, down = LoadedReplica("a", 0), LoadedReplica("b", 0), LoadedReplica("c", 0)
+        down.healthy = False
+        replicas = ReplicaSet([first, second, down])
+
+        chosen = [replicas.choose() for _ in range(4)]
+        assert chosen == [first.database, second.database, first.database, second.database]
+
+    def test_least_loaded_picks_fewest_connections_in_use(self) -> None:
+        busy, idle = LoadedReplica("a", 5), LoadedReplica("b", 1)
+        replicas = ReplicaSet([busy, idle], selection=LEAST_LOADED)
+
+        assert replicas.choose() is idle.database
@@ -0,0 +1,57 @@
+import os
+import runpy
+from unittest import mock
+
+import pytest
+
+GUNICORN_CONF = os.path.join(os.path.dirname(os.path.dirname(__file__)), "gunicorn.conf.py")
+
+
+@pytest.fixture
+def server_env(monkeypatch, tmp_path):
+    # The config writes os.environ itself, behind monkeypatch's back: the whole environment is put back afterwards
+    with mock.patch.dict(os.environ):
+        for name in ("WEB_CONCURRENCY", "DB_CONNECTION_BUDGET", "DB_MIN_POOL_SIZE", "DB_MAX_POOL_SIZE",
+                     "prometheus_multiproc_dir"):
+            monkeypatch.delenv(name, raising=False)
+        monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+        yield monkeypatch
+
+
+class TestServerConfig:
+    def test_defaults_to_one_worker_per_cpu(self, server_env) -> None:
+        settings = runpy.run_path(GUNICORN_CONF)
+        assert settings["workers"] == os.cpu_count()
+        assert settings["worker_class"] == "uvicorn.workers.UvicornWorker"
+        assert settings["preload_app"] is True
+        assert settings["max_requests"] > 0
+        assert "DB_MAX_POOL_SIZE" not in os.environ
+
+    def test_pools_share_the_connection_budget(self, server_env) -> None:
+        server_env.setenv("WEB_CONCURRENCY", "4")
+        server_env.setenv("DB_CONNECTION_BUDGET", "50")
+        settings = runpy.run_path(GUNICORN_CONF)
+
+        # 50 // 4 leaves 12 per worker, one of them for the notification listener
+        assert os.environ["DB_MAX_POOL_SIZE"] == "11"
+        assert os.environ["DB_MIN_POOL_SIZE"] == "2"
+        assert settings["workers"] * (11 + settings["CONNECTIONS_OUTSIDE_POOL"]) <= 50
+
+    def test_min_pool_size_never_exceeds_max(self, server_env) -> None:
+        server_env.setenv("WEB_CONCURRENCY", "8")
+        server_env.setenv("DB_CONNECTION_BUDGET", "16")
+        server_env.setenv("DB_MIN_POOL_SIZE", "5")
+        runpy.run_path(GUNICORN_CONF)
+
+        assert os.environ["DB_MIN_POOL_SIZE"] == os.environ["DB_MAX_POOL_SIZE"] == "1"
+
+    def test_budget_too_small_for_the_workers(self, server_env) -> None:
+        server_env.setenv("WEB_CONCURRENCY", "8")
+        server_env.setenv("DB_CONNECTION_BUDGET", "10")
+        with pytest.raises(ValueError):
+            runpy.run_path(GUNICORN_CONF)
+
+    def test_stale_metric_files_are_removed(self, server_env, tmp_path) -> None:
+        (tmp_path / "counter_1234.db").write_bytes(b"\0" * 8)
+        runpy.run_path(GUNICORN_CONF)
+        assert not list(tmp_path.iterdir())